@@ -0,0 +1,1800 @@
+"""
+Benchmarks locais do bot. Nenhum cenário acessa a Efí ou o Telegram: os bancos são
+criados em um diretório temporário e as APIs externas são simuladas.
+
+Uso:
+    python benchmark.py repositorio [--cliques 5000] [--concorrencia 50]
+    python benchmark.py indices [--linhas 1000000] [--consultas 200]
+    python benchmark.py persistencia [--usuarios 100000] [--sujos 20]
+    python benchmark.py atualizacoes [--usuarios 200] [--por-usuario 5] [--latencia 0.05]
+    python benchmark.py checkout [--usuarios 50] [--cliques 5] [--latencia 0.2]
+    python benchmark.py consultas [--usuarios 200] [--cliques 10] [--intervalo 0.5] [--latencia 0.1]
+    python benchmark.py metricas [--observacoes 1000000]
+    python benchmark.py transmissao [--destinatarios 100000] [--taxa 20000]
+    python benchmark.py convites [--aprovacoes 50] [--profundidade 20] [--latencia 0.3]
+    python benchmark.py sessoes [--usuarios 100000]
+    python benchmark.py renderizacao [--atualizacoes 20000]
+    python benchmark.py relatorio [--linhas 2000000] [--dias 30]
+    python benchmark.py multiprocesso [--usuarios 2000] [--workers 1 2 4] [--latencia 0.02]
+    python benchmark.py efi_tls [--chamadas 500] [--simultaneas 16] [--latencia 0]
+    python benchmark.py disjuntor [--chegada 20] [--queda 10] [--falha erro|lenta] [--timeout 2]
+    python benchmark.py limite [--usuarios 200] [--robos 20] [--cliques-robo 20] [--duracao 10] [--baldes 200000]
+    python benchmark.py carga [--usuarios 1000] [--chegada 50] [--erros-efi 0.01] [--saida atual.json] [--comparar base.json]
+"""
+import argparse
+import asyncio
+import contextlib
+import functools
+import html
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import random
+import sqlite3
+import ssl
+import subprocess
+import tempfile
+import tracemalloc
+import threading
+import time
+import collections
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import pytz
+from aiohttp import web
+from efipay import Constants, EfiPay
+from telegram import Chat, InlineKeyboardButton, InlineKeyboardMarkup, Message, Update, User
+from telegram.ext import Application, CallbackContext, CallbackQueryHandler, ContextTypes, MessageHandler, PicklePersistence, TypeHandler, filters
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import BaseRequest
+
+import bot
+
+
+def _banco_temporario(diretorio: str) -> str:
+    bot.DB_FILE = os.path.join(diretorio, "pagamentos.db")
+    bot.aplicar_migracoes()
+    return bot.DB_FILE
+
+
+def _relatorio(nome: str, operacoes: int, segundos: float):
+    print(f"{nome:<28} {operacoes:>8} ops  {segundos:8.3f} s  {operacoes / segundos:10.0f} ops/s  "
+          f"{segundos / operacoes * 1e6:8.1f} µs/op")
+
+
+# -----------------------------------------------------------------------------
+# 🗂️ REPOSITÓRIO vs. CONEXÃO POR CHAMADA
+# -----------------------------------------------------------------------------
+def _clique_conexao_por_chamada(db_file: str, i: int):
+    """Reproduz o padrão antigo: um sqlite3.connect por consulta, dentro do loop."""
+    user_id = i % 1000
+    conn = sqlite3.connect(db_file, timeout=10)
+    try:
+        conn.execute("SELECT txid, tipo_plano FROM pagamentos WHERE user_id = ? AND status = 'pendente' ORDER BY data_criacao DESC LIMIT 1", (user_id,)).fetchone()
+    finally:
+        conn.close()
+    conn = sqlite3.connect(db_file, timeout=10)
+    try:
+        conn.execute("UPDATE pagamentos SET status = ? WHERE user_id = ? AND status = ?", ('cancelada', user_id, 'pendente'))
+        conn.execute('INSERT INTO pagamentos (txid, user_id, username, status, pix_message_id, tipo_plano, valor_centavos) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (f"antigo{i}", user_id, "u", "pendente", i, "mensal", 990))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def _bench_repositorio(cliques: int, concorrencia: int):
+    with tempfile.TemporaryDirectory() as diretorio:
+        db_file = _banco_temporario(diretorio)
+
+        inicio = time.perf_counter()
+        for i in range(cliques):
+            _clique_conexao_por_chamada(db_file, i)
+        _relatorio("conexão por chamada", cliques, time.perf_counter() - inicio)
+
+        repositorio = bot.RepositorioPagamentos(db_file)
+        await repositorio.abrir()
+        semaforo = asyncio.Semaphore(concorrencia)
+
+        async def clique(i):
+            user_id = i % 1000
+            async with semaforo:
+                await repositorio.pendente_do_usuario(user_id)
+                await repositorio.substituir_pendente(f"novo{i}", user_id, "u", i, "mensal", 990)
+
+        inicio = time.perf_counter()
+        await asyncio.gather(*(clique(i) for i in range(cliques)))
+        _relatorio(f"repositório (conc. {concorrencia})", cliques, time.perf_counter() - inicio)
+        await repositorio.fechar()
+
+
+# -----------------------------------------------------------------------------
+# 📇 ÍNDICES E ESQUEMA V2 EM UM BANCO COM 1M DE LINHAS
+# -----------------------------------------------------------------------------
+CONSULTA_PENDENTE = "SELECT txid, tipo_plano FROM pagamentos WHERE user_id = ? AND status = 'pendente' ORDER BY data_criacao DESC LIMIT 1"
+ATUALIZACAO_CANCELA = "UPDATE pagamentos SET status = 'cancelada' WHERE user_id = ? AND status = 'pendente'"
+
+
+def _medir_consultas(db_file: str, usuarios: int, consultas: int, rotulo: str):
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    for sql in (CONSULTA_PENDENTE, ATUALIZACAO_CANCELA):
+        plano = conn.execute(f"EXPLAIN QUERY PLAN {sql}", (1,)).fetchall()
+        print(f"[{rotulo}] plano de {sql.split()[0]}: " + " | ".join(linha[-1] for linha in plano))
+
+    ids = [random.randrange(usuarios) for _ in range(consultas)]
+    inicio = time.perf_counter()
+    for user_id in ids:
+        conn.execute(CONSULTA_PENDENTE, (user_id,)).fetchone()
+    _relatorio(f"[{rotulo}] SELECT pendente", consultas, time.perf_counter() - inicio)
+
+    conn.execute("BEGIN")
+    inicio = time.perf_counter()
+    for user_id in ids:
+        conn.execute(ATUALIZACAO_CANCELA, (user_id,))
+    _relatorio(f"[{rotulo}] UPDATE cancela", consultas, time.perf_counter() - inicio)
+    conn.execute("ROLLBACK")
+    conn.close()
+
+
+def _bench_indices(linhas: int, consultas: int):
+    usuarios = max(linhas // 5, 1)
+    with tempfile.TemporaryDirectory() as diretorio:
+        bot.DB_FILE = os.path.join(diretorio, "pagamentos.db")
+        bot.aplicar_migracoes(ate=1)
+
+        inicio = time.perf_counter()
+        conn = sqlite3.connect(bot.DB_FILE)
+        status = ['cancelada'] * 6 + ['aprovado'] * 3 + ['pendente']
+        conn.executemany(
+            "INSERT INTO pagamentos (txid, user_id, username, status, data_criacao, tipo_plano, valor) "
+            "VALUES (?, ?, 'u', ?, datetime('now', ?), 'mensal', 9.9)",
+            ((f"tx{i}", random.randrange(usuarios), random.choice(status), f"-{random.randrange(10**7)} seconds")
+             for i in range(linhas))
+        )
+        conn.commit()
+        conn.close()
+        print(f"{linhas} linhas ({usuarios} usuários) geradas em {time.perf_counter() - inicio:.1f}s")
+
+        _medir_consultas(bot.DB_FILE, usuarios, consultas, "v1")
+        inicio = time.perf_counter()
+        bot.aplicar_migracoes()
+        print(f"Migração até a v{len(bot.MIGRACOES)} em {time.perf_counter() - inicio:.1f}s")
+        _medir_consultas(bot.DB_FILE, usuarios, consultas, f"v{len(bot.MIGRACOES)}")
+
+
+# -----------------------------------------------------------------------------
+# 💾 PicklePersistence vs. PersistenciaSQLite
+# -----------------------------------------------------------------------------
+def _dados_usuario(i: int) -> dict:
+    return {
+        'last_activity_time': datetime.now(),
+        'plano_escolhido': {'tipo': 'mensal', 'valor': '19.90'},
+        'pix_message_id': i,
+    }
+
+
+async def _bench_persistencia(usuarios: int, sujos: int):
+    with tempfile.TemporaryDirectory() as diretorio:
+        arquivo = os.path.join(diretorio, "bot_persistence")
+        semente = PicklePersistence(filepath=arquivo, on_flush=True)
+        await semente.get_user_data()
+        for i in range(usuarios):
+            await semente.update_user_data(i, _dados_usuario(i))
+        await semente.flush()
+
+        # Mesma configuração do bot antigo: on_flush=False regrava o arquivo inteiro a cada usuário.
+        inicio = time.perf_counter()
+        pickle_persistence = PicklePersistence(filepath=arquivo)
+        await pickle_persistence.get_user_data()
+        print(f"Pickle   inicialização ({usuarios} usuários): {time.perf_counter() - inicio:8.3f} s")
+        inicio = time.perf_counter()
+        for i in range(sujos):
+            await pickle_persistence.update_user_data(i, _dados_usuario(i))
+        await pickle_persistence.flush()
+        print(f"Pickle   gravação de {sujos} usuários alterados: {time.perf_counter() - inicio:8.3f} s "
+              f"(arquivo: {os.path.getsize(arquivo) / 1e6:.1f} MB)")
+
+        db_file = _banco_temporario(diretorio)
+        conn = sqlite3.connect(db_file)
+        dados = pickle.dumps({'plano_escolhido': {'tipo': 'mensal', 'valor': '19.90'}})
+        conn.executemany("INSERT INTO persistencia_usuarios (user_id, dados, atualizado_em) VALUES (?, ?, ?)",
+                         ((i, dados, int(time.time())) for i in range(usuarios)))
+        conn.commit()
+        conn.close()
+
+        repositorio = bot.RepositorioPagamentos(db_file)
+        inicio = time.perf_counter()
+        await repositorio.abrir()
+        persistencia = bot.PersistenciaSQLite(repositorio)
+        await persistencia.get_user_data()
+        print(f"SQLite   inicialização ({usuarios} usuários): {time.perf_counter() - inicio:8.3f} s")
+
+        # Cada usuário alterado é carregado sob demanda e gravado com um plano diferente.
+        inicio = time.perf_counter()
+        sessoes = [bot.SessaoUsuario() for _ in range(sujos)]
+        for i, sessao in enumerate(sessoes):
+            await persistencia.refresh_user_data(i, sessao)
+            sessao.escolher_plano(bot.Plano.TRIMESTRAL)
+        await asyncio.gather(*(persistencia.update_user_data(i, sessao) for i, sessao in enumerate(sessoes)))
+        await persistencia.flush()
+        print(f"SQLite   carga + gravação de {sujos} usuários alterados: {time.perf_counter() - inicio:8.3f} s")
+        await repositorio.fechar()
+
+
+# -----------------------------------------------------------------------------
+# 🔀 THROUGHPUT DE ATUALIZAÇÕES: SEQUENCIAL vs. PROCESSADOR POR USUÁRIO
+# -----------------------------------------------------------------------------
+class RequisicaoFalsa(BaseRequest):
+    """
+    Bot API simulada em processo: responde a tudo com sucesso depois de `latencia`
+    segundos. Envios e edições devolvem uma mensagem no chat de destino.
+    """
+
+    def __init__(self, latencia: float = 0.0):
+        self.latencia = latencia
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        metodo = url.rsplit("/", 1)[-1]
+        if metodo == "getMe":
+            resultado = {"id": 1, "is_bot": True, "first_name": "bot", "username": "bot_falso"}
+        else:
+            await asyncio.sleep(self.latencia)
+            resultado = True
+            if metodo.startswith(("send", "edit")):
+                chat_id = (request_data.parameters if request_data else {}).get("chat_id", 1)
+                self.mensagens = getattr(self, "mensagens", 0) + 1
+                resultado = {"message_id": self.mensagens, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+        return 200, json.dumps({"ok": True, "result": resultado}).encode()
+
+
+def _atualizacao_sintetica(update_id: int, user_id: int, sequencia: int) -> Update:
+    usuario = User(id=user_id, is_bot=False, first_name=f"u{user_id}")
+    mensagem = Message(message_id=update_id, date=datetime.now(), chat=Chat(id=user_id, type=Chat.PRIVATE),
+                       from_user=usuario, text=str(sequencia))
+    return Update(update_id=update_id, message=mensagem)
+
+
+async def _bench_atualizacoes(usuarios: int, por_usuario: int, latencia: float, simultaneas: int):
+    total = usuarios * por_usuario
+    for nome, processador in (("sequencial", False), (f"por usuário ({simultaneas})", bot.ProcessadorPorUsuario(simultaneas))):
+        app = (Application.builder().token("1:falso").request(RequisicaoFalsa(latencia))
+               .concurrent_updates(processador).updater(None).build())
+        recebidas = defaultdict(list)
+        concluido = asyncio.Event()
+
+        async def tratar(update: Update, context):
+            await context.bot.send_message(chat_id=update.effective_user.id, text="ok")
+            recebidas[update.effective_user.id].append(int(update.message.text))
+            if sum(map(len, recebidas.values())) == total:
+                concluido.set()
+
+        app.add_handler(MessageHandler(filters.TEXT, tratar))
+        await app.initialize()
+        await app.start()
+
+        inicio = time.perf_counter()
+        update_id = 0
+        for sequencia in range(por_usuario):
+            for user_id in range(1, usuarios + 1):
+                update_id += 1
+                await app.update_queue.put(_atualizacao_sintetica(update_id, user_id, sequencia))
+        await concluido.wait()
+        _relatorio(nome, total, time.perf_counter() - inicio)
+
+        fora_de_ordem = sum(1 for seq in recebidas.values() if seq != sorted(seq))
+        print(f"    usuários com atualizações fora de ordem: {fora_de_ordem}")
+        await app.stop()
+        await app.shutdown()
+
+
+# -----------------------------------------------------------------------------
+# 🔒 CHECKOUT: CLIQUES SIMULTÂNEOS EM "LI E ACEITO OS TERMOS"
+# -----------------------------------------------------------------------------
+class GatewayFalso:
+    """Substitui o GatewayEfi: conta as cobranças criadas e simula a latência da Efí."""
+
+    def __init__(self, latencia: float):
+        self.latencia = latencia
+        self.cobrancas = 0
+
+    async def criar_cobranca(self, body: dict) -> dict:
+        await asyncio.sleep(self.latencia)
+        self.cobrancas += 1
+        # O pid no txid evita colisões quando vários workers usam o GatewayFalso no mesmo banco.
+        return {"txid": f"falso{os.getpid():08d}{self.cobrancas:020d}", "loc": {"id": self.cobrancas}}
+
+    async def gerar_qrcode(self, loc_id) -> dict:
+        await asyncio.sleep(self.latencia)
+        return {"pixCopiaECola": f"00020126580014br.gov.bcb.pix{loc_id}"}
+
+    async def detalhar_cobranca(self, txid: str, usar_cache: bool = True) -> dict:
+        await asyncio.sleep(self.latencia)
+        return {"txid": txid, "status": "ATIVA"}
+
+    def disponivel(self, *endpoints: str) -> bool:
+        return True
+
+
+def _clique_sintetico(bot_telegram, update_id: int, user_id: int, dados: str) -> Update:
+    usuario = {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}
+    mensagem = {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "from": usuario}
+    consulta = {"id": str(update_id), "from": usuario, "chat_instance": str(user_id), "message": mensagem, "data": dados}
+    return Update.de_json({"update_id": update_id, "callback_query": consulta}, bot_telegram)
+
+
+async def _bench_checkout(usuarios: int, cliques: int, latencia: float):
+    """
+    Cada usuário escolhe o plano e toca `cliques` vezes em "Li e aceito os Termos"
+    ao mesmo tempo. O esperado é uma única cobrança pendente por usuário, tanto com
+    todas as atualizações em paralelo quanto com o ProcessadorPorUsuario.
+    """
+    cenarios = (("paralelo", True), ("por usuário", bot.ProcessadorPorUsuario(bot.ATUALIZACOES_SIMULTANEAS)))
+    for nome, processador in cenarios:
+        with tempfile.TemporaryDirectory() as diretorio:
+            db_file = _banco_temporario(diretorio)
+            bot.repositorio = bot.RepositorioPagamentos(db_file)
+            bot.gateway = GatewayFalso(latencia)
+            bot.travas_checkout = bot.TravasPorUsuario(bot.CHECKOUT_TRAVA_TTL)
+
+            app = (Application.builder().token("1:falso").request(RequisicaoFalsa(0.01))
+                   .context_types(ContextTypes(user_data=bot.SessaoUsuario))
+                   .concurrent_updates(processador).updater(None).build())
+            app.add_handler(CallbackQueryHandler(bot.mostrar_termos, pattern=r"^plano_"))
+            app.add_handler(CallbackQueryHandler(bot.aceitar_termos, pattern="^aceitar_termos$"))
+            processadas = 0
+            concluido = asyncio.Event()
+
+            async def contar(update, context):
+                nonlocal processadas
+                processadas += 1
+                if processadas == esperadas:
+                    concluido.set()
+
+            app.add_handler(TypeHandler(Update, contar), group=1)
+            await bot.repositorio.abrir()
+            await app.initialize()
+            await app.start()
+
+            update_id = 0
+            esperadas = usuarios
+            for user_id in range(1, usuarios + 1):
+                update_id += 1
+                await app.update_queue.put(_clique_sintetico(app.bot, update_id, user_id, "plano_mensal"))
+            await concluido.wait()
+
+            concluido.clear()
+            processadas, esperadas = 0, usuarios * cliques
+            inicio = time.perf_counter()
+            for _ in range(cliques):
+                for user_id in range(1, usuarios + 1):
+                    update_id += 1
+                    await app.update_queue.put(_clique_sintetico(app.bot, update_id, user_id, "aceitar_termos"))
+            await concluido.wait()
+            segundos = time.perf_counter() - inicio
+
+            await app.stop()
+            await app.shutdown()
+            await bot.repositorio.fechar()
+            with sqlite3.connect(db_file) as conn:
+                pendentes = conn.execute("SELECT COUNT(*) FROM pagamentos WHERE status = 'pendente'").fetchone()[0]
+                canceladas = conn.execute("SELECT COUNT(*) FROM pagamentos WHERE status = 'cancelada'").fetchone()[0]
+            _relatorio(nome, usuarios * cliques, segundos)
+            print(f"    cobranças criadas na Efí: {bot.gateway.cobrancas} para {usuarios} usuário(s); "
+                  f"pendentes: {pendentes}; canceladas: {canceladas}")
+
+
+# -----------------------------------------------------------------------------
+# 🔁 CONSULTAS DE COBRANÇA: SEM CACHE vs. CACHE COM COALESCÊNCIA
+# -----------------------------------------------------------------------------
+class ClienteEfiFalso:
+    """Imita o SDK síncrono da Efí em `pix_detail_charge`; 30% das cobranças já foram pagas."""
+
+    def __init__(self, latencia: float):
+        self.latencia = latencia
+        self.chamadas = 0
+        self._trava = threading.Lock()
+
+    def pix_detail_charge(self, params: dict) -> dict:
+        with self._trava:
+            self.chamadas += 1
+        time.sleep(self.latencia)
+        txid = params['txid']
+        return {"txid": txid, "status": "CONCLUIDA" if int(txid[-1]) < 3 else "ATIVA"}
+
+
+async def _bench_consultas(usuarios: int, cliques: int, intervalo: float, latencia: float):
+    """
+    Pico de pagamentos: cada usuário aperta "Já paguei" / "Tentar novamente"
+    `cliques` vezes, com pausas aleatórias de até 2 x `intervalo`, e às vezes em
+    dois toques seguidos.
+    """
+    for nome, usar_cache in (("sem cache", False), ("cache + coalescência", True)):
+        cliente = ClienteEfiFalso(latencia)
+        gateway = bot.GatewayEfi(bot.TransporteSdkEfi(cliente), cache=bot.CacheCobrancas(bot.EFI_CACHE_TAMANHO, bot.EFI_CACHE_TTL))
+        aleatorio = random.Random(42)
+
+        async def usuario(user_id):
+            txid = f"txid{user_id:030d}"
+            for _ in range(cliques):
+                toques = 2 if aleatorio.random() < 0.2 else 1
+                await asyncio.gather(*(gateway.detalhar_cobranca(txid, usar_cache=usar_cache) for _ in range(toques)))
+                await asyncio.sleep(aleatorio.uniform(0, 2 * intervalo))
+
+        inicio = time.perf_counter()
+        await asyncio.gather(*(usuario(user_id) for user_id in range(usuarios)))
+        segundos = time.perf_counter() - inicio
+        await gateway.fechar()
+        print(f"{nome:<28} {cliente.chamadas:>8} chamadas à Efí  {segundos:8.3f} s")
+        if usar_cache:
+            print(f"    {gateway.cache.resumo()}")
+
+
+# -----------------------------------------------------------------------------
+# 📊 CUSTO DAS MÉTRICAS
+# -----------------------------------------------------------------------------
+def _bench_metricas(observacoes: int):
+    metricas = bot.Metricas()
+    rotulos = (("endpoint", "pix_detail_charge"),)
+
+    inicio = time.perf_counter()
+    for i in range(observacoes):
+        metricas.incrementar("bot_funil_total", (("etapa", "start"),))
+    _relatorio("incrementar", observacoes, time.perf_counter() - inicio)
+
+    inicio = time.perf_counter()
+    for i in range(observacoes):
+        metricas.observar("efi_chamada_segundos", rotulos, 0.0123)
+    _relatorio("observar", observacoes, time.perf_counter() - inicio)
+
+    inicio = time.perf_counter()
+    for i in range(observacoes):
+        with metricas.medir("efi_chamada", rotulos):
+            pass
+    _relatorio("medir (with)", observacoes, time.perf_counter() - inicio)
+
+    async def handler(update, context):
+        pass
+    medido = bot.instrumentar(handler)
+
+    async def chamar_handlers():
+        for i in range(observacoes):
+            await medido(None, None)
+    inicio = time.perf_counter()
+    asyncio.run(chamar_handlers())
+    _relatorio("handler instrumentado", observacoes, time.perf_counter() - inicio)
+
+    for i in range(200):
+        metricas.observar("sqlite_leitura_segundos", (("operacao", f"op{i}"),), 0.001)
+    inicio = time.perf_counter()
+    texto = metricas.exportar()
+    _relatorio("exportar", 1, time.perf_counter() - inicio)
+    print(f"    {texto.count(chr(10))} linhas, {len(texto)} bytes")
+
+
+# -----------------------------------------------------------------------------
+# 📣 TRANSMISSÃO EM MASSA COM REINÍCIO NO MEIO
+# -----------------------------------------------------------------------------
+class BotFalso:
+    """
+    Imita Bot.send_message: 2% dos usuários bloquearam o bot, 0,5% dos chats não
+    existem e o primeiro envio depois de `retry_apos` mensagens recebe RetryAfter.
+    """
+    def __init__(self, latencia: float, retry_apos: int):
+        self.latencia = latencia
+        self.retry_apos = retry_apos
+        self.recebidas = collections.Counter()
+        self.chamadas = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.chamadas += 1
+        await asyncio.sleep(self.latencia)
+        if self.chamadas == self.retry_apos:
+            raise RetryAfter(1)
+        if chat_id % 50 == 0:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        if chat_id % 200 == 7:
+            raise BadRequest("Chat not found")
+        self.recebidas[chat_id] += 1
+
+
+async def _bench_transmissao(destinatarios: int, taxa: float, latencia: float):
+    with tempfile.TemporaryDirectory() as diretorio:
+        db_file = _banco_temporario(diretorio)
+        with sqlite3.connect(db_file) as conn:
+            conn.executemany(
+                "INSERT INTO assinaturas (user_id, tipo_plano, txid, inicio, expira_em, status) VALUES (?, 'mensal', ?, 0, ?, 'ativa')",
+                ((user_id, f"tx{user_id}", 2**31) for user_id in range(1, destinatarios + 1))
+            )
+        bot.repositorio = bot.RepositorioPagamentos(db_file)
+        await bot.repositorio.abrir()
+        bot_falso = BotFalso(latencia, retry_apos=destinatarios // 4)
+        tracemalloc.start()
+
+        # Primeira execução: interrompida (como num desligamento) no meio do caminho.
+        transmissor = bot.Transmissor(taxa=taxa)
+        transmissao_id = await bot.repositorio.criar_transmissao(1, "assinantes", "Promoção de renovação!")
+        inicio = time.perf_counter()
+        transmissor.iniciar(bot_falso, {'id': transmissao_id, 'admin_id': 1, 'publico': 'assinantes', 'texto': "Promoção de renovação!",
+                                        'ultimo_user_id': 0, 'enviados': 0, 'bloqueados': 0, 'falhas': 0})
+        while bot_falso.chamadas < destinatarios // 2:
+            await asyncio.sleep(0.05)
+        await transmissor.parar()
+
+        # Segunda execução: um Transmissor novo retoma a partir do banco.
+        transmissor = bot.Transmissor(taxa=taxa)
+        await transmissor.retomar(bot_falso)
+        while transmissor.em_andamento():
+            await asyncio.sleep(0.05)
+        segundos = time.perf_counter() - inicio
+        _, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        await bot.repositorio.fechar()
+
+        with sqlite3.connect(db_file) as conn:
+            status, enviados, bloqueados, falhas = conn.execute(
+                "SELECT status, enviados, bloqueados, falhas FROM transmissoes WHERE id = ?", (transmissao_id,)).fetchone()
+        esperados = sum(1 for u in range(1, destinatarios + 1) if u % 50 and u % 200 != 7)
+        repetidos = sum(n - 1 for n in bot_falso.recebidas.values())
+        _relatorio("transmissão (com reinício)", bot_falso.chamadas, segundos)
+        print(f"    status: {status}; enviados: {enviados}; bloqueados: {bloqueados}; falhas: {falhas}")
+        print(f"    destinatários alcançados: {len(bot_falso.recebidas)} de {esperados}; repetidos após o reinício: {repetidos} "
+              f"(limite: {bot.TRANSMISSAO_SIMULTANEAS} no desligamento, {2 * bot.TRANSMISSAO_SIMULTANEAS - 1} numa queda)")
+        print(f"    pico de memória alocada: {pico / 1e6:.1f} MB")
+
+
+# -----------------------------------------------------------------------------
+# 🎟️ LINKS DE CONVITE: CRIADOS NA HORA vs. POOL
+# -----------------------------------------------------------------------------
+class BotConvitesFalso:
+    """
+    Imita create_chat_invite_link: cada chamada leva `latencia` e, como no Telegram,
+    rajadas (mais de 5 criações em 1 s) recebem RetryAfter.
+    """
+    def __init__(self, latencia: float):
+        self.latencia = latencia
+        self.criados = 0
+        self.revogados = 0
+        self._recentes = collections.deque()
+
+    async def create_chat_invite_link(self, chat_id, member_limit, expire_date):
+        agora = time.monotonic()
+        while self._recentes and agora - self._recentes[0] > 1:
+            self._recentes.popleft()
+        if len(self._recentes) >= 5:
+            raise RetryAfter(1)
+        self._recentes.append(agora)
+        await asyncio.sleep(self.latencia)
+        self.criados += 1
+        return type("Convite", (), {"invite_link": f"https://t.me/+falso{self.criados}"})()
+
+    async def revoke_chat_invite_link(self, chat_id, invite_link):
+        await asyncio.sleep(self.latencia)
+        self.revogados += 1
+
+
+def _percentil(valores: list, p: float) -> float:
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p))]
+
+
+async def _bench_convites(aprovacoes: int, profundidade: int, latencia: float):
+    """`aprovacoes` pagamentos confirmados ao mesmo tempo (ex.: o reconciliador aprovando um lote)."""
+    for nome, tamanho in (("sob demanda", 0), (f"pool ({profundidade})", profundidade)):
+        bot_falso = BotConvitesFalso(latencia)
+        pool = bot.PoolConvites(tamanho, intervalo_criacao=0.25)
+        pool.iniciar(bot_falso)
+        while len(pool) < tamanho:
+            await asyncio.sleep(0.05)
+
+        latencias, erros = [], 0
+
+        async def aprovar():
+            nonlocal erros
+            inicio = time.perf_counter()
+            try:
+                await pool.obter(bot_falso)
+                latencias.append(time.perf_counter() - inicio)
+            except RetryAfter:
+                erros += 1
+
+        await asyncio.gather(*(aprovar() for _ in range(aprovacoes)))
+        await pool.parar()
+        print(f"{nome:<28} {len(latencias):>5} link(s) entregues, {erros:>3} aprovação(ões) sem link  "
+              f"p50 {_percentil(latencias, 0.5) * 1e3:7.2f} ms  p99 {_percentil(latencias, 0.99) * 1e3:7.2f} ms  "
+              f"revogados ao encerrar: {bot_falso.revogados}")
+
+
+# -----------------------------------------------------------------------------
+# 👤 MEMÓRIA POR SESSÃO: DICT vs. SessaoUsuario
+# -----------------------------------------------------------------------------
+def _medir_memoria(criar, usuarios: int) -> int:
+    tracemalloc.start()
+    antes, _ = tracemalloc.get_traced_memory()
+    sessoes = {user_id: criar(user_id) for user_id in range(usuarios)}
+    depois, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del sessoes
+    return depois - antes
+
+
+def _bench_sessoes(usuarios: int):
+    def sessao_dict(user_id):
+        return {'last_activity_time': datetime.now(), 'plano_escolhido': {'tipo': 'mensal', 'valor': str(19.90 + user_id % 7)},
+                'pix_message_id': 100000 + user_id}
+
+    def sessao_compacta(user_id):
+        sessao = bot.SessaoUsuario()
+        sessao.registrar_atividade()
+        sessao.escolher_plano(bot.Plano.MENSAL)
+        sessao.pix_message_id = 100000 + user_id
+        return sessao
+
+    for nome, criar in (("dict (antes)", sessao_dict), ("SessaoUsuario", sessao_compacta)):
+        total = _medir_memoria(criar, usuarios)
+        print(f"{nome:<28} {usuarios:>8} usuários  {total / 1e6:8.1f} MB  {total / usuarios:8.0f} bytes/usuário")
+
+
+# -----------------------------------------------------------------------------
+# 🎨 RENDERIZAÇÃO DAS TELAS: CPU POR ATUALIZAÇÃO
+# -----------------------------------------------------------------------------
+def _montar_na_hora(nome: str):
+    """Monta a tela como os handlers faziam antes das telas pré-montadas."""
+    if nome == "start":
+        texto = (f"Oi, {nome}! 👋\n\n"
+                 "Você tá entrando num espaço feito só pra quem curte exclusividade.\n\n"
+                 "Aqui eu compartilho conteúdo que não vai pra lugar nenhum além desse canal.\n\n"
+                 "Clica aí e vem fazer parte disso.")
+        teclado = InlineKeyboardMarkup([[InlineKeyboardButton("✨ Quero Acesso Exclusivo", callback_data="mostrar_planos")],
+                                        [InlineKeyboardButton("📞 Preciso de Ajuda", url=bot.LINK_SUPORTE)]])
+    elif nome == "mostrar_planos":
+        texto = ("✨ *Acesso ao Conteúdo Exclusivo*\n\n"
+                 "Para ter acesso a todo o conteúdo, escolha um dos planos abaixo e faça parte do nosso canal privado:")
+        teclado = InlineKeyboardMarkup([[InlineKeyboardButton(f"🌙 Acesso Mensal - R$ {bot.PRECO_MENSAL}", callback_data="plano_mensal")],
+                                        [InlineKeyboardButton(f"🌟 Acesso Trimestral - R$ {bot.PRECO_TRIMESTRAL}", callback_data="plano_trimestral")],
+                                        [InlineKeyboardButton("⬅️ Voltar", callback_data="start")]])
+    elif nome == "mostrar_termos":
+        texto = ("⚠️ *Quase lá... Leia os Termos*\n\n"
+                 "Antes de prosseguir, é importante que você leia e concorde com os nossos termos de uso. "
+                 "Isso garante que tudo fique claro entre a gente.\n\n"
+                 "Ao clicar em 'Aceito', você confirma que leu e está de acordo.")
+        teclado = InlineKeyboardMarkup([[InlineKeyboardButton("Ler Termos de Uso", url=bot.TERMS_URL)],
+                                        [InlineKeyboardButton("✅ Li e aceito os Termos", callback_data="aceitar_termos")],
+                                        [InlineKeyboardButton("⬅️ Voltar", callback_data="mostrar_planos")]])
+    else:
+        texto = datetime.now(pytz.timezone('America/Sao_Paulo')).strftime('%d/%m/%Y às %H:%M:%S')
+        teclado = None
+    return texto, teclado
+
+
+def _montar_pre_montado(nome: str):
+    if nome == "start":
+        return bot.TEXTO_BOAS_VINDAS.format(nome=nome), bot.TECLADO_INICIO
+    if nome == "mostrar_planos":
+        return bot.TEXTO_PLANOS, bot.TECLADO_PLANOS
+    if nome == "mostrar_termos":
+        return bot.TEXTO_TERMOS, bot.TECLADO_TERMOS
+    return bot.formatar_data_brasilia(formato='%d/%m/%Y às %H:%M:%S'), None
+
+
+async def _bench_renderizacao(atualizacoes: int):
+    """
+    Mede o tempo de CPU (time.process_time) por atualização em duas camadas: só a
+    montagem de texto + teclado (antes vs. pré-montado) e o handler completo
+    chamado direto, com a Bot API falsa sem latência, incluindo a serialização
+    da requisição pelo python-telegram-bot.
+    """
+    telas = ("start", "mostrar_planos", "mostrar_termos", "data_brasilia")
+    for tela in telas:
+        for nome, montar in (("montar na hora", _montar_na_hora), ("pré-montado", _montar_pre_montado)):
+            inicio = time.process_time()
+            for _ in range(atualizacoes):
+                montar(tela)
+            cpu = time.process_time() - inicio
+            print(f"{tela:<16} {nome:<16} {cpu / atualizacoes * 1e6:8.2f} µs de CPU por montagem")
+
+    bot.metricas = bot.Metricas()
+    app = (Application.builder().token("1:falso").request(RequisicaoFalsa(0))
+           .context_types(ContextTypes(user_data=bot.SessaoUsuario)).updater(None).build())
+    await app.initialize()
+    handlers = ((bot.start, "start"), (bot.mostrar_planos, "mostrar_planos"), (bot.mostrar_termos, "plano_mensal"))
+    for handler, dados in handlers:
+        updates = [_clique_sintetico(app.bot, i, 1 + i % 1000, dados) for i in range(atualizacoes)]
+        inicio = time.process_time()
+        for update in updates:
+            await handler(update, CallbackContext.from_update(update, app))
+        cpu = time.process_time() - inicio
+        print(f"handler {handler.__name__:<22} {cpu / atualizacoes * 1e6:8.1f} µs de CPU por atualização")
+    await app.shutdown()
+
+
+# -----------------------------------------------------------------------------
+# 📈 RELATÓRIO DE VENDAS: AGREGADOS INCREMENTAIS vs. SQL SOBRE `pagamentos`
+# -----------------------------------------------------------------------------
+CONSULTA_AD_HOC = (
+    "SELECT tipo_plano, COUNT(*), SUM(status = 'aprovado'), "
+    "SUM(CASE WHEN status = 'aprovado' THEN valor_centavos ELSE 0 END) "
+    "FROM pagamentos WHERE data_criacao >= ? GROUP BY tipo_plano"
+)
+
+
+def _gerar_pagamentos(cursor, linhas: int, inicio_id: int = 0, periodo: int = 365 * 86400):
+    agora = int(time.time())
+    status = ['cancelada'] * 5 + ['expirada'] + ['aprovado'] * 3 + ['pendente']
+
+    def linha(i):
+        criacao = agora - random.randrange(periodo)
+        situacao = random.choice(status)
+        aprovacao = criacao + random.randrange(30, 1800) if situacao == 'aprovado' else None
+        plano, valor = random.choice((('mensal', 1990), ('trimestral', 4990)))
+        return (f"tx{i}", random.randrange(linhas // 3 + 1), "u", situacao, criacao, aprovacao, plano, valor)
+
+    cursor.executemany(
+        "INSERT INTO pagamentos (txid, user_id, username, status, data_criacao, data_aprovacao, tipo_plano, valor_centavos) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (linha(i) for i in range(inicio_id, inicio_id + linhas))
+    )
+
+
+async def _bench_relatorio(linhas: int, dias: int):
+    """
+    Com `linhas` pagamentos espalhados por um ano: tempo da migração que preenche
+    vendas_diarias, custo dos triggers nas escritas quentes, /relatorio pelos
+    agregados vs. a consulta ad hoc equivalente e a exportação CSV (tempo e pico
+    de memória).
+    """
+    with tempfile.TemporaryDirectory() as diretorio:
+        bot.DB_FILE = os.path.join(diretorio, "pagamentos.db")
+        bot.aplicar_migracoes(ate=7)
+        conn = sqlite3.connect(bot.DB_FILE)
+        inicio = time.perf_counter()
+        _gerar_pagamentos(conn, linhas)
+        conn.commit()
+        print(f"{linhas} pagamentos gerados em {time.perf_counter() - inicio:.1f}s")
+
+        # Escritas quentes (nova cobrança + aprovação) sem e com os triggers.
+        escritas = 20_000
+        for rotulo in ("sem triggers", "com triggers"):
+            if rotulo == "com triggers":
+                conn.close()
+                inicio = time.perf_counter()
+                bot.aplicar_migracoes()
+                print(f"Migração 8 (preenche vendas_diarias) em {time.perf_counter() - inicio:.1f}s")
+                conn = sqlite3.connect(bot.DB_FILE)
+            base = linhas + (escritas if rotulo == "com triggers" else 0)
+            inicio = time.perf_counter()
+            for i in range(base, base + escritas):
+                conn.execute("INSERT INTO pagamentos (txid, user_id, username, status, tipo_plano, valor_centavos) "
+                             "VALUES (?, ?, 'u', 'pendente', 'mensal', 1990)", (f"tx{i}", i))
+                conn.execute("UPDATE pagamentos SET status = 'aprovado', data_aprovacao = ? WHERE txid = ? AND status != 'aprovado'",
+                             (int(time.time()), f"tx{i}"))
+            conn.commit()
+            _relatorio(f"cobrança + aprovação ({rotulo})", escritas, time.perf_counter() - inicio)
+
+        desde = int(time.time()) - dias * 86400
+        inicio = time.perf_counter()
+        for _ in range(5):
+            conn.execute(CONSULTA_AD_HOC, (desde,)).fetchall()
+        print(f"SQL ad hoc sobre pagamentos ({dias} dias):    {(time.perf_counter() - inicio) / 5 * 1e3:9.2f} ms")
+        conn.close()
+
+        bot.repositorio = bot.RepositorioPagamentos(bot.DB_FILE)
+        await bot.repositorio.abrir()
+        await bot.montar_relatorio(dias)
+        inicio = time.perf_counter()
+        for _ in range(50):
+            texto = await bot.montar_relatorio(dias)
+        print(f"/relatorio pelos agregados ({dias} dias):     {(time.perf_counter() - inicio) / 50 * 1e3:9.2f} ms")
+        inicio = time.perf_counter()
+        await bot.montar_relatorio(365)
+        print(f"/relatorio pelos agregados (365 dias):      {(time.perf_counter() - inicio) * 1e3:9.2f} ms")
+        print(texto.split("\n\n")[1] if "\n\n" in texto else texto)
+
+        # Primeiro o tempo; depois, em outra passada, o pico de memória (o tracemalloc deixa tudo mais lento).
+        for medir_memoria in (False, True):
+            if medir_memoria:
+                tracemalloc.start()
+            inicio = time.perf_counter()
+            with tempfile.TemporaryFile() as arquivo:
+                total = await bot.exportar_csv_pagamentos(arquivo, 0)
+                tamanho = arquivo.tell()
+            if medir_memoria:
+                _, pico = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                print(f"CSV: pico de memória {pico / 1e6:.1f} MB")
+            else:
+                print(f"CSV: {total} linhas, {tamanho / 1e6:.1f} MB compactados em {time.perf_counter() - inicio:.1f}s")
+        await bot.repositorio.fechar()
+
+
+# -----------------------------------------------------------------------------
+# 🧩 MODO MULTIPROCESSO: VAZÃO POR NÚMERO DE WORKERS
+# -----------------------------------------------------------------------------
+def _aplicacao_worker_bench(db_file: str, esperadas: list, fila, latencia: float):
+    """
+    Fábrica da Application de cada worker no benchmark: handlers reais do funil,
+    banco compartilhado, Bot API e Efí falsas. Avisa `fila` quando o worker processa
+    todas as atualizações que o front vai mandar para ele.
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.DB_FILE = db_file
+    bot.repositorio = bot.RepositorioPagamentos(db_file)
+    bot.gateway = GatewayFalso(latencia)
+
+    async def iniciar(application):
+        await bot.repositorio.abrir()
+        bot.despachante.iniciar(application.bot)
+
+    async def parar(application):
+        await bot.despachante.parar()
+
+    async def encerrar(application):
+        await bot.repositorio.fechar()
+
+    app = (Application.builder().token("1:falso").request(RequisicaoFalsa(latencia))
+           .context_types(ContextTypes(user_data=bot.SessaoUsuario))
+           .concurrent_updates(bot.ProcessadorPorUsuario(bot.ATUALIZACOES_SIMULTANEAS)).updater(None)
+           .post_init(iniciar).post_stop(parar).post_shutdown(encerrar).build())
+    app.add_handler(CallbackQueryHandler(bot.start, pattern="^start$"))
+    app.add_handler(CallbackQueryHandler(bot.mostrar_termos, pattern=r"^plano_"))
+    app.add_handler(CallbackQueryHandler(bot.aceitar_termos, pattern="^aceitar_termos$"))
+    app.add_handler(CallbackQueryHandler(bot.verificar, pattern="^verificar$"))
+    processadas = 0
+
+    async def contar(update, context):
+        nonlocal processadas
+        processadas += 1
+        if processadas == esperadas[bot.WORKER_INDICE]:
+            fila.put(bot.WORKER_INDICE)
+
+    app.add_handler(TypeHandler(Update, contar), group=1)
+    return app
+
+
+def _corpo_clique(update_id: int, user_id: int, dados: str) -> bytes:
+    usuario = {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}
+    mensagem = {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "from": usuario}
+    consulta = {"id": str(update_id), "from": usuario, "chat_instance": str(user_id), "message": mensagem, "data": dados}
+    return json.dumps({"update_id": update_id, "callback_query": consulta}).encode()
+
+
+async def _bench_multiprocesso(usuarios: int, workers: list, latencia: float):
+    """
+    Cada usuário percorre o funil (início, plano, aceite dos termos com criação da
+    cobrança, "Já paguei"). O benchmark faz o papel do front: usa o RoteadorAtualizacoes
+    para repassar as atualizações aos workers (processos separados, banco compartilhado)
+    e mede do primeiro envio até todos os workers terminarem.
+    """
+    etapas = ("start", "plano_mensal", "aceitar_termos", "verificar")
+    print(f"CPUs disponíveis: {os.cpu_count()}")
+    for total in workers:
+        with tempfile.TemporaryDirectory() as diretorio:
+            db_file = _banco_temporario(diretorio)
+            esperadas = [0] * total
+            for user_id in range(1, usuarios + 1):
+                esperadas[bot.worker_do_usuario(user_id, total)] += len(etapas)
+            fila = multiprocessing.get_context("spawn").Queue()
+            fabrica = functools.partial(_aplicacao_worker_bench, db_file, esperadas, fila, latencia)
+            processos = [bot.iniciar_processo_worker(indice, total, fabrica) for indice in range(total)]
+            roteador = bot.RoteadorAtualizacoes(total)
+            await roteador.conectar()
+
+            corpos = [_corpo_clique(passo * usuarios + user_id, user_id, dados)
+                      for passo, dados in enumerate(etapas) for user_id in range(1, usuarios + 1)]
+            loop = asyncio.get_running_loop()
+            inicio = time.perf_counter()
+            for corpo in corpos:
+                await roteador.encaminhar(corpo)
+            for _ in range(total):
+                await loop.run_in_executor(None, fila.get)
+            segundos = time.perf_counter() - inicio
+
+            await roteador.fechar()
+            for processo in processos:
+                processo.terminate()
+            for processo in processos:
+                await loop.run_in_executor(None, processo.join)
+            with sqlite3.connect(db_file) as conn:
+                pendentes = conn.execute("SELECT COUNT(*) FROM pagamentos WHERE status = 'pendente'").fetchone()[0]
+                notificacoes = conn.execute("SELECT COUNT(*) FROM notificacoes").fetchone()[0]
+            _relatorio(f"{total} worker(s)", len(corpos), segundos)
+            print(f"    por worker: {roteador.encaminhadas}; cobranças pendentes: {pendentes}/{usuarios}; "
+                  f"notificações ainda no outbox: {notificacoes}")
+
+
+# -----------------------------------------------------------------------------
+# 🧪 TESTE DE CARGA DE PONTA A PONTA
+# -----------------------------------------------------------------------------
+class EfiFalsa:
+    """
+    Servidor HTTP que imita as rotas da API PIX da Efí usadas pelo bot: token OAuth,
+    criação de cobrança, QR Code, detalhe e listagem. O bot fala com ele pelo SDK
+    `efipay` de verdade (apontando `Constants.APIS['PIX']['URL']` para cá).
+
+    Cada rota espera `latencia` segundos e, com probabilidade `erros`, responde 500
+    com um JSON de erro, como a Efí faz em instabilidades.
+    """
+
+    def __init__(self, latencia: float, erros: float, semente: int):
+        self.latencia = latencia
+        self.erros = erros
+        self._aleatorio = random.Random(semente)
+        self.cobrancas = {}           # txid -> cobrança
+        self._por_copia_cola = {}     # pixCopiaECola -> txid
+        self._por_loc = {}            # loc.id -> txid
+        self.chamadas = collections.Counter()
+        self.falhas = collections.Counter()
+        self.conexoes = set()         # (host, porta) do cliente: uma entrada por conexão TCP aberta
+        self.tokens = set()           # tokens OAuth válidos; `invalidar_tokens()` simula a expiração
+        self.url = ""
+        self._runner = None
+
+    async def iniciar(self, contexto_ssl=None):
+        app = web.Application()
+        app.router.add_post("/oauth/token", self._rota("authorize", self._token))
+        app.router.add_post("/v2/cob", self._rota("pix_create_immediate_charge", self._criar))
+        app.router.add_get("/v2/loc/{id}/qrcode", self._rota("pix_generate_qrcode", self._qrcode))
+        app.router.add_get("/v2/cob/{txid}", self._rota("pix_detail_charge", self._detalhar))
+        app.router.add_get("/v2/cob", self._rota("pix_list_charges", self._listar))
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0, ssl_context=contexto_ssl)
+        await site.start()
+        host, porta = self._runner.addresses[0][:2]
+        self.url = f"{'https' if contexto_ssl else 'http'}://{host}:{porta}"
+
+    async def parar(self):
+        await self._runner.cleanup()
+
+    def _rota(self, endpoint: str, tratar):
+        async def rota(request: web.Request) -> web.Response:
+            self.chamadas[endpoint] += 1
+            self.conexoes.add(request.transport.get_extra_info("peername"))
+            await asyncio.sleep(self.latencia)
+            if endpoint != "authorize" and request.headers.get("Authorization", "").removeprefix("Bearer ") not in self.tokens:
+                return web.json_response({"nome": "nao_autorizado", "mensagem": "Token inválido ou expirado"}, status=401)
+            if endpoint != "authorize" and self._aleatorio.random() < self.erros:
+                self.falhas[endpoint] += 1
+                return web.json_response({"nome": "erro_interno", "mensagem": "Falha injetada pelo teste de carga"}, status=500)
+            return await tratar(request)
+        return rota
+
+    @staticmethod
+    def _iso(timestamp: float) -> str:
+        return datetime.fromtimestamp(timestamp, pytz.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    def _publica(self, cobranca: dict) -> dict:
+        return {
+            "calendario": {"criacao": self._iso(cobranca["criacao"]), "expiracao": cobranca["expiracao"]},
+            "txid": cobranca["txid"], "revisao": 0, "status": cobranca["status"],
+            "loc": {"id": cobranca["loc"], "location": f"pix-falsa.local/qr/v2/{cobranca['txid']}", "tipoCob": "cob"},
+            "valor": {"original": cobranca["valor"]}, "chave": cobranca["chave"],
+            "pixCopiaECola": cobranca["pixCopiaECola"],
+        }
+
+    async def _token(self, request: web.Request) -> web.Response:
+        token = f"token-falso-{self.chamadas['authorize']}"
+        self.tokens.add(token)
+        return web.json_response({"access_token": token, "token_type": "Bearer", "expires_in": 3600, "scope": "cob.read cob.write"})
+
+    async def _criar(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        loc = len(self.cobrancas) + 1
+        txid = f"carga{loc:027d}"
+        cobranca = {
+            "txid": txid, "loc": loc, "status": "ATIVA", "criacao": time.time(),
+            "expiracao": body["calendario"]["expiracao"], "valor": body["valor"]["original"], "chave": body["chave"],
+            "pixCopiaECola": f"00020101021226830014BR.GOV.BCB.PIX2561pix-falsa.local/qr/v2/{txid}5204000053039865802BR6304CAFE",
+        }
+        self.cobrancas[txid] = cobranca
+        self._por_copia_cola[cobranca["pixCopiaECola"]] = txid
+        self._por_loc[loc] = txid
+        return web.json_response(self._publica(cobranca), status=201)
+
+    async def _qrcode(self, request: web.Request) -> web.Response:
+        txid = self._por_loc.get(int(request.match_info["id"]))
+        if txid is None:
+            return web.json_response({"nome": "location_nao_encontrada", "mensagem": "Location não encontrada"}, status=404)
+        copia_cola = self.cobrancas[txid]["pixCopiaECola"]
+        return web.json_response({"qrcode": copia_cola, "imagemQrcode": "data:image/png;base64,", "linkVisualizacao": ""})
+
+    async def _detalhar(self, request: web.Request) -> web.Response:
+        cobranca = self.cobrancas.get(request.match_info["txid"])
+        if cobranca is None:
+            return web.json_response({"nome": "cobranca_nao_encontrada", "mensagem": "Cobrança não encontrada"}, status=404)
+        return web.json_response(self._publica(cobranca))
+
+    async def _listar(self, request: web.Request) -> web.Response:
+        def epoch(texto):
+            return datetime.strptime(texto, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=pytz.utc).timestamp()
+
+        inicio, fim = epoch(request.query["inicio"]), epoch(request.query["fim"])
+        pagina = int(request.query.get("paginacao.paginaAtual", 0))
+        por_pagina = int(request.query.get("paginacao.itensPorPagina", 100))
+        cobs = [c for c in self.cobrancas.values() if inicio <= c["criacao"] <= fim]
+        paginas = max(1, -(-len(cobs) // por_pagina))
+        return web.json_response({
+            "parametros": {"inicio": request.query["inicio"], "fim": request.query["fim"], "paginacao": {
+                "paginaAtual": pagina, "itensPorPagina": por_pagina,
+                "quantidadeDePaginas": paginas, "quantidadeTotalDeItens": len(cobs)}},
+            "cobs": [self._publica(c) for c in cobs[pagina * por_pagina:(pagina + 1) * por_pagina]],
+        })
+
+    def invalidar_tokens(self):
+        self.tokens.clear()
+
+    def pagar(self, copia_cola: str) -> bool:
+        """Simula o pagamento do PIX pelo usuário: a cobrança passa a CONCLUIDA."""
+        txid = self._por_copia_cola.get(copia_cola)
+        if txid is None:
+            return False
+        self.cobrancas[txid]["status"] = "CONCLUIDA"
+        return True
+
+
+class BotApiFalsa:
+    """
+    Servidor HTTP que imita a Bot API do Telegram para o HTTPXRequest do bot:
+    getUpdates (long polling de verdade, com offset e timeout), sendMessage,
+    editMessageText, createChatInviteLink e o resto respondendo `true`.
+
+    As mensagens que o bot envia ou edita no chat de um usuário virtual são
+    entregues na fila dele (`registrar`), para o roteiro saber quando a etapa terminou.
+    """
+    BOT = {"id": 100, "is_bot": True, "first_name": "Solerte", "username": "solerte_carga_bot",
+           "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+    def __init__(self, latencia: float):
+        self.latencia = latencia
+        self.chamadas = collections.Counter()
+        self.url = ""
+        self._atualizacoes = collections.deque()
+        self._nova_atualizacao = asyncio.Event()
+        self._proximo_update_id = 1
+        self._proxima_mensagem = 1
+        self._filas = {}              # chat_id -> asyncio.Queue de (message_id, texto)
+        self._runner = None
+
+    async def iniciar(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{metodo}", self._tratar)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, porta = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{porta}"
+
+    async def parar(self):
+        await self._runner.cleanup()
+
+    def registrar(self, chat_id: int) -> asyncio.Queue:
+        fila = self._filas[chat_id] = asyncio.Queue()
+        return fila
+
+    def enviar(self, tipo: str, dados: dict):
+        """Coloca uma atualização (`message`, `callback_query`...) na fila do getUpdates."""
+        self._atualizacoes.append({"update_id": self._proximo_update_id, tipo: dados})
+        self._proximo_update_id += 1
+        self._nova_atualizacao.set()
+
+    async def _tratar(self, request: web.Request) -> web.Response:
+        metodo = request.match_info["metodo"]
+        self.chamadas[metodo] += 1
+        parametros = await request.post()
+        if metodo == "getUpdates":
+            resultado = await self._get_updates(parametros)
+        else:
+            await asyncio.sleep(self.latencia)
+            resultado = self._responder(metodo, parametros)
+        return web.json_response({"ok": True, "result": resultado})
+
+    async def _get_updates(self, parametros) -> list:
+        offset = int(parametros.get("offset", 0))
+        while self._atualizacoes and self._atualizacoes[0]["update_id"] < offset:
+            self._atualizacoes.popleft()
+        if not self._atualizacoes:
+            self._nova_atualizacao.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._nova_atualizacao.wait(), float(parametros.get("timeout", 0)))
+        return list(itertools.islice(self._atualizacoes, int(parametros.get("limit", 100))))
+
+    def _mensagem(self, chat_id: int, message_id: int, texto: str) -> dict:
+        fila = self._filas.get(chat_id)
+        if fila is not None:
+            fila.put_nowait((message_id, texto))
+        return {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                "from": self.BOT, "text": texto}
+
+    def _responder(self, metodo: str, parametros):
+        if metodo == "getMe":
+            return self.BOT
+        if metodo == "sendMessage":
+            self._proxima_mensagem += 1
+            return self._mensagem(int(parametros["chat_id"]), self._proxima_mensagem, parametros["text"])
+        if metodo == "editMessageText":
+            return self._mensagem(int(parametros["chat_id"]), int(parametros["message_id"]), parametros["text"])
+        if metodo in ("createChatInviteLink", "revokeChatInviteLink"):
+            link = parametros.get("invite_link") or f"https://t.me/+carga{self.chamadas[metodo]:010d}"
+            return {"invite_link": link, "creator": self.BOT, "creates_join_request": False, "is_primary": False,
+                    "is_revoked": metodo == "revokeChatInviteLink", "member_limit": 1,
+                    "expire_date": int(parametros.get("expire_date", time.time() + 3600))}
+        return True
+
+
+# Cada etapa do roteiro: (nome, callback_data ou None para o /start, sucesso, falha).
+# Mensagens do bot que não casam com nenhum dos dois (ex.: "⏳ Preparando...") são ignoradas.
+ROTEIRO_CARGA = (
+    ("start", None, lambda t: t.startswith("Oi,"), lambda t: False),
+    ("mostrar_planos", "mostrar_planos", lambda t: "Acesso ao Conteúdo Exclusivo" in t, lambda t: False),
+    ("plano", "plano_{plano}", lambda t: "Quase lá" in t, lambda t: "Plano inválido" in t),
+    ("aceitar_termos", "aceitar_termos", lambda t: t.startswith("<pre><code>"), lambda t: "Algo deu errado" in t),
+    ("verificar", "verificar", lambda t: "Pagamento confirmado" in t or "já foi confirmado" in t or "Pagamento Pendente" in t,
+     lambda t: "erro interno" in t or "problema ao gerar seu link" in t),
+)
+
+
+class UsuarioVirtual:
+    """Percorre o funil como uma pessoa: envia a atualização e espera a resposta do bot antes da próxima."""
+
+    def __init__(self, user_id: int, api: BotApiFalsa, efi: EfiFalsa, aleatorio: random.Random,
+                 conversao: float, pensar: float, tempo_maximo: float):
+        self.user_id = user_id
+        self.api = api
+        self.efi = efi
+        self.plano = aleatorio.choice(("mensal", "trimestral"))
+        self.pagar = aleatorio.random() < conversao
+        self.pausas = [aleatorio.uniform(0, 2 * pensar) for _ in ROTEIRO_CARGA]
+        self.tempo_maximo = tempo_maximo
+        self.usuario = {"id": user_id, "is_bot": False, "first_name": f"Carga{user_id}", "username": f"carga{user_id}"}
+        self.fila = api.registrar(user_id)
+        self.message_id = None
+        self.resultado = "abandonou"
+
+    def _enviar(self, dados: str | None):
+        agora = int(time.time())
+        chat = {"id": self.user_id, "type": "private", "first_name": self.usuario["first_name"]}
+        if dados is None:
+            self.api.enviar("message", {"message_id": 1, "date": agora, "chat": chat, "from": self.usuario, "text": "/start",
+                                        "entities": [{"type": "bot_command", "offset": 0, "length": 6}]})
+            return
+        mensagem = {"message_id": self.message_id, "date": agora, "chat": chat, "from": BotApiFalsa.BOT, "text": "..."}
+        self.api.enviar("callback_query", {"id": f"{self.user_id}-{dados}", "from": self.usuario,
+                                           "chat_instance": str(self.user_id), "message": mensagem, "data": dados})
+
+    async def _esperar(self, sucesso, falha) -> tuple[bool, int, str]:
+        async with asyncio.timeout(self.tempo_maximo):
+            while True:
+                message_id, texto = await self.fila.get()
+                if sucesso(texto):
+                    return True, message_id, texto
+                if falha(texto):
+                    return False, message_id, texto
+
+    async def executar(self, amostras: dict, falhas: collections.Counter):
+        for (etapa, dados, sucesso, falha), pausa in zip(ROTEIRO_CARGA, self.pausas):
+            await asyncio.sleep(pausa)
+            inicio = time.perf_counter()
+            self._enviar(dados.format(plano=self.plano) if dados else None)
+            try:
+                ok, message_id, texto = await self._esperar(sucesso, falha)
+            except TimeoutError:
+                ok, texto = False, ""
+            if not ok:
+                falhas[etapa] += 1
+                return
+            amostras[etapa].append(time.perf_counter() - inicio)
+            if etapa == "start":
+                self.message_id = message_id
+            elif etapa == "aceitar_termos":
+                if self.pagar:
+                    self.efi.pagar(html.unescape(texto[len("<pre><code>"):-len("</code></pre>")]))
+            elif etapa == "verificar":
+                self.resultado = "pendente" if "Pendente" in texto else "venda"
+
+
+def _resumir_carga(amostras: dict, falhas: collections.Counter, resultados: collections.Counter, duracao: float,
+                   atualizacoes: int, efi: EfiFalsa, api: BotApiFalsa, parametros: dict) -> dict:
+    etapas = {}
+    for etapa, *_ in ROTEIRO_CARGA:
+        valores = amostras[etapa]
+        etapas[etapa] = {
+            "amostras": len(valores), "falhas": falhas[etapa],
+            "p50_ms": round(_percentil(valores, 0.5) * 1e3, 2) if valores else None,
+            "p99_ms": round(_percentil(valores, 0.99) * 1e3, 2) if valores else None,
+        }
+    vendas = resultados["venda"]
+    chamadas_efi = sum(n for endpoint, n in efi.chamadas.items() if endpoint != "authorize")
+    banco = {}
+    for nome in ("sqlite_leitura_segundos", "sqlite_escrita_segundos", "sqlite_lote_segundos"):
+        series = bot.metricas.histograma(nome).values()
+        banco[nome.removesuffix("_segundos")] = {"operacoes": int(sum(n for n, _ in series)),
+                                                "segundos": round(sum(s for _, s in series), 4)}
+    return {
+        "parametros": parametros,
+        "duracao_s": round(duracao, 3),
+        "atualizacoes": atualizacoes,
+        "atualizacoes_por_segundo": round(atualizacoes / duracao, 1),
+        "resultados": dict(resultados),
+        "etapas": etapas,
+        "efi": {"chamadas": dict(efi.chamadas), "erros_injetados": dict(efi.falhas),
+                "chamadas_por_venda": round(chamadas_efi / vendas, 2) if vendas else None},
+        "telegram": {"chamadas": dict(api.chamadas)},
+        "banco": banco,
+        "limitador": {"recusados": dict(bot.limitador_cliques.rejeitados)},
+    }
+
+
+def _imprimir_carga(resumo: dict, base: dict | None):
+    print(f"{resumo['atualizacoes']} atualizações em {resumo['duracao_s']:.1f}s "
+          f"({resumo['atualizacoes_por_segundo']:.0f}/s); resultados: {resumo['resultados']}")
+    print(f"{'etapa':<16} {'ok':>6} {'falhas':>7} {'p50 ms':>9} {'p99 ms':>9}" + ("   Δp50     Δp99" if base else ""))
+    for etapa, dados in resumo["etapas"].items():
+        linha = f"{etapa:<16} {dados['amostras']:>6} {dados['falhas']:>7} {dados['p50_ms'] or 0:>9.1f} {dados['p99_ms'] or 0:>9.1f}"
+        anterior = (base or {}).get("etapas", {}).get(etapa)
+        if anterior and anterior["p50_ms"] and dados["p50_ms"]:
+            linha += "".join(f" {(dados[p] / anterior[p] - 1) * 100:+7.1f}%" for p in ("p50_ms", "p99_ms"))
+        print(linha)
+    efi = resumo["efi"]
+    print(f"Efí: {efi['chamadas']} (erros injetados: {efi['erros_injetados']}); "
+          f"chamadas por venda: {efi['chamadas_por_venda']}")
+    print(f"Telegram: {resumo['telegram']['chamadas']}")
+    if "limitador" in resumo:
+        print(f"Cliques recusados pelo limitador: {resumo['limitador']['recusados']}")
+    print("Banco: " + ", ".join(f"{nome} {dados['operacoes']} op(s) / {dados['segundos']:.2f}s"
+                                for nome, dados in resumo["banco"].items()))
+
+
+async def _bench_carga(usuarios: int, chegada: float, conversao: float, pensar: float, latencia_efi: float,
+                       latencia_telegram: float, erros_efi: float, semente: int, tempo_maximo: float,
+                       saida: str | None, comparar: str | None, transporte: str = bot.EFI_TRANSPORTE):
+    """
+    Sobe a Efí e a Bot API falsas, aponta o bot para elas (cliente da Efí e HTTPXRequest
+    de verdade, falando HTTP) e roda `criar_aplicacao()` em polling, como em produção.
+    A Efí é acessada pelo transporte `transporte` do bot ("http" ou "sdk").
+    Os usuários virtuais chegam a `chegada` por segundo e percorrem o funil
+    start → mostrar_planos → plano_* → aceitar_termos → (paga?) → verificar.
+    """
+    parametros = {"usuarios": usuarios, "chegada": chegada, "conversao": conversao, "pensar": pensar,
+                  "latencia_efi": latencia_efi, "latencia_telegram": latencia_telegram, "erros_efi": erros_efi,
+                  "semente": semente, "transporte": transporte}
+    # Erros da Efí injetados geram logs de erro com traceback; só o relatório interessa aqui.
+    logging.getLogger(bot.__name__).setLevel(logging.CRITICAL)
+    efi, api = EfiFalsa(latencia_efi, erros_efi, semente), BotApiFalsa(latencia_telegram)
+    await efi.iniciar()
+    await api.iniciar()
+
+    with tempfile.TemporaryDirectory() as diretorio:
+        bot.repositorio = bot.RepositorioPagamentos(_banco_temporario(diretorio))
+        bot.metricas = bot.Metricas()
+        bot.METRICAS_PORTA = 0
+        bot.TELEGRAM_API_URL = f"{api.url}/bot"
+        if transporte == "sdk":
+            Constants.APIS['PIX']['URL'] = {'production': efi.url, 'sandbox': efi.url}
+            certificado = os.path.join(diretorio, "certificado.pem")
+            open(certificado, "w").close()
+            bot.gateway = bot.GatewayEfi(bot.TransporteSdkEfi(EfiPay({'client_id': 'carga', 'client_secret': 'carga',
+                                                                      'sandbox': True, 'certificate': certificado})))
+        else:
+            bot.gateway = bot.GatewayEfi(bot.TransporteEfi(url=efi.url, certificado=None, client_id="carga", client_secret="carga"))
+        app = bot.criar_aplicacao()
+        for handler in bot._handlers_de_log_telegram():
+            logging.getLogger().removeHandler(handler)
+
+        await app.initialize()
+        await app.post_init(app)
+        await app.updater.start_polling(poll_interval=0, timeout=timedelta(seconds=5))
+        await app.start()
+
+        aleatorio = random.Random(semente)
+        amostras, falhas = defaultdict(list), collections.Counter()
+        virtuais, tarefas = [], []
+        inicio = time.perf_counter()
+        for i in range(usuarios):
+            virtual = UsuarioVirtual(9_000_000_000 + i, api, efi, aleatorio, conversao, pensar, tempo_maximo)
+            virtuais.append(virtual)
+            tarefas.append(asyncio.create_task(virtual.executar(amostras, falhas)))
+            await asyncio.sleep(aleatorio.expovariate(chegada))
+        await asyncio.gather(*tarefas)
+        duracao = time.perf_counter() - inicio
+
+        await app.updater.stop()
+        await app.stop()
+        await app.post_stop(app)
+        await app.shutdown()
+        await app.post_shutdown(app)
+    await api.parar()
+    await efi.parar()
+
+    resultados = collections.Counter(v.resultado for v in virtuais)
+    atualizacoes = sum(len(valores) + falhas[etapa] for etapa, valores in amostras.items())
+    resumo = _resumir_carga(amostras, falhas, resultados, duracao, atualizacoes, efi, api, parametros)
+    base = None
+    if comparar:
+        with open(comparar, encoding="utf-8") as arquivo:
+            base = json.load(arquivo)
+    _imprimir_carga(resumo, base)
+    if saida:
+        with open(saida, "w", encoding="utf-8") as arquivo:
+            json.dump(resumo, arquivo, ensure_ascii=False, indent=2)
+        print(f"Resultados gravados em {saida}")
+
+
+# -----------------------------------------------------------------------------
+# 🔐 TRANSPORTE DA EFÍ: SDK vs. mTLS PERSISTENTE COM TOKEN EM CACHE
+# -----------------------------------------------------------------------------
+def _gerar_certificados(diretorio: str) -> tuple[str, str, str]:
+    """
+    Certificados autoassinados para o mTLS local (via `openssl`): o do servidor
+    (127.0.0.1) e o do cliente, este em um .pem com chave e certificado, como o da Efí.
+    """
+    arquivos = {}
+    for nome in ("servidor", "cliente"):
+        chave, certificado = os.path.join(diretorio, f"{nome}.key"), os.path.join(diretorio, f"{nome}.crt")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                        "-keyout", chave, "-out", certificado, "-subj", f"/CN={nome}",
+                        "-addext", "subjectAltName=IP:127.0.0.1"], check=True, capture_output=True)
+        arquivos[nome] = (chave, certificado)
+    pem_cliente = os.path.join(diretorio, "cliente.pem")
+    with open(pem_cliente, "w") as saida:
+        for caminho in reversed(arquivos["cliente"]):
+            with open(caminho) as entrada:
+                saida.write(entrada.read())
+    return arquivos["servidor"][1], arquivos["servidor"][0], pem_cliente
+
+
+async def _bench_efi_tls(chamadas: int, simultaneas: int, latencia: float):
+    """
+    Efí falsa em HTTPS exigindo certificado de cliente. Para cada transporte: uma
+    rajada fria de `simultaneas` chamadas (cliente recém-criado, sem token), depois
+    `chamadas` consultas em sequência e em lotes de `simultaneas`. Conta conexões
+    TCP/TLS abertas e pedidos de token recebidos pelo servidor.
+    """
+    with tempfile.TemporaryDirectory() as diretorio:
+        cert_servidor, chave_servidor, pem_cliente = _gerar_certificados(diretorio)
+        contexto = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH, cafile=pem_cliente)
+        contexto.load_cert_chain(cert_servidor, chave_servidor)
+        contexto.verify_mode = ssl.CERT_REQUIRED
+        # O `requests` do SDK valida o servidor por esta variável; o TransporteEfi recebe `ca`.
+        os.environ["REQUESTS_CA_BUNDLE"] = cert_servidor
+
+        transportes = {
+            "sdk (efipay)": lambda url: bot.TransporteSdkEfi(EfiPay({
+                'client_id': 'bench', 'client_secret': 'bench', 'sandbox': True, 'certificate': pem_cliente})),
+            "http persistente": lambda url: bot.TransporteEfi(url=url, certificado=pem_cliente, ca=cert_servidor,
+                                                              client_id='bench', client_secret='bench'),
+        }
+        for nome, criar in transportes.items():
+            efi = EfiFalsa(latencia, 0.0, 1)
+            await efi.iniciar(contexto)
+            Constants.APIS['PIX']['URL'] = {'production': efi.url, 'sandbox': efi.url}
+            gateway = bot.GatewayEfi(criar(efi.url), limite_por_endpoint=simultaneas)
+            cobranca = await gateway.criar_cobranca({"calendario": {"expiracao": 3600}, "valor": {"original": "19.90"},
+                                                      "chave": "bench"})
+            txid = cobranca["txid"]
+            conexoes_antes, tokens_antes = len(efi.conexoes), efi.chamadas["authorize"]
+
+            # Rajada fria: cliente novo, sem token e sem conexões.
+            await gateway.transporte.fechar()
+            gateway.transporte = criar(efi.url)
+            inicio = time.perf_counter()
+            await asyncio.gather(*(gateway.detalhar_cobranca(txid, usar_cache=False) for _ in range(simultaneas)))
+            fria = time.perf_counter() - inicio
+            tokens_fria = efi.chamadas["authorize"] - tokens_antes
+
+            for modo, lote in (("sequencial", 1), (f"{simultaneas} simultâneas", simultaneas)):
+                latencias = []
+                conexoes_antes = len(efi.conexoes)
+                cpu, inicio = time.process_time(), time.perf_counter()
+
+                async def consultar():
+                    comeco = time.perf_counter()
+                    await gateway.detalhar_cobranca(txid, usar_cache=False)
+                    latencias.append(time.perf_counter() - comeco)
+
+                for _ in range(chamadas // lote):
+                    await asyncio.gather(*(consultar() for _ in range(lote)))
+                segundos, cpu = time.perf_counter() - inicio, time.process_time() - cpu
+                print(f"{nome:<18} {modo:<16} {len(latencias):>5} chamadas  p50 {_percentil(latencias, 0.5) * 1e3:7.2f} ms  "
+                      f"p99 {_percentil(latencias, 0.99) * 1e3:7.2f} ms  {len(latencias) / segundos:7.0f}/s  "
+                      f"CPU {cpu / len(latencias) * 1e3:5.2f} ms/chamada  conexões novas: {len(efi.conexoes) - conexoes_antes}")
+            print(f"{nome:<18} rajada fria de {simultaneas}: {fria * 1e3:.0f} ms, {tokens_fria} pedido(s) de token")
+            await gateway.fechar()
+            await efi.parar()
+        os.environ.pop("REQUESTS_CA_BUNDLE")
+
+
+# -----------------------------------------------------------------------------
+# ⚡ DISJUNTOR DA EFÍ: CHECKOUTS DURANTE UMA QUEDA
+# -----------------------------------------------------------------------------
+class TransporteComFalhas:
+    """
+    Transporte da Efí com injeção de falhas: `falha` None responde normalmente; "erro"
+    levanta ErroGatewayEfi (como um 503) e "lenta" não responde antes do timeout.
+    """
+    def __init__(self, latencia: float):
+        self.latencia = latencia
+        self.falha = None
+        self.chamadas = collections.Counter()
+        self._txids = itertools.count(1)
+
+    async def preparar(self):
+        pass
+
+    async def chamar(self, endpoint: str, params: dict | None = None, body: dict | None = None, headers: dict | None = None):
+        self.chamadas["falha" if self.falha else "ok"] += 1
+        if self.falha == "lenta":
+            await asyncio.sleep(3600)
+        await asyncio.sleep(self.latencia)
+        if self.falha == "erro":
+            raise bot.ErroGatewayEfi(f"HTTP 503 em '{endpoint}'")
+        if endpoint == 'pix_create_immediate_charge':
+            numero = next(self._txids)
+            return {"txid": f"disjuntor{numero:026d}", "loc": {"id": numero}}
+        if endpoint == 'pix_generate_qrcode':
+            return {"pixCopiaECola": f"00020126580014br.gov.bcb.pix{params['id']}"}
+        return {"txid": params['txid'], "status": "ATIVA"}
+
+    async def fechar(self):
+        pass
+
+
+class BotEntregasFalso:
+    """Imita Bot.send_message para a fila de checkouts adiados: guarda quem recebeu o quê."""
+
+    def __init__(self):
+        self.enviadas = collections.Counter()
+        self._ids = itertools.count(1)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.enviadas[chat_id] += 1
+        return Message(next(self._ids), datetime.now(), Chat(chat_id, "private"))
+
+
+async def _bench_disjuntor(chegada: float, saudavel: float, queda: float, recuperacao: float, falha: str,
+                           latencia: float, timeout: float, espera: float):
+    """
+    Checkouts chegando a `chegada`/s contra uma Efí falsa que funciona por `saudavel`
+    segundos, cai por `queda` segundos (erros ou lentidão) e volta. Sem disjuntor, cada
+    checkout da queda espera a falha (ou o timeout) e termina em erro; com ele, depois
+    das primeiras falhas o checkout responde na hora e vai para a fila persistida,
+    drenada quando a sondagem fecha o disjuntor.
+    """
+    fases = (("saudável", saudavel, None), ("queda", queda, falha), ("recuperação", recuperacao, None))
+    configuracoes = (
+        ("sem disjuntor", lambda endpoint: bot.Disjuntor(endpoint, limite_falhas=float("inf"), lentidao=float("inf"))),
+        ("com disjuntor", lambda endpoint: bot.Disjuntor(endpoint, espera=espera)),
+    )
+    logging.getLogger(bot.__name__).setLevel(logging.CRITICAL)
+    for nome, fabrica in configuracoes:
+        with tempfile.TemporaryDirectory() as diretorio:
+            db_file = _banco_temporario(diretorio)
+            bot.repositorio = bot.RepositorioPagamentos(db_file)
+            await bot.repositorio.abrir()
+            transporte = TransporteComFalhas(latencia)
+            bot.gateway = bot.GatewayEfi(transporte, timeout=timeout, backoff=0.05, fabrica_disjuntor=fabrica)
+            bot_falso = BotEntregasFalso()
+            bot.fila_checkouts = bot.FilaCheckoutsAdiados(intervalo=0.5, validade=3600, simultaneos=4)
+            bot.fila_checkouts.iniciar(bot_falso)
+
+            resultados = defaultdict(list)  # (fase, desfecho) -> latências
+            chamadas_na_queda = 0
+
+            async def checkout(user_id: int, fase: str):
+                # Mesma decisão de gerar_pagamento, sem a conversa do Telegram em volta.
+                inicio = time.perf_counter()
+                pagamento = None
+                if bot.gateway.disponivel(*bot.GatewayEfi.CRIACAO):
+                    pagamento = await bot.criar_pagamento_efi(19.9, user_id, "mensal")
+                if pagamento:
+                    desfecho = "pix"
+                elif not bot.gateway.disponivel(*bot.GatewayEfi.CRIACAO):
+                    await bot.fila_checkouts.adiar(user_id, f"u{user_id}", "mensal", 1990)
+                    desfecho = "adiado"
+                else:
+                    desfecho = "erro"
+                resultados[(fase, desfecho)].append(time.perf_counter() - inicio)
+
+            tarefas = []
+            user_id = 0
+            comeco = time.time()
+            for fase, duracao, modo in fases:
+                transporte.falha = modo
+                antes = sum(transporte.chamadas.values())
+                fim = time.perf_counter() + duracao
+                while time.perf_counter() < fim:
+                    user_id += 1
+                    tarefas.append(asyncio.create_task(checkout(user_id, fase)))
+                    await asyncio.sleep(1 / chegada)
+                if modo:
+                    chamadas_na_queda = sum(transporte.chamadas.values()) - antes
+            await asyncio.gather(*tarefas)
+            # Dá tempo para a fila drenar o que foi adiado.
+            for _ in range(int(10 / 0.1)):
+                if not await bot.repositorio.checkouts_adiados():
+                    break
+                await asyncio.sleep(0.1)
+
+            print(f"{nome}: {user_id} checkouts, {chamadas_na_queda} chamada(s) à Efí durante a queda")
+            for fase, _, _ in fases:
+                for desfecho in ("pix", "adiado", "erro"):
+                    latencias = resultados.get((fase, desfecho))
+                    if latencias:
+                        print(f"    {fase:<12} {desfecho:<7} {len(latencias):>5}  p50 {_percentil(latencias, 0.5) * 1e3:8.1f} ms  "
+                              f"p99 {_percentil(latencias, 0.99) * 1e3:8.1f} ms")
+            adiados = sum(len(v) for (_, desfecho), v in resultados.items() if desfecho == "adiado")
+            print(f"    adiados: {adiados}; entregues pela fila: {bot.fila_checkouts.entregues}; "
+                  f"ainda na fila: {await bot.repositorio.checkouts_adiados()}")
+            transicoes = sorted((instante, endpoint, estado) for endpoint, disjuntor in bot.gateway.disjuntores.items()
+                                for instante, estado in disjuntor.historico)
+            for instante, endpoint, estado in transicoes:
+                print(f"    t={instante - comeco:6.2f}s  {endpoint:<28} -> {estado}")
+
+            await bot.fila_checkouts.parar()
+            await bot.gateway.fechar()
+            await bot.repositorio.fechar()
+
+
+# -----------------------------------------------------------------------------
+# 🚦 LIMITE DE CLIQUES: ROBÔS x USUÁRIOS NORMAIS
+# -----------------------------------------------------------------------------
+def _bench_limite_estado(baldes: int):
+    """Custo de `admitir` e memória/limpeza do estado com `baldes` usuários ativos."""
+    limitador = bot.LimitadorCliques(bot.LIMITE_CLIQUES_TAXA, bot.LIMITE_CLIQUES_RAJADA, bot.LIMITE_CLIQUES_CUSTOS,
+                                     limpeza=float("inf"))
+    inicio = time.perf_counter()
+    for user_id in range(baldes):
+        limitador.admitir(user_id, 2)
+    _relatorio("admitir (usuários novos)", baldes, time.perf_counter() - inicio)
+    inicio = time.perf_counter()
+    for user_id in range(baldes):
+        limitador.admitir(user_id, 2)
+    _relatorio("admitir (já no dicionário)", baldes, time.perf_counter() - inicio)
+
+    limitador.limpar(time.monotonic() + 3600)
+    tracemalloc.start()
+    antes, _ = tracemalloc.get_traced_memory()
+    for user_id in range(baldes):
+        limitador.admitir(user_id, 2)
+    depois, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"    estado: {baldes} baldes, {(depois - antes) / 1e6:.1f} MB ({(depois - antes) / baldes:.0f} bytes/usuário)")
+    inicio = time.perf_counter()
+    removidos = limitador.limpar(time.monotonic() + 3600)
+    print(f"    limpeza com todos os baldes cheios: {removidos} removidos em {(time.perf_counter() - inicio) * 1e3:.1f} ms")
+
+
+async def _bench_limite(usuarios: int, robos: int, cliques_robo: float, duracao: float, latencia: float):
+    """
+    `usuarios` pessoas tocam "Já paguei" a cada 2-6 s enquanto `robos` scripts tocam
+    `cliques_robo` vezes por segundo, por `duracao` segundos. O handler caro só espera
+    `latencia` (a consulta à Efí). Compara quantas operações caras cada grupo executou
+    e a latência das pessoas, sem e com o limitador no ProcessadorPorUsuario.
+    """
+    recusar_clique = bot.recusar_clique
+    for nome, com_limite in (("sem limitador", False), ("com limitador", True)):
+        bot.limitador_cliques = bot.LimitadorCliques(bot.LIMITE_CLIQUES_TAXA, bot.LIMITE_CLIQUES_RAJADA,
+                                                     bot.LIMITE_CLIQUES_CUSTOS, bot.LIMITE_CLIQUES_CAROS,
+                                                     bot.LIMITE_CAROS_SIMULTANEOS, bot.LIMITE_CLIQUES_LIMPEZA)
+        processador = bot.ProcessadorPorUsuario(bot.ATUALIZACOES_SIMULTANEAS, bot.limitador_cliques if com_limite else None)
+        app = (Application.builder().token("1:falso").request(RequisicaoFalsa(0.01))
+               .concurrent_updates(processador).updater(None).build())
+        atraso = [latencia]
+        enviadas = {}                  # update_id -> instante do envio
+        executadas = collections.Counter()
+        latencias = defaultdict(list)  # grupo -> segundos até a resposta (executada ou recusada)
+        pendentes = [0]
+        drenado = asyncio.Event()
+
+        def grupo(user_id):
+            return "robô" if user_id > usuarios else "pessoa"
+
+        async def verificar(update, context):
+            await asyncio.sleep(atraso[0])
+            executadas[grupo(update.effective_user.id)] += 1
+
+        async def concluir(update, context):
+            latencias[grupo(update.effective_user.id)].append(time.perf_counter() - enviadas.pop(update.update_id))
+            pendentes[0] -= 1
+            if not pendentes[0]:
+                drenado.set()
+
+        async def recusar(update, motivo):
+            # O clique recusado não passa pelos handlers: o fim dele é registrado aqui.
+            await recusar_clique(update, motivo)
+            await concluir(update, None)
+
+        bot.recusar_clique = recusar
+        app.add_handler(CallbackQueryHandler(bot.limitador_cliques.operacao_cara(verificar), pattern="^verificar$"))
+        app.add_handler(TypeHandler(Update, concluir), group=1)
+        await app.initialize()
+        await app.start()
+
+        ids = itertools.count(1)
+        fim = time.perf_counter() + duracao
+
+        async def clicar(user_id, pausa):
+            await asyncio.sleep(pausa())
+            while time.perf_counter() < fim:
+                update_id = next(ids)
+                enviadas[update_id] = time.perf_counter()
+                pendentes[0] += 1
+                await app.update_queue.put(_clique_sintetico(app.bot, update_id, user_id, "verificar"))
+                await asyncio.sleep(pausa())
+
+        aleatorio = random.Random(1)
+        await asyncio.gather(
+            *(clicar(user_id, lambda: aleatorio.uniform(2, 6)) for user_id in range(1, usuarios + 1)),
+            *(clicar(user_id, lambda: 1 / cliques_robo) for user_id in range(usuarios + 1, usuarios + robos + 1)),
+        )
+        feitas = dict(executadas)
+        atrasadas = pendentes[0]
+        atraso[0] = 0  # O que ficou na fila drena na hora, só para encerrar
+        if pendentes[0]:
+            await drenado.wait()
+        await app.stop()
+        await app.shutdown()
+        bot.recusar_clique = recusar_clique
+
+        print(f"{nome}: operações caras em {duracao:.0f}s: {feitas}; ainda na fila ao final: {atrasadas}; "
+              f"recusadas: {dict(bot.limitador_cliques.rejeitados)}")
+        for nome_grupo, valores in sorted(latencias.items()):
+            print(f"    {nome_grupo:<7} {len(valores):>6} cliques  p50 {_percentil(valores, 0.5) * 1e3:8.1f} ms  "
+                  f"p99 {_percentil(valores, 0.99) * 1e3:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    cenarios = parser.add_subparsers(dest="cenario", required=True)
+
+    repo = cenarios.add_parser("repositorio", help="Repositório com pool/escritor vs. sqlite3.connect por chamada")
+    repo.add_argument("--cliques", type=int, default=5000)
+    repo.add_argument("--concorrencia", type=int, default=50)
+
+    indices = cenarios.add_parser("indices", help="Planos e latências das consultas quentes antes/depois dos índices")
+    indices.add_argument("--linhas", type=int, default=1_000_000)
+    indices.add_argument("--consultas", type=int, default=200)
+
+    persistencia = cenarios.add_parser("persistencia", help="Inicialização e gravação da persistência com muitos usuários")
+    persistencia.add_argument("--usuarios", type=int, default=100_000)
+    persistencia.add_argument("--sujos", type=int, default=20)
+
+    atualizacoes = cenarios.add_parser("atualizacoes", help="Gerador de carga em processo: atualizações por segundo")
+    atualizacoes.add_argument("--usuarios", type=int, default=200)
+    atualizacoes.add_argument("--por-usuario", type=int, default=5)
+    atualizacoes.add_argument("--latencia", type=float, default=0.05, help="Latência simulada de cada chamada à Bot API (s)")
+    atualizacoes.add_argument("--simultaneas", type=int, default=bot.ATUALIZACOES_SIMULTANEAS)
+
+    checkout = cenarios.add_parser("checkout", help="Cliques simultâneos no aceite dos termos: cobranças criadas por usuário")
+    checkout.add_argument("--usuarios", type=int, default=50)
+    checkout.add_argument("--cliques", type=int, default=5)
+    checkout.add_argument("--latencia", type=float, default=0.2, help="Latência simulada de cada chamada à Efí (s)")
+
+    consultas = cenarios.add_parser("consultas", help="Cliques repetidos em 'Já paguei': chamadas a pix_detail_charge")
+    consultas.add_argument("--usuarios", type=int, default=200)
+    consultas.add_argument("--cliques", type=int, default=10)
+    consultas.add_argument("--intervalo", type=float, default=0.5, help="Pausa média entre cliques de um usuário (s)")
+    consultas.add_argument("--latencia", type=float, default=0.1, help="Latência simulada de cada chamada à Efí (s)")
+
+    metricas = cenarios.add_parser("metricas", help="Custo por observação das métricas")
+    metricas.add_argument("--observacoes", type=int, default=1_000_000)
+
+    transmissao = cenarios.add_parser("transmissao", help="/broadcast para N assinantes com um Bot falso e reinício no meio")
+    transmissao.add_argument("--destinatarios", type=int, default=100_000)
+    transmissao.add_argument("--taxa", type=float, default=20_000, help="Mensagens por segundo do balde de fichas")
+    transmissao.add_argument("--latencia", type=float, default=0.02, help="Latência simulada de cada send_message (s)")
+
+    convites = cenarios.add_parser("convites", help="Aprovações simultâneas: links de convite criados na hora vs. pool")
+    convites.add_argument("--aprovacoes", type=int, default=50)
+    convites.add_argument("--profundidade", type=int, default=20)
+    convites.add_argument("--latencia", type=float, default=0.3, help="Latência simulada de create_chat_invite_link (s)")
+
+    sessoes = cenarios.add_parser("sessoes", help="Memória por usuário: user_data em dict vs. SessaoUsuario")
+    sessoes.add_argument("--usuarios", type=int, default=100_000)
+
+    renderizacao = cenarios.add_parser("renderizacao", help="CPU por atualização dos handlers de telas fixas")
+    renderizacao.add_argument("--atualizacoes", type=int, default=20_000)
+
+    relatorio = cenarios.add_parser("relatorio", help="/relatorio por agregados vs. SQL ad hoc, triggers e exportação CSV")
+    relatorio.add_argument("--linhas", type=int, default=2_000_000)
+    relatorio.add_argument("--dias", type=int, default=30)
+
+    multiprocesso = cenarios.add_parser("multiprocesso", help="Vazão do funil com 1, 2, 4... workers atrás do roteador")
+    multiprocesso.add_argument("--usuarios", type=int, default=2000)
+    multiprocesso.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    multiprocesso.add_argument("--latencia", type=float, default=0.02, help="Latência simulada da Bot API e da Efí (s)")
+
+    carga = cenarios.add_parser("carga", help="Funil completo com Efí e Bot API falsas via HTTP: p50/p99 por etapa")
+    carga.add_argument("--usuarios", type=int, default=1000)
+    carga.add_argument("--chegada", type=float, default=50, help="Usuários novos por segundo")
+    carga.add_argument("--conversao", type=float, default=0.7, help="Fração dos usuários que paga o PIX")
+    carga.add_argument("--pensar", type=float, default=0.2, help="Pausa média entre etapas de um usuário (s)")
+    carga.add_argument("--latencia-efi", type=float, default=0.1, help="Latência de cada rota da Efí falsa (s)")
+    carga.add_argument("--latencia-telegram", type=float, default=0.03, help="Latência de cada método da Bot API falsa (s)")
+    carga.add_argument("--erros-efi", type=float, default=0.0, help="Fração das chamadas à Efí que respondem 500")
+    carga.add_argument("--semente", type=int, default=1)
+    carga.add_argument("--tempo-maximo", type=float, default=30, help="Espera máxima pela resposta de cada etapa (s)")
+    carga.add_argument("--saida", help="Grava os resultados em JSON")
+    carga.add_argument("--comparar", help="JSON de uma execução anterior para comparar p50/p99")
+    carga.add_argument("--transporte", choices=("http", "sdk"), default=bot.EFI_TRANSPORTE)
+
+    efi_tls = cenarios.add_parser("efi_tls", help="Transporte da Efí contra um servidor mTLS local: SDK vs. conexões persistentes")
+    efi_tls.add_argument("--chamadas", type=int, default=500)
+    efi_tls.add_argument("--simultaneas", type=int, default=16)
+    efi_tls.add_argument("--latencia", type=float, default=0.0, help="Latência de cada rota da Efí falsa (s)")
+
+    disjuntor = cenarios.add_parser("disjuntor", help="Checkouts durante uma queda da Efí: com e sem disjuntor e fila de adiados")
+    disjuntor.add_argument("--chegada", type=float, default=20, help="Checkouts por segundo")
+    disjuntor.add_argument("--saudavel", type=float, default=3, help="Duração da fase saudável (s)")
+    disjuntor.add_argument("--queda", type=float, default=10, help="Duração da queda (s)")
+    disjuntor.add_argument("--recuperacao", type=float, default=5, help="Duração da fase de recuperação (s)")
+    disjuntor.add_argument("--falha", choices=("erro", "lenta"), default="erro")
+    disjuntor.add_argument("--latencia", type=float, default=0.1, help="Latência de cada chamada à Efí falsa (s)")
+    disjuntor.add_argument("--timeout", type=float, default=2, help="Timeout das chamadas do GatewayEfi (s)")
+    disjuntor.add_argument("--espera", type=float, default=2, help="Tempo do disjuntor aberto antes da sondagem (s)")
+
+    limite = cenarios.add_parser("limite", help="Robôs clicando sem parar: operações caras e latência das pessoas, com e sem limitador")
+    limite.add_argument("--usuarios", type=int, default=200)
+    limite.add_argument("--robos", type=int, default=20)
+    limite.add_argument("--cliques-robo", type=float, default=20, help="Cliques por segundo de cada robô")
+    limite.add_argument("--duracao", type=float, default=10)
+    limite.add_argument("--latencia", type=float, default=0.2, help="Duração da operação cara (s)")
+    limite.add_argument("--baldes", type=int, default=200_000, help="Usuários no teste de custo e memória do estado")
+
+    args = parser.parse_args()
+    if args.cenario == "repositorio":
+        asyncio.run(_bench_repositorio(args.cliques, args.concorrencia))
+    elif args.cenario == "indices":
+        _bench_indices(args.linhas, args.consultas)
+    elif args.cenario == "persistencia":
+        asyncio.run(_bench_persistencia(args.usuarios, args.sujos))
+    elif args.cenario == "atualizacoes":
+        asyncio.run(_bench_atualizacoes(args.usuarios, args.por_usuario, args.latencia, args.simultaneas))
+    elif args.cenario == "checkout":
+        asyncio.run(_bench_checkout(args.usuarios, args.cliques, args.latencia))
+    elif args.cenario == "consultas":
+        asyncio.run(_bench_consultas(args.usuarios, args.cliques, args.intervalo, args.latencia))
+    elif args.cenario == "metricas":
+        _bench_metricas(args.observacoes)
+    elif args.cenario == "transmissao":
+        asyncio.run(_bench_transmissao(args.destinatarios, args.taxa, args.latencia))
+    elif args.cenario == "convites":
+        asyncio.run(_bench_convites(args.aprovacoes, args.profundidade, args.latencia))
+    elif args.cenario == "sessoes":
+        _bench_sessoes(args.usuarios)
+    elif args.cenario == "renderizacao":
+        asyncio.run(_bench_renderizacao(args.atualizacoes))
+    elif args.cenario == "relatorio":
+        asyncio.run(_bench_relatorio(args.linhas, args.dias))
+    elif args.cenario == "multiprocesso":
+        asyncio.run(_bench_multiprocesso(args.usuarios, args.workers, args.latencia))
+    elif args.cenario == "efi_tls":
+        asyncio.run(_bench_efi_tls(args.chamadas, args.simultaneas, args.latencia))
+    elif args.cenario == "disjuntor":
+        asyncio.run(_bench_disjuntor(args.chegada, args.saudavel, args.queda, args.recuperacao, args.falha,
+                                     args.latencia, args.timeout, args.espera))
+    elif args.cenario == "limite":
+        _bench_limite_estado(args.baldes)
+        asyncio.run(_bench_limite(args.usuarios, args.robos, args.cliques_robo, args.duracao, args.latencia))
+    elif args.cenario == "carga":
+        asyncio.run(_bench_carga(args.usuarios, args.chegada, args.conversao, args.pensar, args.latencia_efi,
+                                 args.latencia_telegram, args.erros_efi, args.semente, args.tempo_maximo,
+                                 args.saida, args.comparar, args.transporte))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,39 @@
 # --- Requisitos ---
-# pip install python-telegram-bot efipay pytz
+# pip install "python-telegram-bot[job-queue,webhooks]" efipay pytz aiohttp
 
 import asyncio
+import bisect
+import collections
+import contextlib
+import csv
+import enum
 import sys
+import threading
 import logging
 import sqlite3
 import re
 import html
-from datetime import datetime, timedelta
+import json
+import multiprocessing
+import pickle
+import random
+import signal
+import ssl
+import tempfile
+import time
+import functools
+import gzip
+import hmac
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+import httpx
 import pytz
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot, constants
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, PicklePersistence, MessageHandler, filters
-from telegram.error import BadRequest
-from efipay import EfiPay
+from telegram.ext import Application, BasePersistence, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, PersistenceInput, filters
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
+from aiohttp import web
 # Você precisa ter um arquivo senhas.py com suas credenciais
 from senhas import (
     TOKEN_BOT,
@@ -32,150 +53,2645 @@ from senhas import (
 class TelegramLogHandler(logging.Handler):
     """
     Um handler de logging que envia registros para um chat do Telegram.
+
+    `emit` apenas coloca o registro em uma fila limitada (pode ser chamado de
+    qualquer thread). Uma única tarefa consumidora junta os registros em mensagens
+    de até 4096 caracteres e envia no máximo uma mensagem a cada `intervalo`
+    segundos, respeitando o limite do Telegram por chat. Se a fila encher, os
+    registros novos são descartados e o total aparece no lote seguinte.
     """
-    def __init__(self, bot: Bot, chat_id: int):
+    LIMITE_MENSAGEM = 4096
+    LIMITE_REGISTRO = 4000
+
+    def __init__(self, bot: Bot, chat_id: int, max_fila: int = 1000, intervalo: float = 3.0):
         super().__init__()
         self.bot = bot
         self.chat_id = chat_id
+        self.max_fila = max_fila
+        self.intervalo = intervalo
+        self.enviados = 0
+        self.descartados = 0
+        self._descartados_nao_informados = 0
+        self._fila = collections.deque()
+        self._trava_fila = threading.Lock()
+        self._tarefa: asyncio.Task | None = None
 
     def emit(self, record):
-        """Formata, escapa e envia o registro de log."""
-        log_entry = self.format(record)
-        escaped_log_entry = html.escape(log_entry)
+        """Formata, escapa e enfileira o registro de log."""
+        try:
+            escaped_log_entry = html.escape(self.format(record))
+        except Exception:
+            self.handleError(record)
+            return
+
+        if len(escaped_log_entry) > self.LIMITE_REGISTRO:
+            escaped_log_entry = escaped_log_entry[:self.LIMITE_REGISTRO] + "\n\n[LOG TRUNCADO POR SER MUITO LONGO]"
+
+        with self._trava_fila:
+            if len(self._fila) >= self.max_fila:
+                self.descartados += 1
+                self._descartados_nao_informados += 1
+                return
+            self._fila.append(escaped_log_entry)
+
+    def _montar_lote(self) -> tuple[str, list]:
+        """Retira da fila quantos registros couberem em uma mensagem."""
+        aviso = ""
+        partes = []
+        with self._trava_fila:
+            if self._descartados_nao_informados:
+                aviso = f"[{self._descartados_nao_informados} REGISTRO(S) DESCARTADO(S): FILA CHEIA]\n\n"
+                self._descartados_nao_informados = 0
+            tamanho = len("<pre></pre>") + len(aviso)
+            while self._fila and tamanho + len(self._fila[0]) + 2 <= self.LIMITE_MENSAGEM:
+                registro = self._fila.popleft()
+                partes.append(registro)
+                tamanho += len(registro) + 2
+        return aviso, partes
+
+    async def _enviar_lote(self) -> bool:
+        """Envia um lote; retorna False se não havia nada a enviar."""
+        aviso, partes = self._montar_lote()
+        if not aviso and not partes:
+            return False
+        try:
+            await self.bot.send_message(chat_id=self.chat_id, text="<pre>" + aviso + "\n\n".join(partes) + "</pre>",
+                                        parse_mode=constants.ParseMode.HTML)
+            self.enviados += len(partes)
+        except RetryAfter as e:
+            # Devolve o lote ao início da fila e espera o tempo pedido pelo Telegram.
+            with self._trava_fila:
+                self._fila.extendleft(reversed(partes))
+            espera = e.retry_after
+            await asyncio.sleep(espera.total_seconds() if isinstance(espera, timedelta) else espera)
+        except Exception as e:
+            # Não usa o logger aqui para não realimentar a própria fila.
+            sys.stderr.write(f"ERRO INESPERADO no handler de log do Telegram: {e}\n")
+            self.descartados += len(partes)
+        return True
+
+    async def _consumir(self):
+        while True:
+            await asyncio.sleep(self.intervalo)
+            await self._enviar_lote()
+
+    def iniciar(self):
+        """Inicia a tarefa consumidora no loop atual."""
+        if not self._tarefa:
+            self._tarefa = asyncio.create_task(self._consumir())
+
+    async def encerrar(self, tempo_maximo: float = 10.0):
+        """Para a tarefa consumidora e envia o que restou na fila (com pausas de 1s)."""
+        if self._tarefa:
+            self._tarefa.cancel()
+            try:
+                await self._tarefa
+            except asyncio.CancelledError:
+                pass
+            self._tarefa = None
+        prazo = time.monotonic() + tempo_maximo
+        while time.monotonic() < prazo and await self._enviar_lote():
+            await asyncio.sleep(1)
+        # Direto no stderr: pelo logger, o resumo voltaria para esta mesma fila, já encerrada.
+        sys.stderr.write(f"Handler de log do Telegram encerrado: {self.enviados} registro(s) enviado(s), {self.descartados} descartado(s).\n")
+
+
+# -----------------------------------------------------------------------------
+# ⚙️ CONFIGURAÇÕES INICIAIS
+# -----------------------------------------------------------------------------
+DB_FILE = 'pagamentos.db'
+PERSISTENCIA_ANTIGA = 'bot_persistence'  # Arquivo do antigo PicklePersistence, importado uma vez pela migração 10
+logger = logging.getLogger(__name__)
+
+# --- MODO DE EXECUÇÃO ---
+MODO_EXECUCAO = "polling"         # "polling", "webhook" ou "multiprocesso" (front + workers, também via webhook)
+TELEGRAM_API_URL = "https://api.telegram.org/bot"  # Troque para usar um servidor telegram-bot-api próprio
+ATUALIZACOES_SIMULTANEAS = 64     # Atualizações processadas em paralelo (em ordem por usuário)
+WEBHOOK_TELEGRAM_URL = ""         # URL pública completa, ex.: https://seu-dominio/telegram
+WEBHOOK_TELEGRAM_HOST = "0.0.0.0"
+WEBHOOK_TELEGRAM_PORTA = 8443
+WEBHOOK_TELEGRAM_CAMINHO = "telegram"
+WEBHOOK_TELEGRAM_SEGREDO = ""     # Enviado pelo Telegram no cabeçalho X-Telegram-Bot-Api-Secret-Token
+
+# --- MODO MULTIPROCESSO ---
+# O front recebe o webhook do Telegram e repassa cada atualização ao worker do
+# usuário (user_id % WORKERS). Todos compartilham o pagamentos.db (WAL).
+WORKERS = 4                       # Processos que tratam as atualizações
+WORKERS_HOST = "127.0.0.1"        # Front e workers conversam só pela máquina local
+WORKERS_PORTA_BASE = 8701         # O worker i escuta em WORKERS_PORTA_BASE + i
+WORKER_INDICE = 0                 # Definidos em cada worker; no modo de um processo só, ele é o worker 0 de 1
+WORKER_TOTAL = 1
+
+# --- CONFIGURAÇÕES DO GATEWAY EFÍ ---
+EFI_TRANSPORTE = "sdk"        # "sdk" (SDK oficial efipay em threads) ou "http" (mTLS persistente e token em cache; ainda não validado contra a Efí real)
+EFI_CONEXOES = 16             # Conexões keep-alive com a Efí no transporte "http"
+EFI_TOKEN_MARGEM = 300        # Renova o token OAuth em segundo plano quando faltar isso (segundos) para expirar
+EFI_MAX_THREADS = 16          # Máximo de chamadas simultâneas à Efí no transporte "sdk" (todas as rotas)
+EFI_LIMITE_POR_ENDPOINT = 8   # Máximo de chamadas simultâneas por endpoint
+EFI_TIMEOUT = 15              # Tempo máximo (segundos) de cada chamada
+EFI_CACHE_TAMANHO = 10000     # Consultas de cobrança (txid) guardadas em memória
+EFI_CACHE_TTL = 5             # Validade (segundos) de status não finais; os finais não expiram
+EFI_TENTATIVAS = 3            # Tentativas das consultas (GET) em erros temporários; criar cobrança não é repetido
+EFI_TENTATIVA_BACKOFF = 0.5   # Espera máxima (segundos) antes da 2ª tentativa; dobra a cada nova, sorteada (jitter)
+
+# --- DISJUNTOR DA EFÍ (por endpoint) ---
+DISJUNTOR_FALHAS = 5          # Falhas seguidas (erro, 5xx, timeout ou lentidão) que abrem o disjuntor
+DISJUNTOR_LENTIDAO = 8        # Chamada mais lenta que isso (segundos) conta como falha
+DISJUNTOR_ESPERA = 30         # Segundos aberto (±20%) antes de deixar passar uma chamada de sondagem
+
+# --- WEBHOOK DE NOTIFICAÇÕES PIX DA EFÍ ---
+# Cadastre na Efí a URL pública: https://seu-dominio{WEBHOOK_EFI_CAMINHO}?hmac={WEBHOOK_EFI_SEGREDO}&ignorar=
+WEBHOOK_EFI_ATIVO = False     # Se True, "Já paguei" só consulta o banco local
+WEBHOOK_EFI_HOST = "0.0.0.0"
+WEBHOOK_EFI_PORTA = 8081
+WEBHOOK_EFI_CAMINHO = "/efi/webhook"
+WEBHOOK_EFI_SEGREDO = ""      # Obrigatório quando o webhook está ativo
+
+# --- COBRANÇAS E RECONCILIAÇÃO ---
+EXPIRACAO_COBRANCA = 900          # Validade de cada cobrança PIX (15 minutos)
+IDEMPOTENCIA_JANELA = 900         # Cobrança pendente criada há menos que isso é reaproveitada
+IDEMPOTENCIA_MARGEM = 120         # ...desde que ainda falte pelo menos isso para ela expirar na Efí
+CHECKOUT_TRAVA_TTL = 600          # Travas de checkout ociosas há mais tempo que isso são descartadas
+RECONCILIADOR_INTERVALO = 120     # Segundos entre reconciliações (0 desativa)
+RECONCILIADOR_JANELA = 2 * 3600   # Até quantos segundos para trás consultar na Efí
+
+# --- LOGS NO TELEGRAM ---
+LOG_TELEGRAM_MAX_FILA = 1000      # Registros aguardando envio; acima disso são descartados
+LOG_TELEGRAM_INTERVALO = 3        # Segundos entre mensagens no chat de logs
+
+# --- SESSÕES (user_data) ---
+SESSAO_TTL = 24 * 3600                # Descarta a sessão de quem ficou parado por mais tempo que isso
+SESSAO_INATIVIDADE = 10 * 60          # Mensagem solta depois disso reinicia o fluxo (/start)
+SESSAO_LIMPEZA_INTERVALO = 3600       # Segundos entre limpezas
+
+# --- EXPIRAÇÃO DAS ASSINATURAS ---
+EXPIRACAO_INTERVALO = 300                     # Segundos entre verificações (0 desativa)
+EXPIRACAO_LOTE = 100                          # Assinaturas lidas por consulta
+EXPIRACAO_MAX_POR_EXECUCAO = 1000             # Teto por execução; o resto fica para a próxima
+EXPIRACAO_INTERVALO_CHAMADAS = 0.1            # Pausa entre chamadas à Bot API
+EXPIRACAO_AVISO_ANTECEDENCIA = 3 * 86400      # Lembrete de renovação enviado com esta antecedência
+
+# --- POOL DE COBRANÇAS PRÉ-GERADAS ---
+POOL_COBRANCAS_PROFUNDIDADE = 0   # Cobranças prontas por plano (0 desativa)
+POOL_COBRANCAS_VALIDADE = 3600    # Validade, na Efí, das cobranças do pool (segundos)
+POOL_COBRANCAS_REPOSICAO = 30     # Intervalo máximo entre reposições (segundos)
+
+# --- POOL DE LINKS DE CONVITE DO CANAL PRIVADO ---
+CONVITES_PROFUNDIDADE = 3         # Links prontos (uso único) mantidos em reserva (0 desativa)
+CONVITES_VALIDADE = 2 * 3600      # Validade de cada link criado para o pool
+CONVITES_VALIDADE_MINIMA = 3600   # Links com menos validade que isso são revogados e substituídos
+CONVITES_INTERVALO_CRIACAO = 1    # Segundos entre criações ao repor (limite da Bot API)
+CONVITES_REPOSICAO = 60           # Intervalo máximo entre verificações do pool
+
+# --- PLANOS ---
+DIAS_POR_PLANO = {'mensal': 31, 'trimestral': 93}
+PRECOS_POR_PLANO = {'mensal': PRECO_MENSAL, 'trimestral': PRECO_TRIMESTRAL}
+
+# --- TRANSMISSÕES (/broadcast) ---
+TRANSMISSAO_TAXA = 25             # Mensagens por segundo (o Telegram aceita ~30/s no total)
+TRANSMISSAO_LOTE = 500            # Destinatários lidos do banco por página
+TRANSMISSAO_TENTATIVAS = 3        # Tentativas por destinatário em caso de RetryAfter ou erro de rede
+TRANSMISSAO_SIMULTANEAS = 10      # Envios em voo; num reinício, só estes (ainda sem confirmação) podem ser repetidos
+TRANSMISSAO_RELATORIO = 60        # Segundos entre registros de progresso no log
+
+# --- NOTIFICAÇÕES (admins e canal de termos) ---
+NOTIFICACOES_SIMULTANEAS = 10     # Envios em paralelo
+NOTIFICACOES_MAX_TENTATIVAS = 8   # Depois disso a notificação fica marcada como 'falhou'
+NOTIFICACOES_BACKOFF = 5          # Espera base (segundos) entre tentativas; dobra a cada falha, até 1h
+NOTIFICACOES_INTERVALO = 30       # Segundos entre varreduras do outbox sem novos eventos
+NOTIFICACOES_RESERVA = 120        # Uma notificação em envio fica reservada a um processo por esse tempo
+
+# --- CHECKOUTS ADIADOS (Efí fora do ar) ---
+CHECKOUT_ADIADO_INTERVALO = 5     # Segundos entre verificações da fila enquanto a Efí não volta
+CHECKOUT_ADIADO_VALIDADE = 3600   # Pedido na fila há mais tempo que isso é descartado (o usuário é avisado)
+CHECKOUT_ADIADO_SIMULTANEOS = 4   # Cobranças da fila criadas em paralelo quando a Efí volta
+CHECKOUT_ADIADO_RESERVA = 120     # Um pedido em processamento fica reservado a um processo por esse tempo
+
+# --- LIMITE DE CLIQUES (por usuário e global) ---
+LIMITE_CLIQUES_TAXA = 1           # Fichas repostas por segundo no balde de cada usuário
+LIMITE_CLIQUES_RAJADA = 10        # Capacidade do balde: quanto um usuário parado pode gastar de uma vez
+LIMITE_CLIQUES_CUSTOS = {"aceitar_termos": 3, "verificar": 2}  # Fichas por botão (chave = callback_data ou prefixo com "_"); os demais custam 1
+LIMITE_CLIQUES_CAROS = ("aceitar_termos", "verificar")  # Botões que chamam a Efí e gravam no banco
+LIMITE_CAROS_SIMULTANEOS = 48     # Operações caras em andamento no processo; acima disso o clique é recusado
+LIMITE_CLIQUES_LIMPEZA = 300      # Segundos entre descartes dos baldes já cheios
+
+# --- RELATÓRIOS DE VENDAS (/relatorio) ---
+RELATORIO_DIAS = 7                # Período padrão do /relatorio
+RELATORIO_DIAS_MAXIMO = 366       # Maior período aceito
+RELATORIO_CSV_PAGINA = 5000       # Linhas de `pagamentos` lidas por página na exportação CSV
+RELATORIO_CSV_LIMITE = 50 * 1024 * 1024  # Bytes; maior arquivo aceito pelo sendDocument da Bot API
+
+# --- MÉTRICAS (formato texto do Prometheus) ---
+METRICAS_HOST = "127.0.0.1"       # Só na máquina local; exponha via proxy se precisar
+METRICAS_PORTA = 9464             # GET /metrics (0 desativa)
+
+# --- CONSTANTES PARA OS TERMOS DE USO ---
+TERMS_URL = "https://docs.google.com/document/d/10l_slgZHCnQw4tSjARx52VU8wNYEoU3qvqLCcTpmB1A/edit?usp=sharing" # Mantenha o seu
+
+
+# -----------------------------------------------------------------------------
+# 📊 MÉTRICAS
+# -----------------------------------------------------------------------------
+class _Medicao:
+    """Um uso de Metricas.medir(): conta em andamento, mede a duração e registra erros."""
+    __slots__ = ("_metricas", "_chaves", "_inicio")
+
+    def __init__(self, metricas, chaves):
+        self._metricas = metricas
+        self._chaves = chaves
+
+    def __enter__(self):
+        self._metricas._medidores[self._chaves[2]] += 1
+        self._inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo, valor, rastro):
+        metricas = self._metricas
+        histograma, erros, em_andamento = self._chaves
+        metricas._medidores[em_andamento] -= 1
+        metricas._observar(histograma, time.perf_counter() - self._inicio)
+        if tipo is not None:
+            metricas._contadores[erros] += 1
+        return False
+
+
+class Metricas:
+    """
+    Contadores, medidores e histogramas em memória, exportados no formato texto do
+    Prometheus. Cada série é identificada pelo nome e por uma tupla de rótulos,
+    ex.: ("efi_chamada_segundos", (("endpoint", "pix_detail_charge"),)).
+
+    Não há trava: as observações devem ser feitas no loop de eventos. Uma observação
+    custa uma busca em dicionário e um bisect; `medir()` soma a isso duas leituras
+    do relógio.
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self._contadores = collections.defaultdict(int)    # (nome, rótulos) -> valor
+        self._medidores = collections.defaultdict(float)   # (nome, rótulos) -> valor
+        self._histogramas = {}                              # (nome, rótulos) -> [contagem por bucket..., +Inf, soma]
+        self._chaves_medicao = {}                           # (prefixo, rótulos) -> chaves de _Medicao
+        self._coletores = []
+
+    def incrementar(self, nome: str, rotulos: tuple = (), valor: float = 1):
+        self._contadores[nome, rotulos] += valor
+
+    def definir(self, nome: str, rotulos: tuple = (), valor: float = 0, contador: bool = False):
+        """Define o valor absoluto de uma série (útil para números mantidos por outros componentes)."""
+        (self._contadores if contador else self._medidores)[nome, rotulos] = valor
+
+    def observar(self, nome: str, rotulos: tuple, segundos: float):
+        self._observar((nome, rotulos), segundos)
+
+    def _observar(self, chave: tuple, segundos: float):
+        serie = self._histogramas.get(chave)
+        if serie is None:
+            serie = self._histogramas[chave] = [0] * (len(self.buckets) + 2)
+        serie[bisect.bisect_left(self.buckets, segundos)] += 1
+        serie[-1] += segundos
+
+    def medir(self, prefixo: str, rotulos: tuple = ()) -> _Medicao:
+        """
+        Context manager que alimenta `<prefixo>_segundos` (histograma),
+        `<prefixo>_em_andamento` (medidor) e `<prefixo>_erros_total` (exceções).
+        """
+        chaves = self._chaves_medicao.get((prefixo, rotulos))
+        if chaves is None:
+            chaves = self._chaves_medicao[prefixo, rotulos] = (
+                (f"{prefixo}_segundos", rotulos), (f"{prefixo}_erros_total", rotulos), (f"{prefixo}_em_andamento", rotulos)
+            )
+        return _Medicao(self, chaves)
+
+    def histograma(self, nome: str) -> dict:
+        """{rótulos: (observações, soma em segundos)} de um histograma."""
+        return {rotulos: (sum(serie[:-1]), serie[-1]) for (nome_serie, rotulos), serie in self._histogramas.items()
+                if nome_serie == nome}
+
+    def registrar_coletor(self, coletor):
+        """`coletor()` roda a cada exportação, para atualizar séries que dependem de estado externo."""
+        self._coletores.append(coletor)
+
+    @staticmethod
+    def _formatar_rotulos(rotulos: tuple) -> str:
+        if not rotulos:
+            return ""
+        pares = []
+        for chave, valor in rotulos:
+            valor = str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            pares.append(f'{chave}="{valor}"')
+        return "{" + ",".join(pares) + "}"
+
+    def exportar(self) -> str:
+        for coletor in self._coletores:
+            try:
+                coletor()
+            except Exception as e:
+                logger.error(f"Falha no coletor de métricas {getattr(coletor, '__name__', coletor)}: {e}")
+
+        linhas = []
+        for tipo, series in (("counter", self._contadores), ("gauge", self._medidores)):
+            nome_anterior = None
+            for (nome, rotulos), valor in sorted(series.items()):
+                if nome != nome_anterior:
+                    linhas.append(f"# TYPE {nome} {tipo}")
+                    nome_anterior = nome
+                linhas.append(f"{nome}{self._formatar_rotulos(rotulos)} {valor}")
+
+        nome_anterior = None
+        limites = [str(limite) for limite in self.buckets] + ["+Inf"]
+        for (nome, rotulos), serie in sorted(self._histogramas.items()):
+            if nome != nome_anterior:
+                linhas.append(f"# TYPE {nome} histogram")
+                nome_anterior = nome
+            acumulado = 0
+            for limite, contagem in zip(limites, serie):
+                acumulado += contagem
+                linhas.append(f"{nome}_bucket{self._formatar_rotulos(rotulos + (('le', limite),))} {acumulado}")
+            linhas.append(f"{nome}_sum{self._formatar_rotulos(rotulos)} {serie[-1]}")
+            linhas.append(f"{nome}_count{self._formatar_rotulos(rotulos)} {acumulado}")
+        return "\n".join(linhas) + "\n"
+
+
+metricas = Metricas()
+
+def instrumentar(handler):
+    """Envolve um handler do Telegram para medir sua latência, erros e execuções em andamento."""
+    rotulos = (("handler", handler.__name__),)
+
+    @functools.wraps(handler)
+    async def medido(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        with metricas.medir("bot_handler", rotulos):
+            return await handler(update, context)
+    return medido
+
+def registrar_etapa_funil(etapa: str):
+    """Conta a passagem de um usuário por uma etapa do funil: start → planos → termos → pix → aprovado."""
+    metricas.incrementar("bot_funil_total", (("etapa", etapa),))
+
+
+class RequisicaoInstrumentada(HTTPXRequest):
+    """HTTPXRequest que mede cada chamada à Bot API, rotulada pelo método (sendMessage, ...)."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> tuple[int, bytes]:
+        rotulos = (("metodo", url.rsplit("/", 1)[-1]),)
+        with metricas.medir("telegram_api", rotulos):
+            codigo, corpo = await super().do_request(url, method, *args, **kwargs)
+        if codigo >= 400:
+            metricas.incrementar("telegram_api_erros_total", rotulos)
+        return codigo, corpo
+
+
+_metricas_runner: web.AppRunner | None = None
+
+async def exportar_metricas(request: web.Request) -> web.Response:
+    return web.Response(body=metricas.exportar().encode(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def iniciar_servidor_metricas(porta: int = METRICAS_PORTA):
+    global _metricas_runner
+    app_metricas = web.Application()
+    app_metricas.router.add_get("/metrics", exportar_metricas)
+    _metricas_runner = web.AppRunner(app_metricas, access_log=None)
+    await _metricas_runner.setup()
+    await web.TCPSite(_metricas_runner, METRICAS_HOST, porta).start()
+    logger.info(f"Métricas disponíveis em http://{METRICAS_HOST}:{porta}/metrics")
+
+async def parar_servidor_metricas():
+    global _metricas_runner
+    if _metricas_runner:
+        await _metricas_runner.cleanup()
+        _metricas_runner = None
+
+
+# -----------------------------------------------------------------------------
+# 🗂️ FUNÇÕES DO BANCO DE DADOS
+# -----------------------------------------------------------------------------
+def _migracao_1_esquema_inicial(cursor):
+    """Esquema original. Em bancos antigos (sem user_version) só adiciona as colunas que faltam."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pagamentos (
+            txid TEXT PRIMARY KEY, user_id INTEGER NOT NULL, username TEXT NOT NULL,
+            status TEXT NOT NULL, data_criacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            data_aprovacao TIMESTAMP,
+            pix_message_id INTEGER
+        )
+    ''')
+
+    cursor.execute("PRAGMA table_info(pagamentos)")
+    columns = [info[1] for info in cursor.fetchall()]
+
+    if 'tipo_plano' not in columns:
+        cursor.execute("ALTER TABLE pagamentos ADD COLUMN tipo_plano TEXT NOT NULL DEFAULT 'mensal'")
+        logger.info("Coluna 'tipo_plano' adicionada ao banco de dados.")
+
+    if 'valor' not in columns:
+        cursor.execute("ALTER TABLE pagamentos ADD COLUMN valor REAL NOT NULL DEFAULT 0.0")
+        logger.info("Coluna 'valor' adicionada ao banco de dados.")
+
+def _migracao_2_indices_e_assinaturas(cursor):
+    """
+    Reescreve `pagamentos` com valor em centavos (INTEGER) e datas em Unix timestamp
+    UTC, cria os índices das consultas quentes e a tabela de assinaturas.
+    """
+    cursor.execute('''
+        CREATE TABLE pagamentos_v2 (
+            txid TEXT PRIMARY KEY, user_id INTEGER NOT NULL, username TEXT NOT NULL,
+            status TEXT NOT NULL,
+            data_criacao INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            data_aprovacao INTEGER,
+            pix_message_id INTEGER,
+            tipo_plano TEXT NOT NULL DEFAULT 'mensal',
+            valor_centavos INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # data_criacao veio de CURRENT_TIMESTAMP (UTC); data_aprovacao de datetime.now() (horário local).
+    cursor.execute('''
+        INSERT INTO pagamentos_v2 (txid, user_id, username, status, data_criacao, data_aprovacao, pix_message_id, tipo_plano, valor_centavos)
+        SELECT txid, user_id, username, status,
+               COALESCE(CAST(strftime('%s', data_criacao) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)),
+               CAST(strftime('%s', data_aprovacao, 'utc') AS INTEGER),
+               pix_message_id, tipo_plano, CAST(ROUND(valor * 100) AS INTEGER)
+        FROM pagamentos
+    ''')
+    cursor.execute("DROP TABLE pagamentos")
+    cursor.execute("ALTER TABLE pagamentos_v2 RENAME TO pagamentos")
+    cursor.execute("CREATE INDEX idx_pagamentos_usuario ON pagamentos (user_id, status, data_criacao)")
+    cursor.execute("CREATE INDEX idx_pagamentos_pendentes ON pagamentos (data_criacao) WHERE status = 'pendente'")
+
+    cursor.execute('''
+        CREATE TABLE assinaturas (
+            user_id INTEGER PRIMARY KEY,
+            tipo_plano TEXT NOT NULL,
+            txid TEXT NOT NULL,
+            inicio INTEGER NOT NULL,
+            expira_em INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'ativa'
+        )
+    ''')
+    # Assinaturas a partir dos pagamentos já aprovados (o mais recente de cada usuário).
+    cursor.execute('''
+        INSERT INTO assinaturas (user_id, tipo_plano, txid, inicio, expira_em)
+        SELECT user_id, tipo_plano, txid, data_aprovacao,
+               data_aprovacao + (CASE tipo_plano WHEN 'trimestral' THEN 93 ELSE 31 END) * 86400
+        FROM pagamentos p
+        WHERE status = 'aprovado' AND data_aprovacao IS NOT NULL
+          AND data_aprovacao = (SELECT MAX(data_aprovacao) FROM pagamentos
+                                WHERE user_id = p.user_id AND status = 'aprovado')
+        GROUP BY user_id
+    ''')
+
+def _migracao_3_persistencia_usuarios(cursor):
+    """Tabela da PersistenciaSQLite: um registro por usuário com o user_data serializado."""
+    cursor.execute('''
+        CREATE TABLE persistencia_usuarios (
+            user_id INTEGER PRIMARY KEY,
+            dados BLOB NOT NULL,
+            atualizado_em INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX idx_persistencia_atualizado ON persistencia_usuarios (atualizado_em)")
+
+def _migracao_4_expiracao(cursor):
+    """Expiração por compra em `pagamentos`, controle de lembretes e índices do agendador."""
+    cursor.execute("ALTER TABLE pagamentos ADD COLUMN expira_em INTEGER")
+    cursor.execute('''
+        UPDATE pagamentos
+        SET expira_em = data_aprovacao + (CASE tipo_plano WHEN 'trimestral' THEN 93 ELSE 31 END) * 86400
+        WHERE status = 'aprovado' AND data_aprovacao IS NOT NULL
+    ''')
+    cursor.execute("ALTER TABLE assinaturas ADD COLUMN lembrete_enviado INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("CREATE INDEX idx_assinaturas_vencimento ON assinaturas (expira_em) WHERE status = 'ativa'")
+    cursor.execute("CREATE INDEX idx_assinaturas_lembrete ON assinaturas (expira_em) WHERE status = 'ativa' AND lembrete_enviado = 0")
+
+def _migracao_5_reuso_de_cobrancas(cursor):
+    """Guarda o Copia e Cola e a validade de cada cobrança, para reenviá-la em vez de criar outra."""
+    cursor.execute("ALTER TABLE pagamentos ADD COLUMN pix_copia_cola TEXT")
+    cursor.execute("ALTER TABLE pagamentos ADD COLUMN cobranca_valida_ate INTEGER")
+
+def _migracao_6_transmissoes(cursor):
+    """Transmissões em massa (/broadcast), com o cursor de progresso para retomar após reinício."""
+    cursor.execute('''
+        CREATE TABLE transmissoes (
+            id INTEGER PRIMARY KEY,
+            admin_id INTEGER NOT NULL,
+            publico TEXT NOT NULL,
+            texto TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'em_andamento',
+            ultimo_user_id INTEGER NOT NULL DEFAULT 0,
+            enviados INTEGER NOT NULL DEFAULT 0,
+            bloqueados INTEGER NOT NULL DEFAULT 0,
+            falhas INTEGER NOT NULL DEFAULT 0,
+            criada_em INTEGER NOT NULL,
+            concluida_em INTEGER
+        )
+    ''')
+
+def _migracao_7_notificacoes(cursor):
+    """Outbox das notificações para admins e canais, entregues em segundo plano."""
+    cursor.execute('''
+        CREATE TABLE notificacoes (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            texto TEXT NOT NULL,
+            parse_mode TEXT,
+            status TEXT NOT NULL DEFAULT 'pendente',
+            tentativas INTEGER NOT NULL DEFAULT 0,
+            proxima_tentativa INTEGER NOT NULL,
+            criada_em INTEGER NOT NULL,
+            erro TEXT
+        )
+    ''')
+    cursor.execute("CREATE INDEX idx_notificacoes_pendentes ON notificacoes (proxima_tentativa) WHERE status = 'pendente'")
+
+def _migracao_8_vendas_diarias(cursor):
+    """
+    Agregados de vendas por dia (horário de Brasília) e plano, mantidos por triggers
+    a cada cobrança criada e a cada aprovação, e preenchidos a partir do histórico.
+    Cobranças contam no dia em que foram geradas; vendas, receita e tempo até o
+    pagamento contam no dia da aprovação. O Brasil não tem horário de verão desde
+    2019, então o fuso é um deslocamento fixo de -3 horas.
+    """
+    cursor.execute('''
+        CREATE TABLE vendas_diarias (
+            dia TEXT NOT NULL,
+            tipo_plano TEXT NOT NULL,
+            cobrancas INTEGER NOT NULL DEFAULT 0,
+            aprovadas INTEGER NOT NULL DEFAULT 0,
+            receita_centavos INTEGER NOT NULL DEFAULT 0,
+            segundos_ate_aprovar INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, tipo_plano)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        INSERT INTO vendas_diarias (dia, tipo_plano, cobrancas, aprovadas, receita_centavos, segundos_ate_aprovar)
+        SELECT dia, tipo_plano, SUM(cobrancas), SUM(aprovadas), SUM(receita_centavos), SUM(segundos)
+        FROM (
+            SELECT date(data_criacao, 'unixepoch', '-3 hours') AS dia, tipo_plano,
+                   1 AS cobrancas, 0 AS aprovadas, 0 AS receita_centavos, 0 AS segundos
+            FROM pagamentos
+            UNION ALL
+            SELECT date(data_aprovacao, 'unixepoch', '-3 hours'), tipo_plano,
+                   0, 1, valor_centavos, MAX(0, data_aprovacao - data_criacao)
+            FROM pagamentos WHERE status = 'aprovado' AND data_aprovacao IS NOT NULL
+        )
+        GROUP BY dia, tipo_plano
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_vendas_cobranca AFTER INSERT ON pagamentos
+        BEGIN
+            INSERT INTO vendas_diarias (dia, tipo_plano, cobrancas)
+            VALUES (date(NEW.data_criacao, 'unixepoch', '-3 hours'), NEW.tipo_plano, 1)
+            ON CONFLICT (dia, tipo_plano) DO UPDATE SET cobrancas = cobrancas + 1;
+        END
+    ''')
+    # Aprovação: na inserção (já aprovada) ou na mudança de status vinda de qualquer outro.
+    corpo_aprovacao = '''
+        BEGIN
+            INSERT INTO vendas_diarias (dia, tipo_plano, aprovadas, receita_centavos, segundos_ate_aprovar)
+            VALUES (date(NEW.data_aprovacao, 'unixepoch', '-3 hours'), NEW.tipo_plano, 1, NEW.valor_centavos,
+                    MAX(0, NEW.data_aprovacao - NEW.data_criacao))
+            ON CONFLICT (dia, tipo_plano) DO UPDATE SET
+                aprovadas = aprovadas + 1,
+                receita_centavos = receita_centavos + excluded.receita_centavos,
+                segundos_ate_aprovar = segundos_ate_aprovar + excluded.segundos_ate_aprovar;
+        END
+    '''
+    cursor.execute(f'''
+        CREATE TRIGGER trg_vendas_aprovacao_inserida AFTER INSERT ON pagamentos
+        WHEN NEW.status = 'aprovado' AND NEW.data_aprovacao IS NOT NULL
+        {corpo_aprovacao}
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER trg_vendas_aprovacao AFTER UPDATE OF status ON pagamentos
+        WHEN NEW.status = 'aprovado' AND OLD.status != 'aprovado' AND NEW.data_aprovacao IS NOT NULL
+        {corpo_aprovacao}
+    ''')
+
+def _migracao_9_checkouts_adiados(cursor):
+    """Fila durável dos checkouts pedidos enquanto a Efí estava fora (um por usuário: o último pedido vale)."""
+    cursor.execute('''
+        CREATE TABLE checkouts_adiados (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            tipo_plano TEXT NOT NULL,
+            valor_centavos INTEGER NOT NULL,
+            criado_em INTEGER NOT NULL,
+            tentativas INTEGER NOT NULL DEFAULT 0,
+            proxima_tentativa INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX idx_checkouts_adiados_proxima ON checkouts_adiados (proxima_tentativa)")
+
+class _LeitorPersistenciaAntiga(pickle.Unpickler):
+    """Lê o arquivo do PicklePersistence sem um Bot: as referências ao bot gravadas nele viram None."""
+    def persistent_load(self, pid):
+        return None
+
+def _migracao_10_sessoes_antigas(cursor):
+    """
+    Importa o user_data do antigo PicklePersistence (PERSISTENCIA_ANTIGA) para
+    `persistencia_usuarios`, já no formato compacto da SessaoUsuario. Sem o arquivo,
+    não faz nada; usuários que já têm registro na tabela ficam como estão.
+    """
+    try:
+        with open(PERSISTENCIA_ANTIGA, 'rb') as arquivo:
+            antigo = _LeitorPersistenciaAntiga(arquivo).load()
+    except FileNotFoundError:
+        return
+    agora = int(time.time())
+    linhas = []
+    for user_id, dados in (antigo.get('user_data') or {}).items():
+        sessao = SessaoUsuario()
+        sessao.restaurar(dados)
+        persistente = sessao.persistente()
+        if persistente:
+            linhas.append((user_id, pickle.dumps(persistente, protocol=pickle.HIGHEST_PROTOCOL), agora))
+    cursor.executemany(
+        "INSERT OR IGNORE INTO persistencia_usuarios (user_id, dados, atualizado_em) VALUES (?, ?, ?)", linhas
+    )
+    logger.info(f"Sessões do PicklePersistence importadas: {len(linhas)} com plano escolhido.")
+
+# A posição na lista é o número da versão (PRAGMA user_version). Nunca altere uma
+# migração já publicada: acrescente uma nova ao final.
+MIGRACOES = [
+    _migracao_1_esquema_inicial,
+    _migracao_2_indices_e_assinaturas,
+    _migracao_3_persistencia_usuarios,
+    _migracao_4_expiracao,
+    _migracao_5_reuso_de_cobrancas,
+    _migracao_6_transmissoes,
+    _migracao_7_notificacoes,
+    _migracao_8_vendas_diarias,
+    _migracao_9_checkouts_adiados,
+    _migracao_10_sessoes_antigas,
+]
+
+def aplicar_migracoes(ate: int | None = None):
+    """Cria o banco e aplica, em ordem, as migrações que ainda não rodaram."""
+    conn = None
+    try:
+        conn = sqlite3.connect(DB_FILE, timeout=10, isolation_level=None)
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL;")
+        versao = cursor.execute("PRAGMA user_version").fetchone()[0]
+        alvo = len(MIGRACOES) if ate is None else ate
+
+        for numero in range(versao + 1, alvo + 1):
+            inicio = time.perf_counter()
+            cursor.execute("BEGIN IMMEDIATE")
+            # Outro processo (ex.: um worker que subiu junto) pode ter aplicado esta enquanto esperávamos a trava.
+            if cursor.execute("PRAGMA user_version").fetchone()[0] >= numero:
+                cursor.execute("COMMIT")
+                continue
+            try:
+                MIGRACOES[numero - 1](cursor)
+                cursor.execute(f"PRAGMA user_version = {numero}")
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            logger.info(f"Migração {numero} ({MIGRACOES[numero - 1].__name__}) aplicada em {time.perf_counter() - inicio:.2f}s.")
+
+        logger.info("Banco de dados verificado e pronto para uso.")
+    except sqlite3.Error as e:
+        logger.critical(f"Erro CRÍTICO no banco de dados: {e}")
+        sys.exit(f"Falha ao inicializar o banco de dados: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+class RepositorioPagamentos:
+    """
+    Acesso ao banco de pagamentos sem bloquear o loop de eventos.
+
+    Leituras usam um pool de conexões persistentes (cada uma mantém seu cache de
+    statements preparados) e rodam em threads. Escritas entram em uma fila consumida
+    por uma única tarefa escritora, que junta tudo o que estiver na fila em uma só
+    transação (group commit). Cada escrita roda em seu próprio SAVEPOINT, então a
+    falha de uma não derruba as outras do mesmo lote.
+    """
+    MAX_LOTE = 256
+
+    def __init__(self, db_file: str = DB_FILE, leitores: int = 4):
+        self.db_file = db_file
+        self.num_leitores = leitores
+        self._leitores: asyncio.Queue | None = None
+        self._fila: asyncio.Queue | None = None
+        self._tarefa_escritora: asyncio.Task | None = None
+        self._conexao_escrita: sqlite3.Connection | None = None
+        self._executor_leitura: ThreadPoolExecutor | None = None
+        self._executor_escrita: ThreadPoolExecutor | None = None
+
+    def _conectar(self, somente_leitura: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_file, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if somente_leitura:
+            conn.execute("PRAGMA query_only=1")
+        return conn
+
+    async def abrir(self):
+        """Abre as conexões e inicia a tarefa escritora."""
+        loop = asyncio.get_running_loop()
+        self._executor_leitura = ThreadPoolExecutor(max_workers=self.num_leitores, thread_name_prefix="db-leitura")
+        self._executor_escrita = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-escrita")
+        self._leitores = asyncio.Queue()
+        for _ in range(self.num_leitores):
+            self._leitores.put_nowait(await loop.run_in_executor(self._executor_leitura, self._conectar, True))
+        self._conexao_escrita = await loop.run_in_executor(self._executor_escrita, self._conectar)
+        self._fila = asyncio.Queue()
+        self._tarefa_escritora = asyncio.create_task(self._escritor())
+
+    async def fechar(self):
+        """Grava o que ainda estiver na fila e fecha as conexões."""
+        if not self._tarefa_escritora:
+            return
+        await self._fila.put(None)
+        await self._tarefa_escritora
+        self._tarefa_escritora = None
+        while not self._leitores.empty():
+            self._leitores.get_nowait().close()
+        self._conexao_escrita.close()
+        self._executor_leitura.shutdown()
+        self._executor_escrita.shutdown()
+
+    _nomes_operacao = {}
+
+    @classmethod
+    def _nome_operacao(cls, funcao) -> str:
+        """Nome do método público que originou a consulta, usado como rótulo nas métricas."""
+        nome = cls._nomes_operacao.get(funcao.__code__)
+        if nome is None:
+            partes = funcao.__qualname__.split(".")
+            nome = partes[-3] if len(partes) >= 3 and partes[-2] == "<locals>" else partes[-1]
+            cls._nomes_operacao[funcao.__code__] = nome
+        return nome
+
+    async def _ler(self, funcao, *args):
+        """Executa `funcao(conn, *args)` em uma conexão de leitura do pool."""
+        with metricas.medir("sqlite_leitura", (("operacao", self._nome_operacao(funcao)),)):
+            conn = await self._leitores.get()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._executor_leitura, funcao, conn, *args)
+            finally:
+                self._leitores.put_nowait(conn)
+
+    async def _escrever(self, funcao, *args):
+        """Enfileira `funcao(cursor, *args)` para a tarefa escritora e espera o commit."""
+        with metricas.medir("sqlite_escrita", (("operacao", self._nome_operacao(funcao)),)):
+            futuro = asyncio.get_running_loop().create_future()
+            await self._fila.put((funcao, args, futuro))
+            return await futuro
+
+    async def _escritor(self):
+        loop = asyncio.get_running_loop()
+        encerrar = False
+        while not encerrar:
+            lote = [await self._fila.get()]
+            while len(lote) < self.MAX_LOTE and not self._fila.empty():
+                lote.append(self._fila.get_nowait())
+            if None in lote:
+                encerrar = True
+                lote = [item for item in lote if item is not None]
+            if not lote:
+                continue
+            metricas.incrementar("sqlite_lotes_total")
+            metricas.incrementar("sqlite_lote_escritas_total", valor=len(lote))
+            try:
+                with metricas.medir("sqlite_lote"):
+                    resultados = await loop.run_in_executor(self._executor_escrita, self._executar_lote, lote)
+            except Exception as e:
+                logger.error(f"Falha ao gravar lote de {len(lote)} escrita(s) no banco: {e}")
+                resultados = [(False, e)] * len(lote)
+            for (_, _, futuro), (ok, valor) in zip(lote, resultados):
+                if futuro.done():
+                    continue
+                if ok:
+                    futuro.set_result(valor)
+                else:
+                    futuro.set_exception(valor)
+
+    def _executar_lote(self, lote):
+        """Roda na thread escritora: um BEGIN/COMMIT para o lote inteiro."""
+        cursor = self._conexao_escrita.cursor()
+        resultados = []
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            for funcao, args, _ in lote:
+                cursor.execute("SAVEPOINT escrita")
+                try:
+                    resultados.append((True, funcao(cursor, *args)))
+                    cursor.execute("RELEASE escrita")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO escrita")
+                    cursor.execute("RELEASE escrita")
+                    resultados.append((False, e))
+            cursor.execute("COMMIT")
+        except Exception:
+            if self._conexao_escrita.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise
+        return resultados
+
+    # --- Consultas ---
+    async def pendente_do_usuario(self, user_id: int):
+        """Retorna (txid, tipo_plano) da cobrança pendente mais recente do usuário, ou None."""
+        def consulta(conn, user_id):
+            return conn.execute(
+                "SELECT txid, tipo_plano FROM pagamentos WHERE user_id = ? AND status = 'pendente' ORDER BY data_criacao DESC LIMIT 1",
+                (user_id,)
+            ).fetchone()
+        return await self._ler(consulta, user_id)
+
+    async def aprovado_recentemente(self, user_id: int, horas: int = 24) -> bool:
+        """Indica se o usuário teve um pagamento aprovado nas últimas `horas`."""
+        def consulta(conn, user_id, limite):
+            return conn.execute(
+                "SELECT 1 FROM pagamentos WHERE user_id = ? AND status = 'aprovado' AND data_aprovacao >= ? LIMIT 1",
+                (user_id, limite)
+            ).fetchone() is not None
+        return await self._ler(consulta, user_id, int(time.time()) - horas * 3600)
+
+    async def cobranca_reutilizavel(self, user_id: int, tipo_plano: str, valor_centavos: int):
+        """
+        Retorna (txid, pix_copia_cola) da cobrança pendente do usuário para o mesmo
+        plano e valor, criada dentro de IDEMPOTENCIA_JANELA e com pelo menos
+        IDEMPOTENCIA_MARGEM de validade restante na Efí; ou None.
+        """
+        def consulta(conn, user_id, tipo_plano, valor_centavos, agora):
+            return conn.execute(
+                "SELECT txid, pix_copia_cola FROM pagamentos "
+                "WHERE user_id = ? AND status = 'pendente' AND data_criacao >= ? "
+                "AND tipo_plano = ? AND valor_centavos = ? AND pix_copia_cola IS NOT NULL AND cobranca_valida_ate >= ? "
+                "ORDER BY data_criacao DESC LIMIT 1",
+                (user_id, agora - IDEMPOTENCIA_JANELA, tipo_plano, valor_centavos, agora + IDEMPOTENCIA_MARGEM)
+            ).fetchone()
+        return await self._ler(consulta, user_id, tipo_plano, valor_centavos, int(time.time()))
+
+    async def listar_pendentes(self) -> list:
+        """Retorna [(txid, data_criacao)] de todas as cobranças pendentes (data em Unix timestamp)."""
+        def consulta(conn):
+            return conn.execute("SELECT txid, data_criacao FROM pagamentos WHERE status = 'pendente'").fetchall()
+        return await self._ler(consulta)
+
+    # --- Escritas ---
+    async def substituir_pendente(self, txid: str, user_id: int, username: str, pix_message_id: int, tipo_plano: str, valor_centavos: int,
+                                  pix_copia_cola: str | None = None, valida_ate: int | None = None):
+        """Cancela a cobrança pendente anterior do usuário e registra a nova."""
+        def escrita(cursor):
+            cursor.execute("UPDATE pagamentos SET status = ? WHERE user_id = ? AND status = ?", ('cancelada', user_id, 'pendente'))
+            cursor.execute(
+                'INSERT INTO pagamentos (txid, user_id, username, status, pix_message_id, tipo_plano, valor_centavos, pix_copia_cola, cobranca_valida_ate) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (txid, user_id, username, "pendente", pix_message_id, tipo_plano, valor_centavos, pix_copia_cola, valida_ate)
+            )
+        await self._escrever(escrita)
+
+    async def atualizar_mensagem_pix(self, txid: str, pix_message_id: int):
+        """Registra a mensagem em que o Copia e Cola de uma cobrança reaproveitada foi reenviado."""
+        def escrita(cursor):
+            cursor.execute("UPDATE pagamentos SET pix_message_id = ? WHERE txid = ?", (pix_message_id, txid))
+        await self._escrever(escrita)
+
+    @staticmethod
+    def _aprovar_no_cursor(cursor, txid: str):
+        """Aprova a cobrança e estende a assinatura do usuário; retorna os dados ou None."""
+        agora = int(time.time())
+        cursor.execute("UPDATE pagamentos SET status = ?, data_aprovacao = ? WHERE txid = ? AND status != ?", ('aprovado', agora, txid, 'aprovado'))
+        if cursor.rowcount == 0:
+            return None
+        cursor.execute("SELECT txid, user_id, username, tipo_plano, pix_message_id FROM pagamentos WHERE txid = ?", (txid,))
+        txid, user_id, username, tipo_plano, pix_message_id = cursor.fetchone()
+
+        # Renovação antes do vencimento soma os dias ao prazo que ainda resta.
+        duracao = DIAS_POR_PLANO.get(tipo_plano, 0) * 86400
+        cursor.execute('''
+            INSERT INTO assinaturas (user_id, tipo_plano, txid, inicio, expira_em, status) VALUES (?, ?, ?, ?, ?, 'ativa')
+            ON CONFLICT(user_id) DO UPDATE SET
+                tipo_plano = excluded.tipo_plano,
+                txid = excluded.txid,
+                inicio = CASE WHEN assinaturas.status = 'ativa' AND assinaturas.expira_em > excluded.inicio
+                              THEN assinaturas.inicio ELSE excluded.inicio END,
+                expira_em = MAX(assinaturas.expira_em, excluded.inicio) + ?,
+                status = 'ativa',
+                lembrete_enviado = 0
+            RETURNING expira_em
+        ''', (user_id, tipo_plano, txid, agora, agora + duracao, duracao))
+        expira_em = cursor.fetchone()[0]
+        cursor.execute("UPDATE pagamentos SET expira_em = ? WHERE txid = ?", (expira_em, txid))
+        return {"txid": txid, "user_id": user_id, "username": username, "tipo_plano": tipo_plano,
+                "pix_message_id": pix_message_id, "expira_em": expira_em}
+
+    async def aprovar(self, txid: str):
+        """
+        Marca a cobrança como aprovada e retorna seus dados. Retorna None se ela não
+        existir ou já tiver sido aprovada, para que o link de acesso seja enviado uma
+        única vez mesmo que o botão, o webhook e o reconciliador cheguem juntos.
+        Cobranças canceladas ou expiradas no banco também são aprovadas: se a Efí
+        confirmou o PIX, o dinheiro entrou.
+        """
+        return await self._escrever(self._aprovar_no_cursor, txid)
+
+    async def reconciliar(self, aprovar: list, expirar: list) -> list:
+        """
+        Aprova e expira cobranças em uma única transação. Retorna os dados das que
+        foram efetivamente aprovadas agora (as já aprovadas antes são ignoradas).
+        """
+        def escrita(cursor):
+            aprovados = [p for p in (self._aprovar_no_cursor(cursor, txid) for txid in aprovar) if p]
+            cursor.executemany("UPDATE pagamentos SET status = ? WHERE txid = ? AND status = ?",
+                               [('expirada', txid, 'pendente') for txid in expirar])
+            return aprovados
+        return await self._escrever(escrita)
+
+    # --- Assinaturas ---
+    async def assinaturas_vencidas(self, agora: int, limite: int) -> list:
+        """user_ids das assinaturas ativas já vencidas, das mais antigas para as mais novas."""
+        def consulta(conn, agora, limite):
+            return [linha[0] for linha in conn.execute(
+                "SELECT user_id FROM assinaturas WHERE status = 'ativa' AND expira_em <= ? ORDER BY expira_em LIMIT ?",
+                (agora, limite)
+            )]
+        return await self._ler(consulta, agora, limite)
+
+    async def marcar_expiradas(self, user_ids: list, agora: int):
+        """Expira as assinaturas, exceto as renovadas depois da consulta."""
+        def escrita(cursor):
+            cursor.executemany(
+                "UPDATE assinaturas SET status = 'expirada' WHERE user_id = ? AND status = 'ativa' AND expira_em <= ?",
+                [(user_id, agora) for user_id in user_ids]
+            )
+        await self._escrever(escrita)
+
+    async def lembretes_pendentes(self, ate: int, limite: int) -> list:
+        """[(user_id, expira_em)] das assinaturas que vencem até `ate` e ainda não foram lembradas."""
+        def consulta(conn, ate, limite):
+            return conn.execute(
+                "SELECT user_id, expira_em FROM assinaturas WHERE status = 'ativa' AND lembrete_enviado = 0 AND expira_em <= ? "
+                "ORDER BY expira_em LIMIT ?",
+                (ate, limite)
+            ).fetchall()
+        return await self._ler(consulta, ate, limite)
+
+    async def marcar_lembretes_enviados(self, user_ids: list):
+        def escrita(cursor):
+            cursor.executemany("UPDATE assinaturas SET lembrete_enviado = 1 WHERE user_id = ?", [(u,) for u in user_ids])
+        await self._escrever(escrita)
+
+    # --- Transmissões ---
+    # Paginação por chave (user_id > último enviado), sempre por índice: nenhuma
+    # página relê as anteriores e o público nunca é carregado inteiro na memória.
+    CONSULTAS_PUBLICO = {
+        'assinantes': "SELECT user_id FROM assinaturas WHERE status = 'ativa' AND user_id > ? ORDER BY user_id LIMIT ?",
+        'clientes': "SELECT user_id FROM assinaturas WHERE user_id > ? ORDER BY user_id LIMIT ?",
+        'todos': "SELECT DISTINCT user_id FROM pagamentos WHERE user_id > ? ORDER BY user_id LIMIT ?",
+    }
+
+    async def destinatarios(self, publico: str, apos_user_id: int, limite: int) -> list:
+        """Próxima página de user_ids do público, em ordem crescente, depois de `apos_user_id`."""
+        def consulta(conn, sql, apos_user_id, limite):
+            return [linha[0] for linha in conn.execute(sql, (apos_user_id, limite))]
+        return await self._ler(consulta, self.CONSULTAS_PUBLICO[publico], apos_user_id, limite)
+
+    async def criar_transmissao(self, admin_id: int, publico: str, texto: str) -> int:
+        def escrita(cursor):
+            cursor.execute("INSERT INTO transmissoes (admin_id, publico, texto, criada_em) VALUES (?, ?, ?, ?)",
+                           (admin_id, publico, texto, int(time.time())))
+            return cursor.lastrowid
+        return await self._escrever(escrita)
+
+    async def transmissoes_em_andamento(self) -> list:
+        """Transmissões não concluídas, como dicionários, da mais antiga para a mais nova."""
+        def consulta(conn):
+            cursor = conn.execute(
+                "SELECT id, admin_id, publico, texto, ultimo_user_id, enviados, bloqueados, falhas, criada_em "
+                "FROM transmissoes WHERE status = 'em_andamento' ORDER BY id"
+            )
+            colunas = [coluna[0] for coluna in cursor.description]
+            return [dict(zip(colunas, linha)) for linha in cursor]
+        return await self._ler(consulta)
+
+    async def salvar_progresso_transmissao(self, transmissao: dict, status: str = 'em_andamento'):
+        def escrita(cursor):
+            cursor.execute(
+                "UPDATE transmissoes SET ultimo_user_id = ?, enviados = ?, bloqueados = ?, falhas = ?, status = ?, "
+                "concluida_em = CASE WHEN ? = 'em_andamento' THEN NULL ELSE ? END WHERE id = ?",
+                (transmissao['ultimo_user_id'], transmissao['enviados'], transmissao['bloqueados'], transmissao['falhas'],
+                 status, status, int(time.time()), transmissao['id'])
+            )
+        await self._escrever(escrita)
+
+    # --- Notificações (outbox) ---
+    async def enfileirar_notificacoes(self, chat_ids, texto: str, parse_mode: str | None = None):
+        def escrita(cursor, agora):
+            cursor.executemany(
+                "INSERT INTO notificacoes (chat_id, texto, parse_mode, proxima_tentativa, criada_em) VALUES (?, ?, ?, ?, ?)",
+                [(chat_id, texto, parse_mode, agora, agora) for chat_id in chat_ids]
+            )
+        await self._escrever(escrita, int(time.time()))
+
+    async def notificacoes_prontas(self, agora: int, limite: int) -> list:
+        """
+        [(id, chat_id, texto, parse_mode, tentativas)] das notificações pendentes cujo
+        horário já chegou. Elas ficam reservadas (próxima tentativa adiada em
+        NOTIFICACOES_RESERVA) para que outro processo não as envie de novo; se este
+        cair no meio do envio, a reserva vence e a notificação volta para a fila.
+        """
+        def escrita(cursor, agora, limite):
+            return cursor.execute(
+                "UPDATE notificacoes SET proxima_tentativa = ? WHERE id IN ("
+                "SELECT id FROM notificacoes WHERE status = 'pendente' AND proxima_tentativa <= ? "
+                "ORDER BY proxima_tentativa, id LIMIT ?) "
+                "RETURNING id, chat_id, texto, parse_mode, tentativas",
+                (agora + NOTIFICACOES_RESERVA, agora, limite)
+            ).fetchall()
+        return await self._escrever(escrita, agora, limite)
+
+    async def proxima_notificacao(self) -> int | None:
+        """Horário (Unix) da próxima tentativa agendada, ou None se o outbox estiver vazio."""
+        def consulta(conn):
+            return conn.execute("SELECT MIN(proxima_tentativa) FROM notificacoes WHERE status = 'pendente'").fetchone()[0]
+        return await self._ler(consulta)
+
+    async def registrar_entregas(self, entregues: list, reagendadas: list, falhas: list):
+        """
+        Grava o resultado de uma rodada do despachante: apaga as entregues, reagenda
+        [(id, tentativas, proxima_tentativa, erro)] e marca [(id, erro)] como 'falhou'.
+        """
+        def escrita(cursor):
+            cursor.executemany("DELETE FROM notificacoes WHERE id = ?", [(i,) for i in entregues])
+            cursor.executemany("UPDATE notificacoes SET tentativas = ?, proxima_tentativa = ?, erro = ? WHERE id = ?",
+                               [(tentativas, proxima, erro, i) for i, tentativas, proxima, erro in reagendadas])
+            cursor.executemany("UPDATE notificacoes SET status = 'falhou', tentativas = tentativas + 1, erro = ? WHERE id = ?",
+                               [(erro, i) for i, erro in falhas])
+        await self._escrever(escrita)
+
+    # --- Checkouts adiados ---
+    async def adiar_checkout(self, user_id: int, username: str, tipo_plano: str, valor_centavos: int):
+        """Guarda o pedido do usuário na fila; um pedido anterior ainda na fila é substituído."""
+        def escrita(cursor, agora):
+            cursor.execute(
+                "INSERT INTO checkouts_adiados (user_id, username, tipo_plano, valor_centavos, criado_em, proxima_tentativa) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, "
+                "tipo_plano = excluded.tipo_plano, valor_centavos = excluded.valor_centavos, criado_em = excluded.criado_em, "
+                "tentativas = 0, proxima_tentativa = excluded.proxima_tentativa",
+                (user_id, username, tipo_plano, valor_centavos, agora, agora)
+            )
+        await self._escrever(escrita, int(time.time()))
+
+    async def checkouts_adiados_prontos(self, agora: int, limite: int) -> list:
+        """
+        [(user_id, username, tipo_plano, valor_centavos, criado_em, tentativas)] prontos
+        para nova tentativa, reservados por CHECKOUT_ADIADO_RESERVA (como as notificações).
+        """
+        def escrita(cursor, agora, limite):
+            return cursor.execute(
+                "UPDATE checkouts_adiados SET proxima_tentativa = ? WHERE user_id IN ("
+                "SELECT user_id FROM checkouts_adiados WHERE proxima_tentativa <= ? "
+                "ORDER BY proxima_tentativa, criado_em LIMIT ?) "
+                "RETURNING user_id, username, tipo_plano, valor_centavos, criado_em, tentativas",
+                (agora + CHECKOUT_ADIADO_RESERVA, agora, limite)
+            ).fetchall()
+        return await self._escrever(escrita, agora, limite)
+
+    async def reagendar_checkout(self, user_id: int, criado_em: int, tentativas: int, proxima_tentativa: int):
+        def escrita(cursor):
+            cursor.execute("UPDATE checkouts_adiados SET tentativas = ?, proxima_tentativa = ? WHERE user_id = ? AND criado_em = ?",
+                           (tentativas, proxima_tentativa, user_id, criado_em))
+        await self._escrever(escrita)
+
+    async def remover_checkout(self, user_id: int, criado_em: int | None = None):
+        """Tira o pedido da fila; com `criado_em`, só se ele não foi substituído por um mais novo."""
+        def escrita(cursor):
+            if criado_em is None:
+                cursor.execute("DELETE FROM checkouts_adiados WHERE user_id = ?", (user_id,))
+            else:
+                cursor.execute("DELETE FROM checkouts_adiados WHERE user_id = ? AND criado_em = ?", (user_id, criado_em))
+        await self._escrever(escrita)
+
+    async def cobranca_pendente_desde(self, user_id: int, desde: int) -> bool:
+        """Se o usuário tem cobrança pendente criada a partir de `desde` (ex.: gerada depois que a Efí voltou)."""
+        def consulta(conn, user_id, desde):
+            return conn.execute(
+                "SELECT 1 FROM pagamentos WHERE user_id = ? AND status = 'pendente' AND data_criacao >= ? LIMIT 1",
+                (user_id, desde)
+            ).fetchone() is not None
+        return await self._ler(consulta, user_id, desde)
+
+    async def checkouts_adiados(self) -> int:
+        def consulta(conn):
+            return conn.execute("SELECT COUNT(*) FROM checkouts_adiados").fetchone()[0]
+        return await self._ler(consulta)
+
+    # --- Relatórios ---
+    async def vendas_por_dia(self, desde_dia: str) -> list:
+        """
+        [(dia, tipo_plano, cobrancas, aprovadas, receita_centavos, segundos_ate_aprovar)]
+        a partir de `desde_dia` ('AAAA-MM-DD', horário de Brasília). Lê só os agregados
+        de vendas_diarias: o custo depende do número de dias, não de pagamentos.
+        """
+        def consulta(conn, desde_dia):
+            return conn.execute(
+                "SELECT dia, tipo_plano, cobrancas, aprovadas, receita_centavos, segundos_ate_aprovar "
+                "FROM vendas_diarias WHERE dia >= ? ORDER BY dia, tipo_plano",
+                (desde_dia,)
+            ).fetchall()
+        return await self._ler(consulta, desde_dia)
+
+    COLUNAS_EXPORTACAO = ("txid", "user_id", "username", "status", "tipo_plano", "valor_centavos",
+                          "data_criacao", "data_aprovacao", "expira_em")
+    _DATA_ISO = "strftime('%Y-%m-%dT%H:%M:%S-03:00', {}, 'unixepoch', '-3 hours')"
+
+    async def paginas_pagamentos(self, desde: int, tamanho: int):
+        """
+        Gera páginas de `pagamentos` criados a partir de `desde` (Unix), na ordem de
+        inserção, com as datas já em ISO 8601 no horário de Brasília. Cada página é uma
+        consulta por chave (rowid > último lido), então a memória fica limitada a uma
+        página e nenhuma conexão do pool fica presa entre elas.
+        """
+        colunas = ", ".join(self._DATA_ISO.format(coluna) if coluna in ("data_criacao", "data_aprovacao", "expira_em") else coluna
+                            for coluna in self.COLUNAS_EXPORTACAO)
+
+        def consulta(conn, apos, desde, tamanho):
+            return conn.execute(
+                f"SELECT rowid, {colunas} FROM pagamentos "
+                "WHERE rowid > ? AND data_criacao >= ? ORDER BY rowid LIMIT ?",
+                (apos, desde, tamanho)
+            ).fetchall()
+        apos = 0
+        while True:
+            pagina = await self._ler(consulta, apos, desde, tamanho)
+            if not pagina:
+                return
+            apos = pagina[-1][0]
+            yield [linha[1:] for linha in pagina]
+            if len(pagina) < tamanho:
+                return
+
+    # --- Persistência de user_data ---
+    async def carregar_dados_usuario(self, user_id: int):
+        """Retorna o user_data serializado do usuário, ou None."""
+        def consulta(conn, user_id):
+            linha = conn.execute("SELECT dados FROM persistencia_usuarios WHERE user_id = ?", (user_id,)).fetchone()
+            return linha[0] if linha else None
+        return await self._ler(consulta, user_id)
+
+    async def salvar_dados_usuario(self, user_id: int, dados: bytes):
+        def escrita(cursor):
+            cursor.execute(
+                "INSERT INTO persistencia_usuarios (user_id, dados, atualizado_em) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET dados = excluded.dados, atualizado_em = excluded.atualizado_em",
+                (user_id, dados, int(time.time()))
+            )
+        await self._escrever(escrita)
+
+    async def apagar_dados_usuario(self, user_id: int):
+        def escrita(cursor):
+            cursor.execute("DELETE FROM persistencia_usuarios WHERE user_id = ?", (user_id,))
+        await self._escrever(escrita)
+
+    async def apagar_dados_ociosos(self, limite: int, total: int = 1, indice: int = 0) -> list:
+        """
+        Apaga o user_data de quem não foi atualizado desde `limite` (Unix timestamp),
+        só dos usuários do worker `indice` de `total`, e retorna os user_ids apagados.
+        """
+        def escrita(cursor):
+            cursor.execute(
+                "DELETE FROM persistencia_usuarios WHERE atualizado_em < ? AND user_id % ? = ? RETURNING user_id",
+                (limite, total, indice)
+            )
+            return [linha[0] for linha in cursor.fetchall()]
+        return await self._escrever(escrita)
+
+
+repositorio = RepositorioPagamentos()
+
+# -----------------------------------------------------------------------------
+# 👤 SESSÃO DO USUÁRIO (context.user_data)
+# -----------------------------------------------------------------------------
+class Plano(enum.Enum):
+    MENSAL = 'mensal'
+    TRIMESTRAL = 'trimestral'
+
+    @property
+    def valor_centavos(self) -> int:
+        return para_centavos(PRECOS_POR_PLANO[self.value])
+
+
+class SessaoUsuario:
+    """
+    Estado de navegação de um usuário, usado como `context.user_data` (via
+    ContextTypes). Com __slots__, cada sessão ocupa uma fração de um dict com
+    datetime e dicts aninhados, o que importa com dezenas de milhares de usuários
+    em memória.
+
+    `ultima_atividade` é time.monotonic() e `pix_message_id` só vale enquanto o bot
+    está no ar; apenas o plano escolhido e o preço vão para a persistência.
+    """
+    __slots__ = ('plano', 'valor_centavos', 'ultima_atividade', 'pix_message_id')
+
+    def __init__(self):
+        self.plano: Plano | None = None
+        self.valor_centavos = 0
+        self.ultima_atividade = float('-inf')  # Sessão nova conta como inativa até a primeira interação
+        self.pix_message_id: int | None = None
+
+    def registrar_atividade(self):
+        self.ultima_atividade = time.monotonic()
+
+    def inativa_ha(self) -> float:
+        return time.monotonic() - self.ultima_atividade
+
+    def escolher_plano(self, plano: Plano):
+        self.plano = plano
+        self.valor_centavos = plano.valor_centavos
+
+    def limpar(self):
+        """Volta ao estado inicial, mantendo o registro de atividade."""
+        self.plano = None
+        self.valor_centavos = 0
+        self.pix_message_id = None
+
+    def persistente(self) -> tuple | None:
+        """Parte que sobrevive a reinícios: (plano, valor em centavos), ou None se não há plano."""
+        return (self.plano.value, self.valor_centavos) if self.plano else None
+
+    def restaurar(self, dados):
+        """
+        Recarrega o que foi salvo por `persistente()`. Aceita também o formato antigo
+        ({'plano_escolhido': {'tipo': ..., 'valor': ...}}), usado pela migração 10 ao
+        importar o PicklePersistence e pelos registros gravados antes da troca para
+        sessões compactas.
+        """
+        if isinstance(dados, dict):
+            antigo = dados.get('plano_escolhido')
+            dados = (antigo['tipo'], para_centavos(antigo['valor'])) if antigo else None
+        if dados and self.plano is None:
+            self.plano, self.valor_centavos = Plano(dados[0]), dados[1]
+
+
+# -----------------------------------------------------------------------------
+# 💾 PERSISTÊNCIA INCREMENTAL DO user_data
+# -----------------------------------------------------------------------------
+class PersistenciaSQLite(BasePersistence):
+    """
+    Persistência do PTB guardada no próprio banco de pagamentos, apenas para user_data.
+
+    Nada é carregado na inicialização: os dados de um usuário são lidos na primeira
+    atualização dele (`refresh_user_data`). Cada gravação escreve só os usuários que
+    mudaram, apenas a parte persistente da SessaoUsuario, e pula quem não mudou desde
+    a última vez. Inicializar e gravar custam o mesmo com cem ou cem mil usuários.
+    """
+
+    def __init__(self, repositorio: RepositorioPagamentos, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.repositorio = repositorio
+        self._carregados = set()
+        self._assinaturas = {}  # user_id -> hash do último conteúdo gravado
+
+    def _serializar(self, sessao: SessaoUsuario) -> bytes | None:
+        persistente = sessao.persistente()
+        return pickle.dumps(persistente, protocol=pickle.HIGHEST_PROTOCOL) if persistente else None
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: SessaoUsuario) -> None:
+        if user_id in self._carregados:
+            return
+        self._carregados.add(user_id)
+        dados = await self.repositorio.carregar_dados_usuario(user_id)
+        if dados:
+            self._assinaturas[user_id] = hash(dados)
+            user_data.restaurar(pickle.loads(dados))
+
+    async def update_user_data(self, user_id: int, data: SessaoUsuario) -> None:
+        dados = self._serializar(data)
+        assinatura = hash(dados) if dados else None
+        if self._assinaturas.get(user_id) == assinatura:
+            return
+        if dados:
+            await self.repositorio.salvar_dados_usuario(user_id, dados)
+            self._assinaturas[user_id] = assinatura
+        else:
+            await self.repositorio.apagar_dados_usuario(user_id)
+            self._assinaturas.pop(user_id, None)
+
+    async def regravar_user_data(self, user_id: int, data: SessaoUsuario) -> None:
+        """Grava de novo o user_data mesmo sem mudança, para quem teve a linha apagada por fora."""
+        self._assinaturas.pop(user_id, None)
+        await self.update_user_data(user_id, data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._carregados.discard(user_id)
+        self._assinaturas.pop(user_id, None)
+        await self.repositorio.apagar_dados_usuario(user_id)
+
+    async def flush(self) -> None:
+        # Cada gravação já foi confirmada pela tarefa escritora do repositório.
+        pass
+
+    # --- Dados não usados pelo bot ---
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+async def limpar_sessoes_ociosas(context: ContextTypes.DEFAULT_TYPE):
+    """Job periódico: descarta a sessão de quem está parado há mais de SESSAO_TTL."""
+    application = context.application
+    ociosos = [user_id for user_id, sessao in application.user_data.items() if sessao.inativa_ha() > SESSAO_TTL]
+    for user_id in ociosos:
+        application.drop_user_data(user_id)
+    # Usuários que não voltaram desde o último restart nem chegaram a ser carregados. Só os
+    # deste worker: os de outro podem estar ativos lá, e só ele consegue regravá-los.
+    apagados = await repositorio.apagar_dados_ociosos(int(time.time()) - SESSAO_TTL, WORKER_TOTAL, WORKER_INDICE)
+    # Quem ainda está ativo em memória só tinha a linha antiga porque a sessão não mudou
+    # desde a última gravação: grava de novo, senão ela se perderia no próximo restart.
+    ativos = [user_id for user_id in apagados if user_id in application.user_data]
+    for user_id in ativos:
+        await application.persistence.regravar_user_data(user_id, application.user_data[user_id])
+    if ociosos or len(apagados) > len(ativos):
+        logger.info(f"Sessões ociosas descartadas: {len(ociosos)} em memória, {len(apagados) - len(ativos)} no banco.")
 
-        if len(escaped_log_entry) > 4000:
-            escaped_log_entry = escaped_log_entry[:4000] + "\n\n[LOG TRUNCADO POR SER MUITO LONGO]"
+# -----------------------------------------------------------------------------
+# 🏦 GATEWAY ASSÍNCRONO DA EFÍ
+# -----------------------------------------------------------------------------
+class ErroGatewayEfi(Exception):
+    """Resposta inválida ou erro retornado (e não levantado) pelo SDK da Efí."""
+
+
+class DisjuntorAberto(ErroGatewayEfi):
+    """A Efí está fora: o disjuntor do endpoint está aberto e a chamada nem foi feita."""
+
+
+class Disjuntor:
+    """
+    Disjuntor (circuit breaker) de um endpoint da Efí.
+
+    - fechado: as chamadas passam; `limite_falhas` falhas seguidas (exceção, 5xx,
+      timeout ou resposta mais lenta que `lentidao`) abrem o disjuntor;
+    - aberto: as chamadas falham na hora com DisjuntorAberto, sem tocar na rede,
+      por `espera` segundos ±20% (o sorteio evita que endpoints e processos
+      voltem a bater na Efí todos no mesmo instante);
+    - meio-aberto: passa uma única chamada de sondagem; sucesso fecha, falha reabre.
+
+    Cada transição vai para o log, para `efi_disjuntor_transicoes_total` e para o
+    medidor `efi_disjuntor_estado` (0 fechado, 1 meio-aberto, 2 aberto).
+    """
+    FECHADO, MEIO_ABERTO, ABERTO = "fechado", "meio_aberto", "aberto"
+    CODIGOS = {FECHADO: 0, MEIO_ABERTO: 1, ABERTO: 2}
+
+    def __init__(self, endpoint: str, limite_falhas: int = DISJUNTOR_FALHAS, lentidao: float = DISJUNTOR_LENTIDAO,
+                 espera: float = DISJUNTOR_ESPERA):
+        self.endpoint = endpoint
+        self.limite_falhas = limite_falhas
+        self.lentidao = lentidao
+        self.espera = espera
+        self.estado = self.FECHADO
+        self.falhas_seguidas = 0
+        self.historico = collections.deque(maxlen=100)  # (time.time(), estado)
+        self._reabre_em = 0.0
+        self._sondando = False
+
+    def _mudar(self, estado: str):
+        self.estado = estado
+        self.historico.append((time.time(), estado))
+        rotulos = (("endpoint", self.endpoint),)
+        metricas.incrementar("efi_disjuntor_transicoes_total", rotulos + (("estado", estado),))
+        metricas.definir("efi_disjuntor_estado", rotulos, self.CODIGOS[estado])
+        registrar = logger.info if estado == self.FECHADO else logger.warning
+        registrar(f"Disjuntor da Efí '{self.endpoint}': {estado} (falhas seguidas: {self.falhas_seguidas}).")
+
+    def _abrir(self):
+        self._reabre_em = time.monotonic() + self.espera * random.uniform(0.8, 1.2)
+        self._mudar(self.ABERTO)
+
+    def disponivel(self) -> bool:
+        """Se uma chamada agora passaria (sem consumir a vaga de sondagem)."""
+        if self.estado == self.FECHADO:
+            return True
+        if self.estado == self.ABERTO:
+            return time.monotonic() >= self._reabre_em
+        return not self._sondando
+
+    def permitir(self) -> str | None:
+        """"normal", "sondagem" ou None (bloqueada). Toda chamada permitida deve terminar em `registrar`."""
+        if self.estado == self.FECHADO:
+            return "normal"
+        if self.estado == self.ABERTO:
+            if time.monotonic() < self._reabre_em:
+                return None
+            self._mudar(self.MEIO_ABERTO)
+        if self._sondando:
+            return None
+        self._sondando = True
+        return "sondagem"
+
+    def registrar(self, sucesso: bool | None, modo: str):
+        """Resultado de uma chamada permitida; None quando ela foi cancelada sem resposta (não conta)."""
+        if modo == "sondagem":
+            self._sondando = False
+            if sucesso:
+                self.falhas_seguidas = 0
+                self._mudar(self.FECHADO)
+            elif sucesso is False:
+                self.falhas_seguidas += 1
+                self._abrir()
+            return
+        # Respostas atrasadas de chamadas feitas antes da abertura não mudam o estado: a sondagem decide.
+        if sucesso is None or self.estado != self.FECHADO:
+            return
+        if sucesso:
+            self.falhas_seguidas = 0
+            return
+        self.falhas_seguidas += 1
+        if self.falhas_seguidas >= self.limite_falhas:
+            self._abrir()
+
+
+class CacheCobrancas:
+    """
+    Cache LRU das consultas de cobrança por txid, com coalescência (single-flight):
+    consultas simultâneas do mesmo txid compartilham uma única chamada à Efí.
 
+    Status finais nunca mudam e ficam guardados até serem expulsos pelo LRU; os
+    demais (ATIVA) valem só `ttl` segundos, para que o pagamento apareça logo.
+    Erros não são guardados.
+    """
+    STATUS_FINAIS = frozenset({'CONCLUIDA', 'REMOVIDA_PELO_USUARIO_RECEBEDOR', 'REMOVIDA_PELO_PSP'})
+
+    def __init__(self, tamanho: int = 10000, ttl: float = 5):
+        self.tamanho = tamanho
+        self.ttl = ttl
+        self.acertos = 0
+        self.falhas = 0
+        self.coalescidas = 0
+        self._itens = collections.OrderedDict()  # txid -> (resposta, válida até (monotonic) ou None)
+        self._em_andamento = {}                  # txid -> asyncio.Task da consulta em curso
+
+    def _consultar(self, txid: str) -> dict | None:
+        item = self._itens.get(txid)
+        if item is None:
+            return None
+        resposta, valida_ate = item
+        if valida_ate is not None and time.monotonic() >= valida_ate:
+            del self._itens[txid]
+            return None
+        self._itens.move_to_end(txid)
+        return resposta
+
+    def registrar(self, txid: str, resposta: dict):
+        """Guarda a resposta de uma consulta (ou de uma listagem) da cobrança."""
+        valida_ate = None if resposta.get('status') in self.STATUS_FINAIS else time.monotonic() + self.ttl
+        self._itens[txid] = (resposta, valida_ate)
+        self._itens.move_to_end(txid)
+        while len(self._itens) > self.tamanho:
+            self._itens.popitem(last=False)
+
+    async def obter(self, txid: str, buscar) -> dict:
+        """Devolve a resposta guardada ou espera `buscar()`, iniciada uma única vez por txid."""
+        resposta = self._consultar(txid)
+        if resposta is not None:
+            self.acertos += 1
+            return resposta
+        tarefa = self._em_andamento.get(txid)
+        if tarefa is None:
+            self.falhas += 1
+            tarefa = self._em_andamento[txid] = asyncio.ensure_future(self._buscar(txid, buscar))
+        else:
+            self.coalescidas += 1
+        # shield: se quem iniciou a consulta for cancelado, os demais continuam esperando por ela.
+        return await asyncio.shield(tarefa)
+
+    async def _buscar(self, txid: str, buscar) -> dict:
         try:
-            loop = asyncio.get_running_loop()
-            loop.create_task(self.bot.send_message(
-                chat_id=self.chat_id,
-                text=f"<pre>{escaped_log_entry}</pre>",
-                parse_mode=constants.ParseMode.HTML
-            ))
-        except (RuntimeError, Exception) as e:
-            print(f"ERRO INESPERADO no handler de log do Telegram: {e}")
+            resposta = await buscar()
+            self.registrar(txid, resposta)
+            return resposta
+        finally:
+            del self._em_andamento[txid]
+
+    def resumo(self) -> str:
+        total = self.acertos + self.falhas + self.coalescidas
+        taxa = (self.acertos + self.coalescidas) / total if total else 0
+        return (f"{self.acertos} acerto(s), {self.coalescidas} coalescida(s), {self.falhas} falha(s) "
+                f"({taxa:.0%} sem chamar a Efí), {len(self._itens)} item(ns)")
+
+
+def criar_cliente_efi():
+    """
+    Monta o cliente do SDK da Efí com as credenciais de senhas.py. O SDK (e o
+    `requests` por baixo dele) só é importado aqui, para que importar o bot seja rápido.
+    """
+    from efipay import EfiPay
+    return EfiPay({
+        'client_id': EFI_CLIENT_ID,
+        'client_secret': EFI_CLIENT_SECRET,
+        'sandbox': not EFI_PRODUCAO,
+        'certificate': EFI_CERTIFICATE_PATH
+    })
+
+
+class TransporteSdkEfi:
+    """
+    Transporte pelo SDK oficial (`efipay`), que usa `requests` sem sessão: cada
+    chamada abre uma conexão mTLS nova e bloqueia a thread durante todo o round-trip.
+    Por isso as chamadas rodam em um pool de threads limitado. Se o handler for
+    cancelado ou estourar o timeout, a thread termina a requisição em segundo plano.
+
+    Sem `cliente`, ele é criado por `criar_cliente_efi()` na primeira necessidade.
+    """
+    def __init__(self, cliente=None, max_threads: int = EFI_MAX_THREADS):
+        self.cliente = cliente
+        self._executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="efi")
+        self._trava_cliente = threading.Lock()
+
+    def _obter_cliente(self):
+        """Roda nas threads do pool: cria o cliente uma única vez, mesmo com chamadas simultâneas."""
+        if self.cliente is None:
+            with self._trava_cliente:
+                if self.cliente is None:
+                    self.cliente = criar_cliente_efi()
+        return self.cliente
+
+    def _executar(self, endpoint: str, kwargs: dict):
+        return getattr(self._obter_cliente(), endpoint)(**kwargs)
+
+    def _aquecer(self):
+        """Cria o cliente e busca o token OAuth, que o SDK guarda para as próximas chamadas."""
+        cliente = self._obter_cliente()
+        getattr(cliente, 'pix_detail_charge')  # o SDK só sabe a rota do token depois de resolver um endpoint PIX
+        codigo = cliente.authenticate()
+        if codigo == 404:  # o SDK devolve 404 quando o arquivo do certificado não existe
+            raise ErroGatewayEfi(f"Certificado da Efí não encontrado em '{EFI_CERTIFICATE_PATH}'.")
+        if codigo != 200:
+            raise ErroGatewayEfi(f"Não foi possível obter o token da Efí (HTTP {codigo}).")
+
+    async def preparar(self):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._aquecer)
+
+    async def chamar(self, endpoint: str, **kwargs):
+        metodo = functools.partial(self._executar, endpoint, kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, metodo)
+
+    async def fechar(self):
+        """Libera as threads do pool sem esperar requisições penduradas."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class TransporteEfi:
+    """
+    Transporte HTTP próprio para a API PIX da Efí, no lugar do SDK:
+
+    - um pool de conexões mTLS keep-alive (httpx) compartilhado por todas as
+      chamadas: o certificado é carregado uma vez e o handshake TLS acontece uma
+      vez por conexão, não por chamada;
+    - o token OAuth fica em cache até `margem` segundos antes de expirar. A partir
+      daí ele é renovado em segundo plano (as chamadas seguem com o token atual),
+      e só uma requisição de token fica em voo, mesmo com muitas chamadas juntas.
+
+    Como o SDK, devolve o JSON da resposta, inclusive o das respostas de erro 4xx, e
+    repete a chamada uma vez com token novo se a Efí responder 401. Respostas 5xx e
+    429 levantam ErroGatewayEfi, para contarem como falha no disjuntor.
+    """
+    URLS = {True: "https://pix.api.efipay.com.br", False: "https://pix-h.api.efipay.com.br"}
+    ROTAS = {
+        'pix_create_immediate_charge': ('POST', '/v2/cob'),
+        'pix_detail_charge': ('GET', '/v2/cob/:txid'),
+        'pix_list_charges': ('GET', '/v2/cob'),
+        'pix_generate_qrcode': ('GET', '/v2/loc/:id/qrcode'),
+    }
+
+    def __init__(self, url: str | None = None, certificado: str | None = EFI_CERTIFICATE_PATH,
+                 client_id: str = EFI_CLIENT_ID, client_secret: str = EFI_CLIENT_SECRET,
+                 conexoes: int = EFI_CONEXOES, margem: float = EFI_TOKEN_MARGEM, ca: str | None = None):
+        self.url = url or self.URLS[bool(EFI_PRODUCAO)]
+        self.certificado = certificado
+        self.ca = ca                      # CA para validar o servidor (None: as do sistema)
+        self.margem = margem
+        self.renovacoes = 0
+        self._credenciais = (client_id, client_secret)
+        self._conexoes = conexoes
+        self._cliente: httpx.AsyncClient | None = None
+        self._token: str | None = None
+        self._expira_em = 0.0             # time.monotonic()
+        self._renovacao: asyncio.Task | None = None
+
+    def _cliente_http(self) -> httpx.AsyncClient:
+        if self._cliente is None:
+            contexto = ssl.create_default_context(cafile=self.ca)
+            if self.certificado:
+                contexto.load_cert_chain(self.certificado)
+            self._cliente = httpx.AsyncClient(
+                base_url=self.url, verify=contexto, timeout=EFI_TIMEOUT,
+                limits=httpx.Limits(max_connections=self._conexoes, max_keepalive_connections=self._conexoes)
+            )
+        return self._cliente
+
+    async def _buscar_token(self):
+        resposta = await self._cliente_http().post("/oauth/token", json={"grant_type": "client_credentials"},
+                                                   auth=self._credenciais)
+        if resposta.status_code != 200:
+            raise ErroGatewayEfi(f"Não foi possível obter o token da Efí (HTTP {resposta.status_code}): {resposta.text[:200]}")
+        dados = resposta.json()
+        self._token = dados['access_token']
+        self._expira_em = time.monotonic() + dados.get('expires_in', 3600)
+        self.renovacoes += 1
+        metricas.incrementar("efi_token_renovacoes_total")
+
+    @staticmethod
+    def _registrar_falha_renovacao(tarefa: asyncio.Task):
+        if not tarefa.cancelled() and tarefa.exception():
+            logger.error(f"Falha ao renovar o token da Efí: {tarefa.exception()}")
+
+    def _renovar(self) -> asyncio.Task:
+        """Uma única renovação em voo; quem chega enquanto ela corre espera a mesma tarefa."""
+        if self._renovacao is None or self._renovacao.done():
+            self._renovacao = asyncio.create_task(self._buscar_token())
+            self._renovacao.add_done_callback(self._registrar_falha_renovacao)
+        return self._renovacao
+
+    async def _obter_token(self, recusado: str | None = None) -> str:
+        restante = self._expira_em - time.monotonic()
+        if self._token is None or restante <= 0 or self._token == recusado:
+            # shield: uma chamada cancelada (timeout) não derruba a renovação das outras
+            await asyncio.shield(self._renovar())
+        elif restante < self.margem:
+            self._renovar()
+        return self._token
+
+    async def preparar(self):
+        await self._obter_token()
+
+    async def chamar(self, endpoint: str, params: dict | None = None, body: dict | None = None,
+                     headers: dict | None = None):
+        if endpoint not in self.ROTAS:
+            raise ErroGatewayEfi(f"Endpoint '{endpoint}' não suportado pelo transporte HTTP.")
+        metodo, rota = self.ROTAS[endpoint]
+        params = dict(params or {})
+        rota = re.sub(r':(\w+)', lambda m: str(params.pop(m.group(1))), rota)
+        token = await self._obter_token()
+        for tentativa in range(2):
+            resposta = await self._cliente_http().request(
+                metodo, rota, params=params or None, json=body,
+                headers={"Authorization": f"Bearer {token}", **(headers or {})}
+            )
+            if resposta.status_code != 401 or tentativa:
+                break
+            token = await self._obter_token(recusado=token)
+        if resposta.status_code >= 500 or resposta.status_code == 429:
+            raise ErroGatewayEfi(f"HTTP {resposta.status_code} em '{endpoint}': {resposta.text[:200]}")
+        try:
+            return resposta.json()
+        except ValueError:
+            return f"HTTP {resposta.status_code}: {resposta.text[:200]}"
+
+    async def fechar(self):
+        if self._renovacao and not self._renovacao.done():
+            self._renovacao.cancel()
+        if self._cliente is not None:
+            await self._cliente.aclose()
+            self._cliente = None
+
+
+def criar_transporte_efi():
+    return TransporteEfi() if EFI_TRANSPORTE == "http" else TransporteSdkEfi()
+
+
+class GatewayEfi:
+    """
+    Camada assíncrona sobre o transporte da Efí (`TransporteEfi` ou `TransporteSdkEfi`).
+
+    Cada chamada passa por um semáforo por endpoint e tem timeout, para que um pico
+    de cliques não abra conexões sem limite nem deixe handlers esperando para sempre.
+    Cada endpoint tem seu Disjuntor: com a Efí fora, as chamadas falham na hora em
+    vez de esperar o timeout. As consultas (GET) são repetidas em erros temporários,
+    com espera sorteada; a criação de cobrança não, porque repetir criaria duas.
+    As consultas de cobrança por txid passam pelo `cache` (CacheCobrancas).
+    """
+    IDEMPOTENTES = frozenset({'pix_detail_charge', 'pix_list_charges', 'pix_generate_qrcode'})
+    CRIACAO = ('pix_create_immediate_charge', 'pix_generate_qrcode')  # chamadas de criar_pagamento_efi
+
+    def __init__(self, transporte=None, limite_por_endpoint: int = EFI_LIMITE_POR_ENDPOINT,
+                 timeout: float = EFI_TIMEOUT, cache: CacheCobrancas | None = None,
+                 tentativas: int = EFI_TENTATIVAS, backoff: float = EFI_TENTATIVA_BACKOFF, fabrica_disjuntor=Disjuntor):
+        self.transporte = transporte or criar_transporte_efi()
+        self.timeout = timeout
+        self.cache = cache or CacheCobrancas(EFI_CACHE_TAMANHO, EFI_CACHE_TTL)
+        self.tentativas = tentativas
+        self.backoff = backoff
+        self._limite_por_endpoint = limite_por_endpoint
+        self._semaforos = {}
+        self._fabrica_disjuntor = fabrica_disjuntor
+        self.disjuntores = {}
+
+    def disjuntor(self, endpoint: str) -> Disjuntor:
+        disjuntor = self.disjuntores.get(endpoint)
+        if disjuntor is None:
+            disjuntor = self.disjuntores[endpoint] = self._fabrica_disjuntor(endpoint)
+        return disjuntor
+
+    def disponivel(self, *endpoints: str) -> bool:
+        """Se os disjuntores de todos os `endpoints` deixariam uma chamada passar agora."""
+        return all(self.disjuntor(endpoint).disponivel() for endpoint in endpoints)
+
+    async def preparar(self):
+        """Aquecimento no post_init: cliente pronto e token em mãos antes da primeira cobrança."""
+        try:
+            await asyncio.wait_for(self.transporte.preparar(), timeout=self.timeout)
+        except Exception as e:
+            logger.critical(f"Falha CRÍTICA ao inicializar a API da Efí (nova tentativa na primeira chamada). Erro: {e}")
+
+    def _semaforo(self, endpoint: str) -> asyncio.Semaphore:
+        semaforo = self._semaforos.get(endpoint)
+        if semaforo is None:
+            semaforo = self._semaforos[endpoint] = asyncio.Semaphore(self._limite_por_endpoint)
+        return semaforo
+
+    async def chamar(self, endpoint: str, timeout: float | None = None, **kwargs) -> dict:
+        """Executa `endpoint` no transporte, sem bloquear o loop, e devolve a resposta JSON."""
+        tentativas = self.tentativas if endpoint in self.IDEMPOTENTES else 1
+        for tentativa in range(tentativas):
+            try:
+                return await self._chamar_uma_vez(endpoint, timeout, kwargs)
+            except DisjuntorAberto:
+                raise
+            except Exception:
+                if tentativa + 1 >= tentativas:
+                    raise
+                metricas.incrementar("efi_chamada_repeticoes_total", (("endpoint", endpoint),))
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** tentativa))
+
+    async def _chamar_uma_vez(self, endpoint: str, timeout: float | None, kwargs: dict) -> dict:
+        rotulos = (("endpoint", endpoint),)
+        disjuntor = self.disjuntor(endpoint)
+        modo = disjuntor.permitir()
+        if modo is None:
+            metricas.incrementar("efi_chamada_bloqueadas_total", rotulos)
+            raise DisjuntorAberto(f"Efí indisponível: disjuntor de '{endpoint}' aberto.")
+        sucesso = None
+        try:
+            with metricas.medir("efi_chamada", rotulos):
+                async with self._semaforo(endpoint):
+                    inicio = time.monotonic()
+                    try:
+                        resposta = await asyncio.wait_for(self.transporte.chamar(endpoint, **kwargs),
+                                                          timeout=timeout or self.timeout)
+                    except Exception:
+                        sucesso = False
+                        raise
+                    duracao = time.monotonic() - inicio
+            # O SDK devolve exceções e strings de erro em vez de levantá-las.
+            if isinstance(resposta, Exception):
+                sucesso = False
+                metricas.incrementar("efi_chamada_erros_total", rotulos)
+                raise resposta
+            if not isinstance(resposta, dict):
+                sucesso = False
+                metricas.incrementar("efi_chamada_erros_total", rotulos)
+                raise ErroGatewayEfi(f"Resposta inesperada de '{endpoint}': {resposta}")
+            sucesso = duracao <= disjuntor.lentidao
+            return resposta
+        finally:
+            disjuntor.registrar(sucesso, modo)
 
+    async def criar_cobranca(self, body: dict, **kwargs) -> dict:
+        return await self.chamar('pix_create_immediate_charge', body=body, **kwargs)
 
-# -----------------------------------------------------------------------------
-# ⚙️ CONFIGURAÇÕES INICIAIS
-# -----------------------------------------------------------------------------
-try:
-    # Inicializa a API da Efí com as credenciais fornecidas
-    credentials = {
-        'client_id': EFI_CLIENT_ID,
-        'client_secret': EFI_CLIENT_SECRET,
-        'sandbox': not EFI_PRODUCAO,
-        'certificate': EFI_CERTIFICATE_PATH
-    }
-    efi = EfiPay(credentials)
-except Exception as e:
-    logging.critical(f"Falha CRÍTICA ao inicializar a API da Efí. Erro: {e}")
-    sys.exit("Erro fatal na inicialização da Efí.")
+    async def gerar_qrcode(self, loc_id, **kwargs) -> dict:
+        return await self.chamar('pix_generate_qrcode', params={'id': loc_id}, **kwargs)
 
-DB_FILE = 'pagamentos.db'
-logger = logging.getLogger(__name__)
+    async def detalhar_cobranca(self, txid: str, usar_cache: bool = True, **kwargs) -> dict:
+        buscar = functools.partial(self.chamar, 'pix_detail_charge', params={'txid': txid}, **kwargs)
+        if not usar_cache:
+            resposta = await buscar()
+            self.cache.registrar(txid, resposta)
+            return resposta
+        return await self.cache.obter(txid, buscar)
 
-# --- CONSTANTES PARA OS TERMOS DE USO ---
-TERMS_URL = "https://docs.google.com/document/d/10l_slgZHCnQw4tSjARx52VU8wNYEoU3qvqLCcTpmB1A/edit?usp=sharing" # Mantenha o seu
+    async def listar_cobrancas(self, inicio: datetime, fim: datetime, **kwargs) -> list:
+        """Lista todas as cobranças criadas entre `inicio` e `fim` (UTC), página por página."""
+        cobrancas = []
+        pagina = 0
+        while True:
+            resposta = await self.chamar('pix_list_charges', params={
+                'inicio': inicio.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'fim': fim.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'paginacao.paginaAtual': pagina,
+                'paginacao.itensPorPagina': 1000,
+            }, **kwargs)
+            for cobranca in resposta.get('cobs', []):
+                if cobranca.get('txid'):
+                    self.cache.registrar(cobranca['txid'], cobranca)
+                cobrancas.append(cobranca)
+            total_paginas = resposta.get('parametros', {}).get('paginacao', {}).get('quantidadeDePaginas', 1)
+            pagina += 1
+            if pagina >= total_paginas:
+                return cobrancas
 
+    async def fechar(self):
+        await self.transporte.fechar()
+        logger.info(f"Cache de cobranças da Efí: {self.cache.resumo()}.")
 
-# -----------------------------------------------------------------------------
-# 🗂️ FUNÇÕES DO BANCO DE DADOS
-# -----------------------------------------------------------------------------
-def criar_e_migrar_db():
-    """Cria e configura o banco de dados, adicionando colunas se não existirem."""
-    conn = None
-    try:
-        conn = sqlite3.connect(DB_FILE, timeout=10)
-        cursor = conn.cursor()
-        cursor.execute("PRAGMA journal_mode=WAL;")
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS pagamentos (
-                txid TEXT PRIMARY KEY, user_id INTEGER NOT NULL, username TEXT NOT NULL,
-                status TEXT NOT NULL, data_criacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                data_aprovacao TIMESTAMP,
-                pix_message_id INTEGER
-            )
-        ''')
-        
-        # --- MIGRAÇÃO: Adiciona novas colunas se não existirem ---
-        cursor.execute("PRAGMA table_info(pagamentos)")
-        columns = [info[1] for info in cursor.fetchall()]
-        
-        if 'tipo_plano' not in columns:
-            cursor.execute("ALTER TABLE pagamentos ADD COLUMN tipo_plano TEXT NOT NULL DEFAULT 'mensal'")
-            logger.info("Coluna 'tipo_plano' adicionada ao banco de dados.")
-            
-        if 'valor' not in columns:
-            cursor.execute("ALTER TABLE pagamentos ADD COLUMN valor REAL NOT NULL DEFAULT 0.0")
-            logger.info("Coluna 'valor' adicionada ao banco de dados.")
 
-        conn.commit()
-        logger.info("Banco de dados verificado e pronto para uso.")
-    except sqlite3.Error as e:
-        logger.critical(f"Erro CRÍTICO no banco de dados: {e}")
-        sys.exit(f"Falha ao inicializar o banco de dados: {e}")
-    finally:
-        if conn:
-            conn.close()
+gateway = GatewayEfi()
 
 # -----------------------------------------------------------------------------
 # 💳 FUNÇÃO DE PAGAMENTO
 # -----------------------------------------------------------------------------
-def criar_pagamento_efi(valor: float, user_id: int, tipo_plano: str):
-    """Cria uma cobrança PIX na Efí e retorna o txid e o código Copia e Cola."""
+def para_centavos(valor) -> int:
+    """Converte um preço como "19.90" para centavos (1990) sem erro de ponto flutuante."""
+    return int(Decimal(str(valor)) * 100)
+
+def formatar_centavos(centavos: int) -> str:
+    """Formata um valor em centavos no padrão brasileiro: 1990 -> "19,90"."""
+    return f"{centavos // 100},{centavos % 100:02d}"
+
+async def criar_pagamento_efi(valor: float, user_id: int | None, tipo_plano: str, expiracao: int = EXPIRACAO_COBRANCA):
+    """
+    Cria uma cobrança PIX na Efí e retorna o txid e o código Copia e Cola.
+    Sem `user_id`, cria uma cobrança genérica do plano (usada pelo pool).
+    """
+    destino = f"user {user_id}" if user_id else "o pool"
     try:
         body = {
-            "calendario": {"expiracao": 900},  # 15 minutos
+            "calendario": {"expiracao": expiracao},
             "valor": {"original": f"{valor:.2f}"},
             "chave": EFI_PIX_KEY,
-            "solicitacaoPagador": f"Acesso {tipo_plano} para user ID {user_id}"
+            "solicitacaoPagador": f"Acesso {tipo_plano} para user ID {user_id}" if user_id else f"Acesso {tipo_plano}"
         }
-        response_charge = efi.pix_create_immediate_charge(body=body)
+        response_charge = await gateway.criar_cobranca(body)
         txid = response_charge.get('txid')
         loc_id = response_charge.get('loc', {}).get('id')
         if not txid or not loc_id:
             raise ValueError(f"API não retornou 'txid' ou 'loc.id': {response_charge}")
 
-        response_qrcode = efi.pix_generate_qrcode(params={'id': loc_id})
+        response_qrcode = await gateway.gerar_qrcode(loc_id)
         pix_copia_cola = response_qrcode.get('pixCopiaECola') or response_qrcode.get('qrcode')
         if not pix_copia_cola:
             raise ValueError(f"'pixCopiaECola' ou 'qrcode' não encontrados: {response_qrcode}")
             
-        logger.info(f"Cobrança {txid} (Plano: {tipo_plano}, Valor: {valor}) criada para user {user_id}.")
-        return {"txid": txid, "pixCopiaECola": pix_copia_cola}
+        logger.info(f"Cobrança {txid} (Plano: {tipo_plano}, Valor: {valor}) criada para {destino}.")
+        return {"txid": txid, "pixCopiaECola": pix_copia_cola, "valida_ate": int(time.time()) + expiracao}
 
+    except DisjuntorAberto as e:
+        logger.warning(f"Cobrança para {destino} não criada: {e}")
+        return None
     except Exception as e:
-        logger.error(f"Erro CRÍTICO na API Efí ao criar cobrança para {user_id}: {e}", exc_info=True)
+        logger.error(f"Erro CRÍTICO na API Efí ao criar cobrança para {destino}: {e}", exc_info=True)
+        return None
+
+# -----------------------------------------------------------------------------
+# 🧊 POOL DE COBRANÇAS PRÉ-GERADAS
+# -----------------------------------------------------------------------------
+class PoolCobrancas:
+    """
+    Mantém, para cada plano, algumas cobranças PIX já criadas na Efí, para que o
+    checkout não espere as duas chamadas (cobrança + QR code).
+
+    As cobranças do pool são criadas com validade maior (`validade`) e só são
+    entregues enquanto ainda restar pelo menos EXPIRACAO_COBRANCA para o usuário
+    pagar; as que passam disso são descartadas e expiram sozinhas na Efí. Uma
+    tarefa em segundo plano repõe o pool até `profundidade`. O txid só é ligado a
+    um usuário no banco quando a cobrança é retirada.
+    """
+    def __init__(self, precos: dict, profundidade: int, validade: int = 3600, intervalo_reposicao: float = 30):
+        self.precos = precos
+        self.profundidade = profundidade
+        self.validade = validade
+        self.intervalo_reposicao = intervalo_reposicao
+        self.acertos = 0
+        self.falhas = 0
+        self.descartadas = 0
+        self._cobrancas = {plano: collections.deque() for plano in precos}
+        self._repor = asyncio.Event()
+        self._tarefa: asyncio.Task | None = None
+
+    def _valida(self, cobranca: dict) -> bool:
+        # Margem de 60s para o usuário ver a mensagem antes do prazo mínimo começar a correr.
+        return cobranca['expira_em'] - time.monotonic() >= EXPIRACAO_COBRANCA + 60
+
+    def retirar(self, tipo_plano: str) -> dict | None:
+        """Entrega uma cobrança pronta do plano, ou None se o pool estiver vazio."""
+        if self.profundidade <= 0:
+            return None
+        fila = self._cobrancas.get(tipo_plano)
+        while fila:
+            cobranca = fila.popleft()
+            if self._valida(cobranca):
+                self.acertos += 1
+                self._repor.set()
+                return {"txid": cobranca['txid'], "pixCopiaECola": cobranca['pixCopiaECola'],
+                        "valida_ate": int(time.time() + cobranca['expira_em'] - time.monotonic())}
+            self.descartadas += 1
+        self.falhas += 1
+        self._repor.set()
         return None
 
+    def tamanho(self, tipo_plano: str) -> int:
+        return len(self._cobrancas.get(tipo_plano, ()))
+
+    async def _repor_plano(self, tipo_plano: str):
+        fila = self._cobrancas[tipo_plano]
+        while fila and not self._valida(fila[0]):
+            fila.popleft()
+            self.descartadas += 1
+        faltam = self.profundidade - len(fila)
+        # Com o disjuntor aberto a reposição espera: as chamadas falhariam na hora.
+        if faltam <= 0 or not gateway.disponivel(*GatewayEfi.CRIACAO):
+            return
+        novas = await asyncio.gather(*(
+            criar_pagamento_efi(float(self.precos[tipo_plano]), None, tipo_plano, expiracao=self.validade)
+            for _ in range(faltam)
+        ))
+        expira_em = time.monotonic() + self.validade - 5  # Folga para o tempo da própria chamada
+        fila.extend({**cobranca, 'expira_em': expira_em} for cobranca in novas if cobranca)
+
+    async def _reabastecer(self):
+        while self._tarefa:
+            self._repor.clear()
+            for tipo_plano in self._cobrancas:
+                try:
+                    await self._repor_plano(tipo_plano)
+                except Exception as e:
+                    logger.error(f"Falha ao repor o pool de cobranças do plano {tipo_plano}: {e}")
+            try:
+                await asyncio.wait_for(self._repor.wait(), timeout=self.intervalo_reposicao)
+            except asyncio.TimeoutError:
+                pass
+
+    def iniciar(self):
+        if self.profundidade > 0 and not self._tarefa:
+            self._tarefa = asyncio.create_task(self._reabastecer())
+
+    async def parar(self):
+        tarefa, self._tarefa = self._tarefa, None
+        if tarefa:
+            # Zerar `_tarefa` encerra o laço mesmo se o wait_for engolir o cancelamento.
+            tarefa.cancel()
+            try:
+                await tarefa
+            except asyncio.CancelledError:
+                pass
+        logger.info(f"Pool de cobranças: {self.acertos} acerto(s), {self.falhas} falha(s), {self.descartadas} descartada(s).")
+
+
+pool_cobrancas = PoolCobrancas(PRECOS_POR_PLANO, POOL_COBRANCAS_PROFUNDIDADE, POOL_COBRANCAS_VALIDADE, POOL_COBRANCAS_REPOSICAO)
+
+# -----------------------------------------------------------------------------
+# 🎟️ POOL DE LINKS DE CONVITE DO CANAL PRIVADO
+# -----------------------------------------------------------------------------
+class PoolConvites:
+    """
+    Mantém alguns links de convite de uso único (member_limit=1) do canal privado já
+    criados, para que a aprovação de um pagamento não dependa de uma chamada a
+    `create_chat_invite_link` (limitada pelo Telegram e sujeita a falhas em picos).
+
+    Cada link é entregue a um único usuário e só enquanto ainda tiver pelo menos
+    `validade_minima` pela frente. Os que ficam velhos no pool sem uso são revogados
+    e substituídos; ao desligar, os que sobraram também são revogados. Com o pool
+    vazio, o link é criado na hora, como antes.
+    """
+    def __init__(self, profundidade: int, validade: int = 7200, validade_minima: int = 3600,
+                 intervalo_criacao: float = 1, intervalo_reposicao: float = 60):
+        self.profundidade = profundidade
+        self.validade = validade
+        self.validade_minima = validade_minima
+        self.intervalo_criacao = intervalo_criacao
+        self.intervalo_reposicao = intervalo_reposicao
+        self.acertos = 0
+        self.falhas = 0
+        self.revogados = 0
+        self._links = collections.deque()  # (link, expire_date em Unix timestamp)
+        self._para_revogar = []
+        self._bot: Bot | None = None
+        self._repor = asyncio.Event()
+        self._tarefa: asyncio.Task | None = None
+
+    def __len__(self):
+        return len(self._links)
+
+    def _valido(self, expira_em: int) -> bool:
+        return expira_em - time.time() >= self.validade_minima
+
+    async def _criar(self, bot: Bot, validade: int) -> str:
+        convite = await bot.create_chat_invite_link(
+            chat_id=ID_CANAL_PRIVADO, member_limit=1, expire_date=int(time.time()) + validade
+        )
+        return convite.invite_link
+
+    async def _revogar(self, link: str):
+        try:
+            await self._bot.revoke_chat_invite_link(chat_id=ID_CANAL_PRIVADO, invite_link=link)
+            self.revogados += 1
+        except Exception as e:
+            # Link não revogado só sobra até expirar sozinho.
+            logger.warning(f"Não foi possível revogar um link de convite do pool: {e}")
+
+    async def obter(self, bot: Bot) -> str:
+        """Entrega um link de uso único: do pool, se houver, ou criado na hora."""
+        with metricas.medir("convite_obter"):
+            while self._links:
+                link, expira_em = self._links.popleft()
+                self._repor.set()
+                if self._valido(expira_em):
+                    self.acertos += 1
+                    return link
+                self._para_revogar.append(link)
+            if self.profundidade > 0:
+                self.falhas += 1
+                self._repor.set()
+            # Sob demanda, um RetryAfter vale a espera: sem link o cliente cai no suporte.
+            for tentativa in range(3):
+                try:
+                    return await self._criar(bot, self.validade_minima)
+                except RetryAfter as e:
+                    if tentativa == 2:
+                        raise
+                    espera = e.retry_after
+                    await asyncio.sleep(espera.total_seconds() if isinstance(espera, timedelta) else espera)
+
+    async def _reabastecer(self):
+        while self._tarefa:
+            self._repor.clear()
+            try:
+                while self._links and not self._valido(self._links[0][1]):
+                    self._para_revogar.append(self._links.popleft()[0])
+                while self._para_revogar:
+                    await self._revogar(self._para_revogar.pop())
+                while self._tarefa and len(self._links) < self.profundidade:
+                    link = await self._criar(self._bot, self.validade)
+                    self._links.append((link, int(time.time()) + self.validade))
+                    await asyncio.sleep(self.intervalo_criacao)
+            except RetryAfter as e:
+                espera = e.retry_after
+                await asyncio.sleep(espera.total_seconds() if isinstance(espera, timedelta) else espera)
+                continue
+            except Exception as e:
+                logger.error(f"Falha ao repor o pool de links de convite: {e}")
+            try:
+                await asyncio.wait_for(self._repor.wait(), timeout=self.intervalo_reposicao)
+            except asyncio.TimeoutError:
+                pass
+
+    def iniciar(self, bot: Bot):
+        if self.profundidade > 0 and not self._tarefa:
+            self._bot = bot
+            self._tarefa = asyncio.create_task(self._reabastecer())
+
+    async def parar(self):
+        """Encerra a reposição e revoga os links que não chegaram a ser entregues."""
+        tarefa, self._tarefa = self._tarefa, None
+        if tarefa:
+            tarefa.cancel()
+            try:
+                await tarefa
+            except asyncio.CancelledError:
+                pass
+        self._para_revogar.extend(link for link, _ in self._links)
+        self._links.clear()
+        while self._para_revogar:
+            await self._revogar(self._para_revogar.pop())
+        logger.info(f"Pool de convites: {self.acertos} acerto(s), {self.falhas} falha(s), {self.revogados} revogado(s).")
+
+
+pool_convites = PoolConvites(CONVITES_PROFUNDIDADE, CONVITES_VALIDADE, CONVITES_VALIDADE_MINIMA,
+                             CONVITES_INTERVALO_CRIACAO, CONVITES_REPOSICAO)
+
+# -----------------------------------------------------------------------------
+# 🔒 TRAVAS DE CHECKOUT POR USUÁRIO
+# -----------------------------------------------------------------------------
+class TravasPorUsuario:
+    """
+    Registro das gerações de cobrança em andamento, uma trava por usuário. Permite
+    descobrir, sem esperar, se o usuário já tem um checkout em curso. Travas livres
+    e sem uso há mais de `ttl` segundos são descartadas periodicamente, para que o
+    registro não cresça com cada usuário que já passou pelo bot.
+    """
+    def __init__(self, ttl: float = 600):
+        self.ttl = ttl
+        self._travas = {}  # user_id -> [asyncio.Lock, último uso (monotonic)]
+        self._ultima_limpeza = time.monotonic()
+
+    def ocupada(self, user_id: int) -> bool:
+        entrada = self._travas.get(user_id)
+        return bool(entrada and entrada[0].locked())
+
+    def limpar(self) -> int:
+        """Descarta as travas livres e ociosas; retorna quantas foram removidas."""
+        agora = time.monotonic()
+        self._ultima_limpeza = agora
+        ociosas = [uid for uid, (trava, uso) in self._travas.items() if not trava.locked() and agora - uso > self.ttl]
+        for uid in ociosas:
+            del self._travas[uid]
+        return len(ociosas)
+
+    @contextlib.asynccontextmanager
+    async def travar(self, user_id: int):
+        if time.monotonic() - self._ultima_limpeza > self.ttl:
+            self.limpar()
+        entrada = self._travas.get(user_id)
+        if entrada is None:
+            entrada = self._travas[user_id] = [asyncio.Lock(), time.monotonic()]
+        async with entrada[0]:
+            try:
+                yield
+            finally:
+                entrada[1] = time.monotonic()
+
+    def __len__(self):
+        return len(self._travas)
+
+
+travas_checkout = TravasPorUsuario(CHECKOUT_TRAVA_TTL)
+
+# -----------------------------------------------------------------------------
+# 🚦 LIMITE DE CLIQUES POR USUÁRIO E GLOBAL
+# -----------------------------------------------------------------------------
+class LimitadorCliques:
+    """
+    Controle de carga na frente dos CallbackQueryHandlers, consultado pelo
+    ProcessadorPorUsuario antes da trava do usuário.
+
+    Por usuário, um balde de fichas com `rajada` de capacidade, reposto a `taxa`
+    fichas por segundo; cada botão custa `custos[callback_data]` fichas. O balde é
+    guardado como GCRA: um único float por usuário, o instante (monotonic) em que
+    ele estaria cheio de novo. Quem já passou desse instante está com o balde cheio,
+    então a entrada pode ser apagada sem perder nada; `limpar` faz isso a cada
+    `limpeza` segundos, e o dicionário só guarda quem clicou nos últimos segundos.
+
+    Globalmente, no máximo `limite_caros` operações caras (`caros`) em andamento no
+    processo; elas são contadas pelo decorador `operacao_cara`.
+    """
+    def __init__(self, taxa: float = 1, rajada: float = 10, custos: dict | None = None, caros=(),
+                 limite_caros: int = 48, limpeza: float = 300):
+        self.intervalo = 1 / taxa
+        self.tolerancia = rajada * self.intervalo
+        self.custos = custos or {}
+        self.caros = frozenset(caros)
+        self.limite_caros = limite_caros
+        self.limpeza = limpeza
+        self.em_andamento = 0
+        self.rejeitados = collections.Counter()  # motivo -> cliques recusados
+        self._cheio_em = {}  # user_id -> instante (monotonic) em que o balde estará cheio
+        self._ultima_limpeza = time.monotonic()
+
+    def custo(self, dados: str) -> float:
+        custo = self.custos.get(dados)
+        if custo is None:
+            custo = self.custos.get(dados.partition("_")[0] + "_", 1)
+        return custo
+
+    def admitir(self, user_id: int, custo: float = 1) -> float:
+        """Debita `custo` fichas do usuário. Retorna 0 se o clique passa, ou quantos segundos faltam para passar."""
+        agora = time.monotonic()
+        if agora - self._ultima_limpeza > self.limpeza:
+            self.limpar(agora)
+        cheio_em = max(self._cheio_em.get(user_id, agora), agora) + custo * self.intervalo
+        if cheio_em - agora > self.tolerancia:
+            return cheio_em - agora - self.tolerancia
+        self._cheio_em[user_id] = cheio_em
+        return 0.0
+
+    def lotado(self, dados: str) -> bool:
+        return dados in self.caros and self.em_andamento >= self.limite_caros
+
+    def recusar(self, user_id: int, dados: str) -> str | None:
+        """Confere o clique nos dois limites. Retorna None se ele passa, ou o motivo da recusa ("global" ou "usuario")."""
+        if self.lotado(dados):
+            motivo = "global"
+        elif self.admitir(user_id, self.custo(dados)):
+            motivo = "usuario"
+        else:
+            return None
+        self.rejeitados[motivo] += 1
+        metricas.incrementar("limite_cliques_recusados_total", (("motivo", motivo),))
+        return motivo
+
+    def limpar(self, agora: float | None = None) -> int:
+        """Descarta os baldes já cheios; retorna quantos foram removidos."""
+        agora = time.monotonic() if agora is None else agora
+        self._ultima_limpeza = agora
+        antes = len(self._cheio_em)
+        self._cheio_em = {uid: cheio_em for uid, cheio_em in self._cheio_em.items() if cheio_em > agora}
+        return antes - len(self._cheio_em)
+
+    def operacao_cara(self, handler):
+        """Envolve um handler caro para que ele conte no limite global enquanto roda."""
+        @functools.wraps(handler)
+        async def contado(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            self.em_andamento += 1
+            try:
+                return await handler(update, context)
+            finally:
+                self.em_andamento -= 1
+        return contado
+
+    def __len__(self):
+        return len(self._cheio_em)
+
+
+limitador_cliques = LimitadorCliques(LIMITE_CLIQUES_TAXA, LIMITE_CLIQUES_RAJADA, LIMITE_CLIQUES_CUSTOS,
+                                     LIMITE_CLIQUES_CAROS, LIMITE_CAROS_SIMULTANEOS, LIMITE_CLIQUES_LIMPEZA)
+
+# -----------------------------------------------------------------------------
+# 📨 NOTIFICAÇÕES EM SEGUNDO PLANO (OUTBOX)
+# -----------------------------------------------------------------------------
+class DespachanteNotificacoes:
+    """
+    Entrega as notificações gravadas no outbox (tabela `notificacoes`) fora do
+    caminho do usuário: quem notifica só espera a gravação no banco. Os envios saem
+    em paralelo, e cada destino falha sozinho: um admin que bloqueou o bot não
+    atrasa os outros. Erros temporários são repetidos com espera exponencial (ou o
+    RetryAfter pedido pelo Telegram); Forbidden e BadRequest não se resolvem
+    sozinhos e marcam a notificação como 'falhou'. Como o outbox é durável, o que
+    não foi entregue antes de um desligamento sai no próximo início.
+    """
+    LOTE = 100
+
+    def __init__(self, simultaneas: int = 10, max_tentativas: int = 8, backoff: float = 5, intervalo: float = 30):
+        self.simultaneas = simultaneas
+        self.max_tentativas = max_tentativas
+        self.backoff = backoff
+        self.intervalo = intervalo
+        self.entregues = 0
+        self.falhas = 0
+        self._bot: Bot | None = None
+        self._acordar = asyncio.Event()
+        self._encerrando = False
+        self._tarefa: asyncio.Task | None = None
+
+    async def notificar(self, chat_ids, texto: str, parse_mode: str | None = None):
+        """Grava a notificação para cada chat e acorda o despachante; não espera o envio."""
+        await repositorio.enfileirar_notificacoes(list(chat_ids), texto, parse_mode)
+        self._acordar.set()
+
+    def iniciar(self, bot: Bot):
+        if not self._tarefa:
+            self._bot = bot
+            self._encerrando = False
+            self._tarefa = asyncio.create_task(self._despachar())
+
+    async def parar(self, tempo_maximo: float = 5):
+        """Entrega o que já estiver pronto (por até `tempo_maximo` segundos) e encerra."""
+        tarefa = self._tarefa
+        if not tarefa:
+            return
+        self._encerrando = True
+        self._acordar.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(tarefa), timeout=tempo_maximo)
+        except asyncio.TimeoutError:
+            self._tarefa = None
+            tarefa.cancel()
+            try:
+                await tarefa
+            except asyncio.CancelledError:
+                pass
+        self._tarefa = None
+        logger.info(f"Despachante de notificações encerrado: {self.entregues} entregue(s), {self.falhas} falha(s) definitiva(s).")
+
+    async def _despachar(self):
+        while self._tarefa:
+            self._acordar.clear()
+            try:
+                processadas = await self._rodada()
+            except Exception as e:
+                logger.error(f"Falha ao processar o outbox de notificações: {e}", exc_info=True)
+                processadas = 0
+            if processadas == self.LOTE:
+                continue
+            if self._encerrando:
+                return
+            espera = self.intervalo
+            proxima = await repositorio.proxima_notificacao()
+            if proxima is not None:
+                espera = min(espera, max(0, proxima - time.time()))
+            try:
+                await asyncio.wait_for(self._acordar.wait(), timeout=espera)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _rodada(self) -> int:
+        prontas = await repositorio.notificacoes_prontas(int(time.time()), self.LOTE)
+        if not prontas:
+            return 0
+        semaforo = asyncio.Semaphore(self.simultaneas)
+        resultados = await asyncio.gather(*(self._entregar(semaforo, chat_id, texto, parse_mode, tentativas)
+                                            for _, chat_id, texto, parse_mode, tentativas in prontas))
+        entregues, reagendadas, falhas = [], [], []
+        agora = int(time.time())
+        for (notificacao_id, chat_id, _, _, tentativas), (erro, espera) in zip(prontas, resultados):
+            if erro is None:
+                entregues.append(notificacao_id)
+            elif espera is None or tentativas + 1 >= self.max_tentativas:
+                falhas.append((notificacao_id, erro))
+                logger.error(f"Notificação {notificacao_id} para {chat_id} descartada após {tentativas + 1} tentativa(s): {erro}")
+            else:
+                reagendadas.append((notificacao_id, tentativas + 1, agora + int(espera), erro))
+        await repositorio.registrar_entregas(entregues, reagendadas, falhas)
+        self.entregues += len(entregues)
+        self.falhas += len(falhas)
+        metricas.incrementar("notificacoes_total", (("resultado", "entregue"),), len(entregues))
+        metricas.incrementar("notificacoes_total", (("resultado", "reagendada"),), len(reagendadas))
+        metricas.incrementar("notificacoes_total", (("resultado", "falhou"),), len(falhas))
+        return len(prontas)
+
+    async def _entregar(self, semaforo: asyncio.Semaphore, chat_id: int, texto: str, parse_mode: str | None, tentativas: int):
+        """Retorna (erro, espera): (None, None) se entregou; espera None quando não vale repetir."""
+        async with semaforo:
+            try:
+                with metricas.medir("notificacao_envio"):
+                    await self._bot.send_message(chat_id=chat_id, text=texto, parse_mode=parse_mode)
+                return None, None
+            except RetryAfter as e:
+                espera = e.retry_after
+                return str(e), espera.total_seconds() if isinstance(espera, timedelta) else espera
+            except (Forbidden, BadRequest) as e:
+                return str(e), None
+            except Exception as e:
+                return str(e), min(self.backoff * 2 ** tentativas, 3600)
+
+
+despachante = DespachanteNotificacoes(NOTIFICACOES_SIMULTANEAS, NOTIFICACOES_MAX_TENTATIVAS, NOTIFICACOES_BACKOFF, NOTIFICACOES_INTERVALO)
+
+# -----------------------------------------------------------------------------
+# ⏸️ CHECKOUTS ADIADOS (EFÍ FORA DO AR)
+# -----------------------------------------------------------------------------
+class FilaCheckoutsAdiados:
+    """
+    Com o disjuntor de criação de cobranças aberto, o checkout não espera a Efí: o
+    pedido vai para a tabela `checkouts_adiados` e o usuário recebe na hora o aviso
+    de que o PIX chega em seguida. Esta tarefa drena a fila quando a Efí volta:
+    cria a cobrança, registra no banco e envia as instruções e o Copia e Cola na
+    conversa. Enquanto o disjuntor não deixa, ela só espera; as falhas de cada
+    pedido são reagendadas com espera exponencial.
+
+    Pedidos mais velhos que `validade` são descartados com um aviso ao usuário, e
+    um pedido cujo usuário já gerou outra cobrança (ou pagou) sai da fila sem criar nada.
+    """
+    LOTE = 50
+
+    def __init__(self, intervalo: float = 5, validade: int = 3600, simultaneos: int = 4):
+        self.intervalo = intervalo
+        self.validade = validade
+        self.simultaneos = simultaneos
+        self.entregues = 0
+        self.descartados = 0
+        self._bot: Bot | None = None
+        self._acordar = asyncio.Event()
+        self._tarefa: asyncio.Task | None = None
+
+    async def adiar(self, user_id: int, username: str, tipo_plano: str, valor_centavos: int):
+        await repositorio.adiar_checkout(user_id, username, tipo_plano, valor_centavos)
+        metricas.incrementar("checkouts_adiados_total", (("plano", tipo_plano),))
+        logger.warning(f"Efí indisponível: checkout do plano {tipo_plano} de {user_id} adiado.")
+        self._acordar.set()
+
+    def iniciar(self, bot: Bot):
+        if not self._tarefa:
+            self._bot = bot
+            self._tarefa = asyncio.create_task(self._drenar())
+
+    async def parar(self):
+        tarefa, self._tarefa = self._tarefa, None
+        if tarefa:
+            tarefa.cancel()
+            try:
+                await tarefa
+            except asyncio.CancelledError:
+                pass
+        logger.info(f"Fila de checkouts adiados: {self.entregues} entregue(s), {self.descartados} descartado(s).")
+
+    async def _drenar(self):
+        while self._tarefa:
+            self._acordar.clear()
+            processados = 0
+            if gateway.disponivel(*GatewayEfi.CRIACAO):
+                try:
+                    processados = await self._rodada()
+                except Exception as e:
+                    logger.error(f"Falha ao drenar a fila de checkouts adiados: {e}", exc_info=True)
+            if processados == self.LOTE:
+                continue
+            try:
+                await asyncio.wait_for(self._acordar.wait(), timeout=self.intervalo)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _rodada(self) -> int:
+        prontos = await repositorio.checkouts_adiados_prontos(int(time.time()), self.LOTE)
+        semaforo = asyncio.Semaphore(self.simultaneos)
+
+        async def processar(pedido):
+            async with semaforo:
+                # Com a Efí caindo de novo no meio da rodada, o resto espera a próxima.
+                if not gateway.disponivel(*GatewayEfi.CRIACAO):
+                    await repositorio.reagendar_checkout(pedido[0], pedido[4], pedido[5], int(time.time()))
+                    return
+                await self._processar(*pedido)
+
+        await asyncio.gather(*(processar(pedido) for pedido in prontos))
+        return len(prontos)
+
+    async def _processar(self, user_id: int, username: str, tipo_plano: str, valor_centavos: int, criado_em: int, tentativas: int):
+        agora = int(time.time())
+        if await repositorio.cobranca_pendente_desde(user_id, criado_em) or await repositorio.aprovado_recentemente(user_id):
+            await repositorio.remover_checkout(user_id, criado_em)
+            return
+        if agora - criado_em > self.validade:
+            await repositorio.remover_checkout(user_id, criado_em)
+            self.descartados += 1
+            metricas.incrementar("checkouts_adiados_expirados_total", (("plano", tipo_plano),))
+            await despachante.notificar([user_id], TEXTO_CHECKOUT_ADIADO_EXPIRADO)
+            return
+
+        pagamento = await criar_pagamento_efi(valor_centavos / 100, user_id, tipo_plano)
+        if not pagamento:
+            espera = min(self.intervalo * 2 ** tentativas, 300)
+            await repositorio.reagendar_checkout(user_id, criado_em, tentativas + 1, agora + int(espera))
+            return
+
+        # Registra antes de enviar: se o envio falhar, "Já paguei" e o reenvio da cobrança continuam funcionando.
+        await repositorio.substituir_pendente(pagamento["txid"], user_id, username, None, tipo_plano, valor_centavos,
+                                              pagamento["pixCopiaECola"], pagamento.get("valida_ate"))
+        await repositorio.remover_checkout(user_id, criado_em)
+        self.entregues += 1
+        metricas.incrementar("checkouts_adiados_entregues_total", (("plano", tipo_plano),))
+        try:
+            await self._bot.send_message(
+                chat_id=user_id,
+                text=TEXTO_INSTRUCOES_PIX.format(plano=tipo_plano.capitalize(), valor=formatar_centavos(valor_centavos)),
+                parse_mode=constants.ParseMode.MARKDOWN,
+                reply_markup=TECLADO_VERIFICAR
+            )
+            pix_message = await self._bot.send_message(
+                chat_id=user_id,
+                text=f"<pre><code>{html.escape(pagamento['pixCopiaECola'])}</code></pre>",
+                parse_mode=constants.ParseMode.HTML,
+                disable_web_page_preview=True
+            )
+            await repositorio.atualizar_mensagem_pix(pagamento["txid"], pix_message.message_id)
+            logger.info(f"Cobrança adiada {pagamento['txid']} (plano: {tipo_plano}) entregue para {user_id}.")
+        except Exception as e:
+            logger.error(f"Cobrança adiada {pagamento['txid']} criada, mas falhou o envio para {user_id}: {e}")
+
+
+fila_checkouts = FilaCheckoutsAdiados(CHECKOUT_ADIADO_INTERVALO, CHECKOUT_ADIADO_VALIDADE, CHECKOUT_ADIADO_SIMULTANEOS)
+
+# -----------------------------------------------------------------------------
+# 🎨 TELAS E TECLADOS PRÉ-MONTADOS
+# -----------------------------------------------------------------------------
+# Textos e teclados fixos são montados uma única vez, na importação, a partir das
+# configurações do senhas.py. Os handlers só encaixam os campos de cada usuário
+# (nome, plano, valor, datas). Os objetos do telegram são imutáveis depois de
+# criados, então podem ser compartilhados entre todas as atualizações.
+FUSO_BRASILIA = pytz.timezone('America/Sao_Paulo')
+
+def formatar_data_brasilia(timestamp: float | None = None, formato: str = '%d/%m/%Y às %H:%M') -> str:
+    """Formata um timestamp (ou o instante atual) no horário de Brasília."""
+    if timestamp is None:
+        return datetime.now(FUSO_BRASILIA).strftime(formato)
+    return datetime.fromtimestamp(timestamp, FUSO_BRASILIA).strftime(formato)
+
+def _teclado(*linhas) -> InlineKeyboardMarkup:
+    """Monta um teclado com um botão por linha a partir de tuplas (texto, callback_data ou url)."""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(texto, url=destino) if "://" in destino else InlineKeyboardButton(texto, callback_data=destino)]
+        for texto, destino in linhas
+    ])
+
+# --- Tela inicial (/start) ---
+TEXTO_BOAS_VINDAS = (
+    "Oi, {nome}! 👋\n\n"
+    "Você tá entrando num espaço feito só pra quem curte exclusividade.\n\n"
+    "Aqui eu compartilho conteúdo que não vai pra lugar nenhum além desse canal.\n\n"
+    "Clica aí e vem fazer parte disso."
+)
+TECLADO_INICIO = _teclado(("✨ Quero Acesso Exclusivo", "mostrar_planos"), ("📞 Preciso de Ajuda", LINK_SUPORTE))
+
+# --- Planos ---
+TEXTO_PLANOS = (
+    "✨ *Acesso ao Conteúdo Exclusivo*\n\n"
+    "Para ter acesso a todo o conteúdo, escolha um dos planos abaixo e faça parte do nosso canal privado:"
+)
+TECLADO_PLANOS = _teclado(
+    (f"🌙 Acesso Mensal - R$ {PRECO_MENSAL}", "plano_mensal"),
+    (f"🌟 Acesso Trimestral - R$ {PRECO_TRIMESTRAL}", "plano_trimestral"),
+    ("⬅️ Voltar", "start"),
+)
+
+# --- Termos ---
+TEXTO_TERMOS = (
+    "⚠️ *Quase lá... Leia os Termos*\n\n"
+    "Antes de prosseguir, é importante que você leia e concorde com os nossos termos de uso. "
+    "Isso garante que tudo fique claro entre a gente.\n\n"
+    "Ao clicar em 'Aceito', você confirma que leu e está de acordo."
+)
+TECLADO_TERMOS = _teclado(
+    ("Ler Termos de Uso", TERMS_URL),
+    ("✅ Li e aceito os Termos", "aceitar_termos"),
+    ("⬅️ Voltar", "mostrar_planos"),
+)
+
+# --- Pagamento e verificação ---
+TEXTO_INSTRUCOES_PIX = (
+    "🔑 *Seu Acesso ao Canal*\n\n"
+    "Plano: *{plano}*\nValor: *R$ {valor}*.\n\n"
+    "Para finalizar, use o *PIX Copia e Cola* abaixo. Seu acesso será liberado automaticamente assim que o pagamento for confirmado.\n\n"
+    "Após pagar, clique em *'Já paguei'* para fazer a verificação."
+)
+TEXTO_PAGAMENTO_PENDENTE = (
+    "❌ Pagamento Pendente (status: <b>{status}</b>).\n\n"
+    "Se você já pagou, pode levar alguns minutos para o sistema confirmar. "
+    "Aguarde um pouco e tente verificar novamente."
+)
+TEXTO_CHECKOUT_ADIADO = (
+    "⏳ *O banco está instável neste momento.*\n\n"
+    "Seu pedido do plano *{plano}* (R$ {valor}) ficou guardado: assim que normalizar, "
+    "o PIX chega aqui na conversa, sem você precisar fazer nada."
+)
+TEXTO_CHECKOUT_ADIADO_EXPIRADO = (
+    "😕 Não conseguimos gerar o seu PIX a tempo por uma instabilidade no banco. "
+    "Envie /start para tentar de novo."
+)
+TEXTO_VERIFICACAO_INDISPONIVEL = (
+    "⏳ Não consegui consultar o banco agora, ele está instável.\n\n"
+    "Se você já pagou, fique tranquilo: o acesso é liberado aqui automaticamente assim que a consulta voltar."
+)
+TECLADO_VERIFICAR = _teclado(("✅ Já paguei, verificar acesso", "verificar"))
+
+# --- Cliques recusados pelo limitador ---
+TEXTO_LIMITE_USUARIO = "⏳ Calma! Aguarde alguns segundos antes de tocar de novo."
+TEXTO_LIMITE_GLOBAL = "⏳ Muitos pedidos neste momento. Tente de novo em alguns segundos."
+TECLADO_FALHA_VERIFICACAO = _teclado(("Tentar novamente", "verificar"), ("⬅️ Escolher outro plano", "mostrar_planos"))
+
+# --- Navegação, suporte e renovação ---
+TECLADO_VOLTAR_PLANOS = _teclado(("⬅️ Voltar", "mostrar_planos"))
+TECLADO_ESCOLHER_PLANO = _teclado(("Escolher Plano", "mostrar_planos"))
+TECLADO_ESCOLHER_PLANO_ACESSO = _teclado(("Escolher Plano de Acesso", "mostrar_planos"))
+TECLADO_IR_INICIO = _teclado(("Ir para o início", "start"))
+TECLADO_SUPORTE = _teclado(("Falar com Suporte", LINK_SUPORTE))
+TECLADO_RENOVAR = _teclado(("🔄 Renovar Acesso", "mostrar_planos"))
+
 # -----------------------------------------------------------------------------
 # 🤖 HANDLERS DE COMANDOS E CALLBACKS DO TELEGRAM
 # -----------------------------------------------------------------------------
+async def recusar_clique(update: Update, motivo: str):
+    """
+    Resposta ao clique recusado pelo limitador (chamada pelo ProcessadorPorUsuario,
+    sem passar pelos handlers): só um answer, sem banco, Efí ou edição.
+    """
+    texto = TEXTO_LIMITE_GLOBAL if motivo == "global" else TEXTO_LIMITE_USUARIO
+    with contextlib.suppress(BadRequest, NetworkError):
+        await update.callback_query.answer(texto)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler para o comando /start e para o botão 'Voltar' ao menu principal."""
     user = update.effective_user
     if not user: return
     logger.info(f"Usuário {user.id} ({user.first_name}) iniciou o bot ou voltou ao menu.")
+    registrar_etapa_funil("start")
+
+    texto_boas_vindas = TEXTO_BOAS_VINDAS.format(nome=user.first_name)
+    reply_markup = TECLADO_INICIO
 
-    # --- TEXTO DE BOAS-VINDAS ATUALIZADO ---
-    texto_boas_vindas = (
-        f"Oi, {user.first_name}! 👋\n\n"
-        "Você tá entrando num espaço feito só pra quem curte exclusividade.\n\n"
-        "Aqui eu compartilho conteúdo que não vai pra lugar nenhum além desse canal.\n\n"
-        "Clica aí e vem fazer parte disso."
-    )
-    
-    keyboard = [
-        [InlineKeyboardButton("✨ Quero Acesso Exclusivo", callback_data="mostrar_planos")],
-        [InlineKeyboardButton("📞 Preciso de Ajuda", url=LINK_SUPORTE)]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     # Limpa dados de usuário para garantir um fluxo novo e registra a atividade
-    context.user_data.clear()
-    context.user_data['last_activity_time'] = datetime.now()
+    context.user_data.limpar()
+    context.user_data.registrar_atividade()
 
     if update.message:
         await update.message.reply_text(texto_boas_vindas, reply_markup=reply_markup)
@@ -191,32 +2707,22 @@ async def mostrar_planos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     if not query or not query.from_user: return
     user_id = query.from_user.id
-    context.user_data['last_activity_time'] = datetime.now() # Registra atividade
+    context.user_data.registrar_atividade()
     await query.answer()
+    registrar_etapa_funil("planos")
 
-    if context.user_data.get('pix_message_id'):
+    if context.user_data.pix_message_id:
         try:
-            await context.bot.delete_message(chat_id=user_id, message_id=context.user_data['pix_message_id'])
-            logger.info(f"Mensagem de PIX ({context.user_data['pix_message_id']}) apagada para o usuário {user_id} ao voltar para os planos.")
+            await context.bot.delete_message(chat_id=user_id, message_id=context.user_data.pix_message_id)
+            logger.info(f"Mensagem de PIX ({context.user_data.pix_message_id}) apagada para o usuário {user_id} ao voltar para os planos.")
         except BadRequest as e:
             if "Message to delete not found" not in str(e):
                 logger.warning(f"Não foi possível apagar a mensagem de PIX para {user_id}: {e}")
         finally:
-            context.user_data['pix_message_id'] = None
+            context.user_data.pix_message_id = None
 
-    # --- TEXTO DOS PLANOS MODIFICADO ---
-    texto = (
-        "✨ *Acesso ao Conteúdo Exclusivo*\n\n"
-        "Para ter acesso a todo o conteúdo, escolha um dos planos abaixo e faça parte do nosso canal privado:"
-    )
-    keyboard = [
-        [InlineKeyboardButton(f"🌙 Acesso Mensal - R$ {PRECO_MENSAL}", callback_data="plano_mensal")],
-        [InlineKeyboardButton(f"🌟 Acesso Trimestral - R$ {PRECO_TRIMESTRAL}", callback_data="plano_trimestral")], # Alterado
-        [InlineKeyboardButton("⬅️ Voltar", callback_data="start")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     try:
-        await query.edit_message_text(texto, reply_markup=reply_markup, parse_mode=constants.ParseMode.MARKDOWN)
+        await query.edit_message_text(TEXTO_PLANOS, reply_markup=TECLADO_PLANOS, parse_mode=constants.ParseMode.MARKDOWN)
     except BadRequest as e:
         if "Message is not modified" not in str(e):
             logger.error(f"Erro ao mostrar planos: {e}")
@@ -225,37 +2731,23 @@ async def mostrar_termos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Pega o plano escolhido, salva e exibe os termos."""
     query = update.callback_query
     if not query: return
-    context.user_data['last_activity_time'] = datetime.now() # Registra atividade
+    context.user_data.registrar_atividade()
     await query.answer()
 
     plano_selecionado = query.data.split('_')[1]  
 
-    if plano_selecionado == 'mensal':
-        context.user_data['plano_escolhido'] = {'tipo': 'mensal', 'valor': PRECO_MENSAL}
-    elif plano_selecionado == 'trimestral': # Alterado de 'vitalicio'
-        context.user_data['plano_escolhido'] = {'tipo': 'trimestral', 'valor': PRECO_TRIMESTRAL} # Alterado
-    else:
+    try:
+        context.user_data.escolher_plano(Plano(plano_selecionado))
+    except ValueError:
         logger.error(f"Plano inválido '{plano_selecionado}' recebido do usuário {query.from_user.id}")
         await query.edit_message_text("❌ Erro: Plano inválido. Por favor, tente novamente.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Voltar", callback_data="mostrar_planos")]]))
+                                      reply_markup=TECLADO_VOLTAR_PLANOS)
         return
 
     logger.info(f"Usuário {query.from_user.id} escolheu o plano: {plano_selecionado}")
+    registrar_etapa_funil("termos")
 
-    # --- TEXTO DOS TERMOS MODIFICADO ---
-    texto = (
-        "⚠️ *Quase lá... Leia os Termos*\n\n"
-        "Antes de prosseguir, é importante que você leia e concorde com os nossos termos de uso. "
-        "Isso garante que tudo fique claro entre a gente.\n\n"
-        "Ao clicar em 'Aceito', você confirma que leu e está de acordo."
-    )
-    keyboard = [
-        [InlineKeyboardButton("Ler Termos de Uso", url=TERMS_URL)],
-        [InlineKeyboardButton("✅ Li e aceito os Termos", callback_data="aceitar_termos")],
-        [InlineKeyboardButton("⬅️ Voltar", callback_data="mostrar_planos")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(texto, reply_markup=reply_markup, parse_mode=constants.ParseMode.MARKDOWN)
+    await query.edit_message_text(TEXTO_TERMOS, reply_markup=TECLADO_TERMOS, parse_mode=constants.ParseMode.MARKDOWN)
 
 
 async def aceitar_termos(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -263,7 +2755,7 @@ async def aceitar_termos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     if not query or not query.from_user: return
     user = query.from_user
-    context.user_data['last_activity_time'] = datetime.now() # Registra atividade
+    context.user_data.registrar_atividade()
 
     try:
         await query.answer()
@@ -273,270 +2765,308 @@ async def aceitar_termos(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await context.bot.send_message(
                 chat_id=user.id,
                 text="Sua sessão expirou. Por favor, inicie o processo novamente.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Ir para o início", callback_data="start")]])
+                reply_markup=TECLADO_IR_INICIO
             )
             return
         else:
             logger.error(f"Erro inesperado ao responder callback em aceitar_termos: {e}")
             raise
 
-    if 'plano_escolhido' not in context.user_data:
+    if not context.user_data.plano:
         logger.warning(f"Usuário {user.id} chegou em 'aceitar_termos' sem plano escolhido. Redirecionando.")
         await query.edit_message_text(
             text="❗️Opa! Parece que sua sessão foi reiniciada. Por favor, escolha um plano novamente.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Escolher Plano", callback_data="mostrar_planos")]])
+            reply_markup=TECLADO_ESCOLHER_PLANO
         )
         return
 
     await query.edit_message_text("Termos aceitos! Preparando seu acesso...")
     
-    brasilia_tz = pytz.timezone('America/Sao_Paulo')
-    now_brasilia = datetime.now(brasilia_tz)
-    data_hora_brasilia = now_brasilia.strftime('%d/%m/%Y às %H:%M:%S')
+    data_hora_brasilia = formatar_data_brasilia(formato='%d/%m/%Y às %H:%M:%S')
     username = f"@{user.username}" if user.username else "N/A"
-    plano_info = context.user_data['plano_escolhido']
+    sessao = context.user_data
     
     user_info = (
         f"✅ *Termo de Uso Aceito*\n\n"
         f"👤 *Usuário:* {user.full_name} ({username})\n"
         f"🆔 *Chat ID:* `{user.id}`\n"
-        f"💎 *Plano Escolhido:* {plano_info['tipo'].capitalize()} (R$ {plano_info['valor']})\n"
+        f"💎 *Plano Escolhido:* {sessao.plano.value.capitalize()} (R$ {formatar_centavos(sessao.valor_centavos)})\n"
         f"🗓️ *Data e Hora (Brasília):* {data_hora_brasilia}"
     )
+    # O aviso vai para o canal de termos dentro do checkout, depois da trava e da
+    # reutilização: um toque duplo não registra o aceite duas vezes.
+    await gerar_pagamento(update, context, aviso_termos=user_info)
+
+
+async def registrar_aceite_termos(user_id: int, tipo_plano: str, aviso: str):
+    """Enfileira no outbox o registro do aceite dos termos para o canal de termos."""
     try:
-        await context.bot.send_message(chat_id=ID_CANAL_TERMOS, text=user_info, parse_mode=constants.ParseMode.MARKDOWN)
-        logger.info(f"Usuário {user.id} aceitou os termos para o plano {plano_info['tipo']}.")
+        await despachante.notificar([ID_CANAL_TERMOS], aviso, constants.ParseMode.MARKDOWN)
+        logger.info(f"Usuário {user_id} aceitou os termos para o plano {tipo_plano}.")
     except Exception as e:
-        logger.error(f"Falha ao enviar notificação de aceite de termos para {ID_CANAL_TERMOS}: {e}")
-        
-    await gerar_pagamento(update, context)
+        logger.error(f"Falha ao registrar notificação de aceite de termos para {ID_CANAL_TERMOS}: {e}")
 
 
-async def gerar_pagamento(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Gera a cobrança PIX com base no plano salvo em user_data."""
+async def gerar_pagamento(update: Update, context: ContextTypes.DEFAULT_TYPE, aviso_termos: str | None = None):
+    """
+    Gera a cobrança PIX com base no plano salvo na sessão. `aviso_termos`, quando
+    vem do aceite, é registrado só se este clique não foi descartado nem reaproveitou
+    uma cobrança pendente.
+    """
     query = update.callback_query
     if not query or not query.from_user: return
     user_id = query.from_user.id
-    context.user_data['last_activity_time'] = datetime.now() # Registra atividade
+    context.user_data.registrar_atividade()
     
-    plano = context.user_data.get('plano_escolhido')
-    if not plano:
+    sessao = context.user_data
+    if not sessao.plano:
         logger.warning(f"Usuário {user_id} tentou gerar pagamento sem plano escolhido.")
         await query.edit_message_text(
             "❗️Opa! Parece que você não escolheu um plano. Vamos voltar.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Escolher Plano", callback_data="mostrar_planos")]])
+            reply_markup=TECLADO_ESCOLHER_PLANO
         )
         return
 
-    await query.edit_message_text("⏳ Preparando seu pagamento... um instante.")
-    
-    valor_plano = float(plano['valor'])
-    tipo_plano = plano['tipo']
-    
-    pagamento_info = criar_pagamento_efi(valor_plano, user_id, tipo_plano)
+    # Cliques repetidos enquanto a cobrança anterior ainda está sendo gerada são descartados.
+    if travas_checkout.ocupada(user_id):
+        logger.info(f"Usuário {user_id} pediu outra cobrança enquanto a anterior era gerada. Clique ignorado.")
+        return
+
+    async with travas_checkout.travar(user_id):
+        await query.edit_message_text("⏳ Preparando seu pagamento... um instante.")
+
+        tipo_plano = sessao.plano.value
+        valor_centavos = sessao.valor_centavos
+        valor_plano = valor_centavos / 100
+        username = query.from_user.username or f"id_{user_id}"
+
+        # Dentro da janela de idempotência, reenvia a cobrança pendente em vez de criar outra.
+        reutilizada = await repositorio.cobranca_reutilizavel(user_id, tipo_plano, valor_centavos)
+        if reutilizada:
+            pagamento_info = {"txid": reutilizada[0], "pixCopiaECola": reutilizada[1]}
+        else:
+            if aviso_termos:
+                await registrar_aceite_termos(user_id, tipo_plano, aviso_termos)
+            pagamento_info = pool_cobrancas.retirar(tipo_plano)
+            if not pagamento_info and gateway.disponivel(*GatewayEfi.CRIACAO):
+                pagamento_info = await criar_pagamento_efi(valor_plano, user_id, tipo_plano)
+            # Efí fora (disjuntor aberto, inclusive por esta falha): o pedido espera na fila em vez de falhar.
+            if not pagamento_info and not gateway.disponivel(*GatewayEfi.CRIACAO):
+                await fila_checkouts.adiar(user_id, username, tipo_plano, valor_centavos)
+                await query.edit_message_text(
+                    TEXTO_CHECKOUT_ADIADO.format(plano=tipo_plano.capitalize(), valor=formatar_centavos(valor_centavos)),
+                    parse_mode=constants.ParseMode.MARKDOWN
+                )
+                return
+
+        if pagamento_info and pagamento_info.get("txid") and pagamento_info.get("pixCopiaECola"):
+            txid_gerado = pagamento_info["txid"]
+            pix_copia_cola = pagamento_info["pixCopiaECola"]
+
+            valor_plano_str = formatar_centavos(valor_centavos)
+
+            texto_instrucoes = TEXTO_INSTRUCOES_PIX.format(plano=tipo_plano.capitalize(), valor=valor_plano_str)
+
+            await query.edit_message_text(
+                text=texto_instrucoes,
+                parse_mode=constants.ParseMode.MARKDOWN,
+                reply_markup=TECLADO_VERIFICAR
+            )
+
+            if sessao.pix_message_id:
+                try:
+                    await context.bot.delete_message(chat_id=user_id, message_id=sessao.pix_message_id)
+                except BadRequest:
+                    pass
+
+            pix_copia_cola_escaped = html.escape(pix_copia_cola)
+            pix_message = await context.bot.send_message(
+                chat_id=user_id,
+                text=f"<pre><code>{pix_copia_cola_escaped}</code></pre>",
+                parse_mode=constants.ParseMode.HTML,
+                disable_web_page_preview=True
+            )
+            sessao.pix_message_id = pix_message.message_id
+            registrar_etapa_funil("pix")
+
+            if reutilizada:
+                await repositorio.atualizar_mensagem_pix(txid_gerado, pix_message.message_id)
+                logger.info(f"Cobrança pendente {txid_gerado} (plano: {tipo_plano}) reenviada para {user_id} (msg: {pix_message.message_id}).")
+            else:
+                await repositorio.substituir_pendente(txid_gerado, user_id, username, pix_message.message_id, tipo_plano, valor_centavos,
+                                                      pix_copia_cola, pagamento_info.get("valida_ate"))
+                logger.info(f"Cobrança {txid_gerado} (msg: {pix_message.message_id}, plano: {tipo_plano}) salva no DB para {user_id}.")
+        else:
+            logger.error(f"Falha crítica ao gerar cobrança Efí para {user_id}.")
+            await query.edit_message_text("❌ Algo deu errado ao gerar o pagamento. Por favor, contate o suporte.")
+
+async def liberar_acesso(bot: Bot, pagamento: dict, sessao: SessaoUsuario | None = None, query=None, user=None):
+    """
+    Libera o acesso de um pagamento recém-aprovado: apaga a mensagem do PIX, envia o
+    link do canal e avisa os admins. Usado tanto pelo botão "Já paguei" (editando a
+    mensagem do botão) quanto pelo webhook da Efí (enviando uma mensagem nova).
+    """
+    user_id = pagamento['user_id']
+    txid = pagamento['txid']
+    tipo_plano_db = pagamento['tipo_plano']
+    registrar_etapa_funil("aprovado")
+
+    async def responder(**kwargs):
+        if query:
+            await query.edit_message_text(**kwargs)
+        else:
+            await bot.send_message(chat_id=user_id, **kwargs)
+
+    pix_message_id = (sessao.pix_message_id if sessao else None) or pagamento.get('pix_message_id')
+    if pix_message_id:
+        try:
+            await bot.delete_message(chat_id=user_id, message_id=pix_message_id)
+        except BadRequest: pass
+    if sessao is not None:
+        sessao.limpar()
+
+    try:
+        # --- TEXTOS DE SUCESSO MODIFICADOS ---
+        if tipo_plano_db == 'trimestral':
+            texto_sucesso = (
+                "<b>Acesso Trimestral Liberado!</b>\n\n"
+                "Seu acesso de 93 dias está ativo. Aproveite todo o conteúdo exclusivo."
+            )
+        else:  # Plano Mensal
+            texto_sucesso = (
+                "<b>Acesso Mensal Liberado!</b>\n\n"
+                "Seu acesso de 31 dias está ativo. Aproveite todo o conteúdo exclusivo."
+            )
+
+        # Link de uso único, com pelo menos 1 hora de validade (do pool ou criado na hora).
+        link = await pool_convites.obter(bot)
+
+        safe_link = html.escape(link)
+
+        texto_final = (
+            f"✅ Pagamento confirmado!\n\n{texto_sucesso}\n\n"
+            f'Clique no link abaixo para entrar:\n<a href="{safe_link}">{safe_link}</a>\n\n'
+            f"<i>Atenção: O link é de uso único e pessoal. Ele expira em breve.</i>"
+        )
+
+        await responder(
+            text=texto_final,
+            parse_mode=constants.ParseMode.HTML,
+            disable_web_page_preview=True
+        )
+
+    except Exception as e:
+        logger.error(f"PAGAMENTO APROVADO, MAS FALHOU AO GERAR/ENVIAR LINK para {user_id} ({txid}): {e}", exc_info=True)
+
+        texto_erro_html = (
+            f"✅ Pagamento aprovado, mas tive um problema ao gerar seu link!\n\n"
+            f"<b>Não se preocupe!</b> Contate o suporte informando seu ID (<code>{user_id}</code>) para receber o acesso."
+        )
+        await responder(
+            text=texto_erro_html,
+            parse_mode=constants.ParseMode.HTML,
+            reply_markup=TECLADO_SUPORTE
+        )
+        return
+
+    try:
+        if user:
+            user_details = f"{user.first_name or ''} (@{user.username or 'N/A'}, ID: {user.id})"
+        else:
+            user_details = f"(@{pagamento['username']}, ID: {user_id})"
 
-    if pagamento_info and pagamento_info.get("txid") and pagamento_info.get("pixCopiaECola"):
-        txid_gerado = pagamento_info["txid"]
-        pix_copia_cola = pagamento_info["pixCopiaECola"]
-        username = query.from_user.username or f"id_{user_id}"
-        
-        valor_plano_str = f"{valor_plano:.2f}".replace('.', ',')
-        
-        # --- TEXTO DE PAGAMENTO MODIFICADO ---
-        texto_instrucoes = (
-            f"🔑 *Seu Acesso ao Canal*\n\n"
-            f"Plano: *{tipo_plano.capitalize()}*\nValor: *R$ {valor_plano_str}*.\n\n"
-            f"Para finalizar, use o *PIX Copia e Cola* abaixo. Seu acesso será liberado automaticamente assim que o pagamento for confirmado.\n\n"
-            f"Após pagar, clique em *'Já paguei'* para fazer a verificação."
-        )
+        # --- LÓGICA DE NOTIFICAÇÃO PARA ADMIN MODIFICADA ---
+        # A expiração vem da assinatura, que já considera renovações antecipadas.
+        data_expiracao_formatada = formatar_data_brasilia(pagamento['expira_em'])
 
-        await query.edit_message_text(
-            text=texto_instrucoes,
-            parse_mode=constants.ParseMode.MARKDOWN,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ Já paguei, verificar acesso", callback_data="verificar")]])
-        )
-        
-        if context.user_data.get('pix_message_id'):
-            try:
-                await context.bot.delete_message(chat_id=user_id, message_id=context.user_data['pix_message_id'])
-            except BadRequest:
-                pass
-        
-        pix_copia_cola_escaped = html.escape(pix_copia_cola)
-        pix_message = await context.bot.send_message(
-            chat_id=user_id,
-            text=f"<pre><code>{pix_copia_cola_escaped}</code></pre>",
-            parse_mode=constants.ParseMode.HTML,
-            disable_web_page_preview=True
+        texto_notificacao_admin = (
+            f"🎉 Novo acesso <b>{tipo_plano_db.upper()}</b> liberado!\n\n"
+            f"Usuário: {html.escape(user_details)}\n"
+            f"🗓️ <b>Expira em:</b> {data_expiracao_formatada} (Horário de Brasília)"
         )
-        context.user_data['pix_message_id'] = pix_message.message_id
-        
-        conn = sqlite3.connect(DB_FILE, timeout=10)
-        try:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE pagamentos SET status = ? WHERE user_id = ? AND status = ?", ('cancelada', user_id, 'pendente'))
-            cursor.execute(
-                'INSERT INTO pagamentos (txid, user_id, username, status, pix_message_id, tipo_plano, valor) VALUES (?, ?, ?, ?, ?, ?, ?)',  
-                (txid_gerado, user_id, username, "pendente", pix_message.message_id, tipo_plano, valor_plano)
-            )
-            conn.commit()
-            logger.info(f"Cobrança {txid_gerado} (msg: {pix_message.message_id}, plano: {tipo_plano}) salva no DB para {user_id}.")
-        finally:
-            conn.close()
+
+        await despachante.notificar(ID_DONOS, texto_notificacao_admin, constants.ParseMode.HTML)
+    except Exception as e:
+        logger.error(f"Sucesso ao liberar acesso para {user_id}, mas falha ao notificar admins: {e}", exc_info=True)
+
+async def liberar_acesso_aprovado(application: Application, pagamento: dict):
+    """
+    liberar_acesso para aprovações fora do clique do usuário (reconciliação e webhook
+    da Efí), que rodam só no worker 0. A sessão de um usuário de outro worker só existe
+    lá, então ela é limpa por um aviso ao worker dele.
+    """
+    user_id = pagamento['user_id']
+    if pertence_a_este_worker(user_id):
+        await liberar_acesso(application.bot, pagamento, sessao=application.user_data.get(user_id))
     else:
-        logger.error(f"Falha crítica ao gerar cobrança Efí para {user_id}.")
-        await query.edit_message_text("❌ Algo deu errado ao gerar o pagamento. Por favor, contate o suporte.")
+        await liberar_acesso(application.bot, pagamento)
+        await avisar_acesso_liberado(user_id)
 
 async def verificar(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Verifica o status, e concede acesso conforme o plano."""
+    """
+    Verifica o status, e concede acesso conforme o plano.
+
+    Com o webhook da Efí ativo, a confirmação chega sozinha e este botão só consulta
+    o banco local, sem chamar a API.
+    """
     query = update.callback_query
     if not query or not query.from_user: return
     user_id = query.from_user.id
-    context.user_data['last_activity_time'] = datetime.now() # Registra atividade
+    context.user_data.registrar_atividade()
 
     await query.answer("Verificando seu pagamento, um momento...")
 
-    txid = None
-    tipo_plano_db = None
-    conn = sqlite3.connect(DB_FILE, timeout=10)
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT txid, tipo_plano FROM pagamentos WHERE user_id = ? AND status = 'pendente' ORDER BY data_criacao DESC LIMIT 1", (user_id,))
-        resultado_db = cursor.fetchone()
-        if resultado_db:
-            txid, tipo_plano_db = resultado_db
-    finally:
-        conn.close()
+    pendente = await repositorio.pendente_do_usuario(user_id)
 
-    if not txid:
+    if not pendente:
+        if await repositorio.aprovado_recentemente(user_id):
+            await query.edit_message_text(
+                "✅ Seu pagamento já foi confirmado! O link de acesso foi enviado aqui na conversa."
+            )
+            return
         await query.edit_message_text(
             "❌ Nenhuma cobrança ativa foi encontrada. Clique abaixo para gerar uma.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Escolher Plano de Acesso", callback_data="mostrar_planos")]])
+            reply_markup=TECLADO_ESCOLHER_PLANO_ACESSO
         )
         return
 
+    txid, tipo_plano_db = pendente
+
     try:
-        resultado_api = efi.pix_detail_charge(params={'txid': txid})
-        status_api = resultado_api.get('status')
+        if WEBHOOK_EFI_ATIVO:
+            status_api = "AGUARDANDO CONFIRMAÇÃO"
+        else:
+            resultado_api = await gateway.detalhar_cobranca(txid)
+            status_api = resultado_api.get('status')
 
         if status_api == 'CONCLUIDA':
-            conn = sqlite3.connect(DB_FILE, timeout=10)
-            try:
-                cursor = conn.cursor()
-                cursor.execute("UPDATE pagamentos SET status = ?, data_aprovacao = ? WHERE txid = ?", ('aprovado', datetime.now().isoformat(), txid))
-                conn.commit()
-            finally:
-                conn.close()
-
-            logger.info(f"PAGAMENTO APROVADO! Plano: {tipo_plano_db}, txid {txid} para usuário {user_id}.")
-
-            if context.user_data.get('pix_message_id'):
-                try:
-                    await context.bot.delete_message(chat_id=user_id, message_id=context.user_data['pix_message_id'])
-                except BadRequest: pass
-                finally: context.user_data.clear()
-            
-            try:
-                # --- TEXTOS DE SUCESSO MODIFICADOS ---
-                if tipo_plano_db == 'trimestral':
-                    texto_sucesso = (
-                        "<b>Acesso Trimestral Liberado!</b>\n\n"
-                        "Seu acesso de 93 dias está ativo. Aproveite todo o conteúdo exclusivo."
-                    )
-                else:  # Plano Mensal
-                    texto_sucesso = (
-                        "<b>Acesso Mensal Liberado!</b>\n\n"
-                        "Seu acesso de 31 dias está ativo. Aproveite todo o conteúdo exclusivo."
-                    )
-                
-                # A data de expiração precisa ser um Unix Timestamp (inteiro).
-                expire_time = datetime.now() + timedelta(hours=1)
-                expire_timestamp = int(expire_time.timestamp())
-
-                link = await context.bot.create_chat_invite_link(
-                    chat_id=ID_CANAL_PRIVADO,  
-                    member_limit=1,
-                    expire_date=expire_timestamp # Link expira em 1 hora
-                )
-                
-                safe_link = html.escape(link.invite_link)
-                
-                texto_final = (
-                    f"✅ Pagamento confirmado!\n\n{texto_sucesso}\n\n"
-                    f'Clique no link abaixo para entrar:\n<a href="{safe_link}">{safe_link}</a>\n\n'
-                    f"<i>Atenção: O link é de uso único e pessoal. Ele expira em breve.</i>"
-                )
-
+            pagamento = await repositorio.aprovar(txid)
+            if not pagamento:
+                # Outro caminho (ex.: webhook) aprovou e já enviou o link.
                 await query.edit_message_text(
-                    text=texto_final,
-                    parse_mode=constants.ParseMode.HTML,
-                    disable_web_page_preview=True
+                    "✅ Seu pagamento já foi confirmado! O link de acesso foi enviado aqui na conversa."
                 )
-            
-            except Exception as e:
-                logger.error(f"PAGAMENTO APROVADO, MAS FALHOU AO GERAR/ENVIAR LINK para {user_id} ({txid}): {e}", exc_info=True)
-                
-                texto_erro_html = (
-                    f"✅ Pagamento aprovado, mas tive um problema ao gerar seu link!\n\n"
-                    f"<b>Não se preocupe!</b> Contate o suporte informando seu ID (<code>{user_id}</code>) para receber o acesso."
-                )
-                await query.edit_message_text(
-                    text=texto_erro_html,
-                    parse_mode=constants.ParseMode.HTML,
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Falar com Suporte", url=LINK_SUPORTE)]])
-                )
-                return 
+                return
 
-            try:
-                user = query.from_user
-                user_details = f"{user.first_name or ''} (@{user.username or 'N/A'}, ID: {user.id})"
-                
-                # --- LÓGICA DE NOTIFICAÇÃO PARA ADMIN MODIFICADA ---
-                dias_expiracao = 0
-                if tipo_plano_db == 'trimestral':
-                    dias_expiracao = 93
-                elif tipo_plano_db == 'mensal':
-                    dias_expiracao = 31
-
-                data_expiracao_acesso = datetime.now() + timedelta(days=dias_expiracao)
-                brasilia_tz = pytz.timezone('America/Sao_Paulo')
-                expire_time_br = data_expiracao_acesso.astimezone(brasilia_tz)
-                data_expiracao_formatada = expire_time_br.strftime('%d/%m/%Y às %H:%M')
-                
-                texto_notificacao_admin = (
-                    f"🎉 Novo acesso <b>{tipo_plano_db.upper()}</b> liberado!\n\n"
-                    f"Usuário: {html.escape(user_details)}\n"
-                    f"🗓️ <b>Expira em:</b> {data_expiracao_formatada} (Horário de Brasília)"
-                )
-                
-                for admin_id in ID_DONOS:
-                    await context.bot.send_message(
-                        chat_id=admin_id,  
-                        text=texto_notificacao_admin,
-                        parse_mode=constants.ParseMode.HTML
-                    )
-            except Exception as e:
-                logger.error(f"Sucesso ao liberar acesso para {user_id}, mas falha ao notificar admins: {e}", exc_info=True)
+            logger.info(f"PAGAMENTO APROVADO! Plano: {tipo_plano_db}, txid {txid} para usuário {user_id}.")
+            await liberar_acesso(context.bot, pagamento, sessao=context.user_data, query=query, user=query.from_user)
 
         else:
-            safe_status_api = html.escape(status_api)
-            # --- TEXTO DE ESPERA MODIFICADO ---
-            texto_espera = (f"❌ Pagamento Pendente (status: <b>{safe_status_api}</b>).\n\n"
-                            "Se você já pagou, pode levar alguns minutos para o sistema confirmar. "
-                            "Aguarde um pouco e tente verificar novamente.")
-            
-            keyboard_falha = InlineKeyboardMarkup([
-                [InlineKeyboardButton("Tentar novamente", callback_data="verificar")],
-                [InlineKeyboardButton("⬅️ Escolher outro plano", callback_data="mostrar_planos")]
-            ])
+            safe_status_api = html.escape(str(status_api))
+            texto_espera = TEXTO_PAGAMENTO_PENDENTE.format(status=safe_status_api)
             try:
-                await query.edit_message_text(text=texto_espera, reply_markup=keyboard_falha, parse_mode=constants.ParseMode.HTML)
+                await query.edit_message_text(text=texto_espera, reply_markup=TECLADO_FALHA_VERIFICACAO, parse_mode=constants.ParseMode.HTML)
             except BadRequest as e:
                 if "Message is not modified" in str(e):
                     await query.answer("O status do pagamento ainda não mudou. Por favor, aguarde.", show_alert=True)
                 else:
                     raise 
 
+    except DisjuntorAberto:
+        try:
+            await query.edit_message_text(TEXTO_VERIFICACAO_INDISPONIVEL, reply_markup=TECLADO_FALHA_VERIFICACAO)
+        except BadRequest:
+            await query.answer("A consulta ao banco ainda está indisponível. Tente em instantes.", show_alert=True)
     except Exception as e:
         logger.error(f"Erro geral em 'verificar' para {user_id}: {e}", exc_info=True)
         try:
@@ -544,56 +3074,1029 @@ async def verificar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except BadRequest:  
             await query.answer("❌ Ocorreu um erro interno.", show_alert=True)
 
+# -----------------------------------------------------------------------------
+# ⌛ EXPIRAÇÃO DE ASSINATURAS
+# -----------------------------------------------------------------------------
+async def _chamar_com_limite(chamada, *args, **kwargs):
+    """Chama a Bot API respeitando o intervalo mínimo entre chamadas e o RetryAfter."""
+    try:
+        return await chamada(*args, **kwargs)
+    except RetryAfter as e:
+        espera = e.retry_after
+        await asyncio.sleep(espera.total_seconds() if isinstance(espera, timedelta) else espera)
+        return await chamada(*args, **kwargs)
+    finally:
+        await asyncio.sleep(EXPIRACAO_INTERVALO_CHAMADAS)
+
+async def remover_do_canal(bot: Bot, user_id: int):
+    """Remove o usuário do canal privado sem deixá-lo banido (ele pode voltar ao renovar)."""
+    try:
+        await _chamar_com_limite(bot.ban_chat_member, chat_id=ID_CANAL_PRIVADO, user_id=user_id)
+        await _chamar_com_limite(bot.unban_chat_member, chat_id=ID_CANAL_PRIVADO, user_id=user_id, only_if_banned=True)
+    except (BadRequest, Forbidden) as e:
+        # Usuário que já saiu do canal, ou admin que não pode ser removido.
+        logger.warning(f"Não foi possível remover {user_id} do canal privado: {e}")
+
+async def processar_expiracoes(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Job periódico: remove do canal quem venceu e lembra quem está perto de vencer.
+
+    As consultas usam índices parciais sobre `expira_em`, então cada execução só lê as
+    assinaturas que vencem agora, sem varrer a tabela. Cada usuário é marcado como
+    expirado logo depois de removido: se o bot cair no meio, a próxima execução segue
+    do primeiro que ficou sem marca (no máximo ele é removido de novo, o que é
+    idempotente). Um RetryAfter ou erro de rede na remoção de um usuário não
+    interrompe a varredura: ele fica sem marca para a próxima execução.
+    """
+    bot = context.bot
+    processados = 0
+    adiados = set()  # Remoções que falharam nesta execução; ficam para a próxima
+    while processados < EXPIRACAO_MAX_POR_EXECUCAO:
+        agora = int(time.time())
+        vencidas = [user_id for user_id in await repositorio.assinaturas_vencidas(agora, EXPIRACAO_LOTE + len(adiados))
+                    if user_id not in adiados]
+        if not vencidas:
+            break
+        for user_id in vencidas:
+            if user_id not in ID_DONOS:
+                try:
+                    await remover_do_canal(bot, user_id)
+                except (RetryAfter, NetworkError) as e:
+                    logger.warning(f"Remoção de {user_id} do canal adiada para a próxima execução: {e}")
+                    adiados.add(user_id)
+                    continue
+            await repositorio.marcar_expiradas([user_id], agora)
+            try:
+                await _chamar_com_limite(
+                    bot.send_message,
+                    chat_id=user_id,
+                    text="⌛ Seu acesso ao canal exclusivo expirou.\n\nQuer continuar com a gente? É só renovar abaixo.",
+                    reply_markup=TECLADO_RENOVAR
+                )
+            except (BadRequest, Forbidden, RetryAfter, NetworkError) as e:
+                logger.warning(f"Aviso de expiração não enviado para {user_id}: {e}")
+        processados += len(vencidas)
+        logger.info(f"{len(vencidas)} assinatura(s) vencida(s) processada(s); {len(adiados)} remoção(ões) adiada(s).")
+
+    lembretes = await repositorio.lembretes_pendentes(int(time.time()) + EXPIRACAO_AVISO_ANTECEDENCIA, EXPIRACAO_LOTE)
+    enviados = []
+    for user_id, expira_em in lembretes:
+        data_formatada = formatar_data_brasilia(expira_em)
+        try:
+            await _chamar_com_limite(
+                bot.send_message,
+                chat_id=user_id,
+                text=f"⏰ Seu acesso ao canal exclusivo expira em {data_formatada} (Horário de Brasília).\n\n"
+                     "Renove agora para não perder nada. O tempo que ainda resta é somado ao novo plano.",
+                reply_markup=TECLADO_RENOVAR
+            )
+        except (BadRequest, Forbidden):
+            pass
+        except (RetryAfter, NetworkError) as e:
+            # Sem marca: o lembrete é tentado de novo na próxima execução.
+            logger.warning(f"Lembrete de renovação para {user_id} adiado: {e}")
+            continue
+        enviados.append(user_id)
+    if enviados:
+        await repositorio.marcar_lembretes_enviados(enviados)
+        logger.info(f"{len(enviados)} lembrete(s) de renovação enviado(s).")
+
+# -----------------------------------------------------------------------------
+# 📣 TRANSMISSÕES EM MASSA (/broadcast)
+# -----------------------------------------------------------------------------
+class BaldeDeFichas:
+    """
+    Token bucket assíncrono: libera em média `taxa` chamadas por segundo, com
+    rajadas de até `capacidade`. Quem espera é atendido em ordem de chegada.
+    `pausar()` segura todos os envios, usado quando o Telegram devolve RetryAfter.
+    `relogio` e `dormir` podem ser trocados por um relógio falso nos testes.
+    """
+    def __init__(self, taxa: float, capacidade: float | None = None, relogio=time.monotonic, dormir=asyncio.sleep):
+        self.taxa = taxa
+        self.capacidade = capacidade or taxa
+        self._relogio = relogio
+        self._dormir = dormir
+        self._fichas = self.capacidade
+        self._atualizado = relogio()
+        self._pausado_ate = 0.0
+        self._trava = asyncio.Lock()
+
+    def pausar(self, segundos: float):
+        self._pausado_ate = max(self._pausado_ate, self._relogio() + segundos)
+        self._atualizado = self._pausado_ate
+        self._fichas = 0
+
+    async def retirar(self):
+        async with self._trava:
+            while True:
+                agora = self._relogio()
+                if agora < self._pausado_ate:
+                    await self._dormir(self._pausado_ate - agora)
+                    continue
+                self._fichas = min(self.capacidade, self._fichas + (agora - self._atualizado) * self.taxa)
+                self._atualizado = agora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    return
+                await self._dormir((1 - self._fichas) / self.taxa)
+
+
+class Transmissor:
+    """
+    Envia uma mensagem a todo um público (assinantes ativos, clientes ou todos que
+    já geraram cobrança), lendo os destinatários do banco página por página.
+
+    Todos os envios passam por um único BaldeDeFichas, que respeita o limite global
+    do Telegram; cada destinatário recebe uma só mensagem, então o limite por chat
+    só importa nas novas tentativas, que já esperam o RetryAfter.
+
+    No máximo `simultaneas` envios ficam em voo, e eles são confirmados na ordem dos
+    user_ids: tudo até o último confirmado já terminou. O progresso (último user_id
+    confirmado e contadores) é salvo a cada `simultaneas` confirmações e ao parar.
+    A entrega é "pelo menos uma vez": numa queda do processo, no máximo
+    2 x `simultaneas` - 1 destinatários (os em voo e os confirmados desde o último
+    salvamento) recebem a mensagem de novo; num desligamento normal, só os em voo.
+    """
+    def __init__(self, taxa: float = TRANSMISSAO_TAXA, lote: int = TRANSMISSAO_LOTE,
+                 tentativas: int = TRANSMISSAO_TENTATIVAS, intervalo_relatorio: float = TRANSMISSAO_RELATORIO,
+                 simultaneas: int = TRANSMISSAO_SIMULTANEAS):
+        self.balde = BaldeDeFichas(taxa)
+        self.lote = lote
+        self.simultaneas = max(1, simultaneas)
+        self.tentativas = tentativas
+        self.intervalo_relatorio = intervalo_relatorio
+        self._ativas = {}  # id da transmissão -> (dados da transmissão, asyncio.Task)
+
+    def em_andamento(self) -> list:
+        return [dict(transmissao) for transmissao, _ in self._ativas.values()]
+
+    def iniciar(self, bot: Bot, transmissao: dict):
+        tarefa = asyncio.create_task(self._executar(bot, transmissao))
+        self._ativas[transmissao['id']] = (transmissao, tarefa)
+        tarefa.add_done_callback(lambda _: self._ativas.pop(transmissao['id'], None))
+
+    async def retomar(self, bot: Bot):
+        """Retoma as transmissões interrompidas por um reinício (no modo multiprocesso, as dos admins deste worker)."""
+        for transmissao in await repositorio.transmissoes_em_andamento():
+            if not pertence_a_este_worker(transmissao['admin_id']):
+                continue
+            logger.info(f"Retomando a transmissão {transmissao['id']} após o user_id {transmissao['ultimo_user_id']}.")
+            self.iniciar(bot, transmissao)
+
+    async def cancelar(self, transmissao_id: int) -> bool:
+        """Cancela de vez uma transmissão (ela não volta no próximo início)."""
+        ativa = self._ativas.get(transmissao_id)
+        if not ativa:
+            return False
+        transmissao, tarefa = ativa
+        transmissao['cancelada'] = True
+        tarefa.cancel()
+        try:
+            await tarefa
+        except asyncio.CancelledError:
+            pass
+        return True
+
+    async def parar(self):
+        """Interrompe as transmissões sem marcá-las como canceladas: elas voltam no próximo início."""
+        tarefas = [tarefa for _, tarefa in self._ativas.values()]
+        for tarefa in tarefas:
+            tarefa.cancel()
+        await asyncio.gather(*tarefas, return_exceptions=True)
+
+    async def _enviar(self, bot: Bot, user_id: int, texto: str) -> str:
+        for _ in range(self.tentativas):
+            await self.balde.retirar()
+            try:
+                await bot.send_message(chat_id=user_id, text=texto, disable_web_page_preview=True)
+                return 'enviados'
+            except RetryAfter as e:
+                espera = e.retry_after
+                self.balde.pausar(espera.total_seconds() if isinstance(espera, timedelta) else espera)
+            except Forbidden:
+                return 'bloqueados'
+            except BadRequest as e:
+                logger.warning(f"Transmissão: mensagem para {user_id} recusada: {e}")
+                return 'falhas'
+            except Exception as e:
+                logger.warning(f"Transmissão: erro ao enviar para {user_id}: {e}")
+        return 'falhas'
+
+    async def _executar(self, bot: Bot, transmissao: dict):
+        inicio = time.monotonic()
+        enviados_no_inicio = transmissao['enviados'] + transmissao['bloqueados'] + transmissao['falhas']
+        proximo_relatorio = inicio + self.intervalo_relatorio
+        em_voo = collections.deque()  # (user_id, tarefa de envio), em ordem crescente de user_id
+        ultimo_lido = transmissao['ultimo_user_id']
+        sem_salvar = 0
+
+        async def confirmar():
+            """Espera o envio mais antigo em voo e conta o resultado; salva o progresso a cada `simultaneas`."""
+            nonlocal sem_salvar
+            user_id, envio = em_voo[0]
+            resultado = await envio
+            em_voo.popleft()
+            transmissao[resultado] += 1
+            metricas.incrementar("transmissao_mensagens_total", (("resultado", resultado),))
+            transmissao['ultimo_user_id'] = user_id
+            sem_salvar += 1
+            if sem_salvar >= self.simultaneas:
+                sem_salvar = 0
+                await repositorio.salvar_progresso_transmissao(transmissao)
+
+        try:
+            while True:
+                pagina = await repositorio.destinatarios(transmissao['publico'], ultimo_lido, self.lote)
+                if not pagina:
+                    break
+                for user_id in pagina:
+                    if len(em_voo) >= self.simultaneas:
+                        await confirmar()
+                    while em_voo and em_voo[0][1].done():
+                        await confirmar()
+                    em_voo.append((user_id, asyncio.create_task(self._enviar(bot, user_id, transmissao['texto']))))
+                ultimo_lido = pagina[-1]
+                if time.monotonic() >= proximo_relatorio:
+                    proximo_relatorio += self.intervalo_relatorio
+                    logger.info(f"Transmissão {transmissao['id']}: {self._resumo(transmissao, inicio, enviados_no_inicio)}")
+            while em_voo:
+                await confirmar()
+            status = 'concluida'
+        except asyncio.CancelledError:
+            # Desligamento (parar) mantém 'em_andamento' para retomar; só o /broadcast cancelar encerra de vez.
+            await repositorio.salvar_progresso_transmissao(transmissao, 'cancelada' if transmissao.get('cancelada') else 'em_andamento')
+            raise
+        except Exception as e:
+            logger.error(f"Transmissão {transmissao['id']} interrompida por erro: {e}", exc_info=True)
+            with contextlib.suppress(Exception):
+                await repositorio.salvar_progresso_transmissao(transmissao)
+            try:
+                await bot.send_message(
+                    chat_id=transmissao['admin_id'],
+                    text=f"❗️Transmissão {transmissao['id']} interrompida por erro: {e}\n\n"
+                         f"{self._resumo(transmissao, inicio, enviados_no_inicio)}.\n"
+                         f"Ela será retomada do ponto salvo no próximo início do bot "
+                         f"(ou use /broadcast cancelar {transmissao['id']})."
+                )
+            except Exception as erro_aviso:
+                logger.error(f"Não foi possível avisar o admin {transmissao['admin_id']} sobre a transmissão {transmissao['id']}: {erro_aviso}")
+            return
+        finally:
+            for _, envio in em_voo:
+                envio.cancel()
+
+        await repositorio.salvar_progresso_transmissao(transmissao, status)
+        resumo = self._resumo(transmissao, inicio, enviados_no_inicio)
+        logger.info(f"Transmissão {transmissao['id']} concluída: {resumo}")
+        try:
+            await bot.send_message(chat_id=transmissao['admin_id'], text=f"📣 Transmissão {transmissao['id']} concluída.\n\n{resumo}")
+        except (BadRequest, Forbidden):
+            pass
+
+    @staticmethod
+    def _resumo(transmissao: dict, inicio: float, processados_no_inicio: int) -> str:
+        segundos = max(time.monotonic() - inicio, 1e-9)
+        processados = transmissao['enviados'] + transmissao['bloqueados'] + transmissao['falhas'] - processados_no_inicio
+        return (f"{transmissao['enviados']} enviada(s), {transmissao['bloqueados']} bloqueado(s), "
+                f"{transmissao['falhas']} falha(s); {processados} nesta execução em {segundos:.0f}s "
+                f"({processados / segundos:.1f} msg/s)")
+
+
+transmissor = Transmissor()
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /broadcast <assinantes|clientes|todos> <mensagem>  — inicia uma transmissão
+    /broadcast cancelar <id>                          — cancela uma transmissão
+    /broadcast status                                 — lista as transmissões em andamento
+    Restrito aos admins de ID_DONOS.
+    """
+    user = update.effective_user
+    mensagem = update.effective_message
+    if not user or not mensagem or user.id not in ID_DONOS:
+        return
+    partes = (mensagem.text or "").split(maxsplit=2)
+    acao = partes[1].lower() if len(partes) > 1 else ""
+
+    if acao == "status":
+        linhas = [f"#{t['id']} ({t['publico']}): {t['enviados']} enviada(s), {t['bloqueados']} bloqueado(s), "
+                  f"{t['falhas']} falha(s)" for t in transmissor.em_andamento()]
+        await mensagem.reply_text("📣 Transmissões em andamento:\n" + "\n".join(linhas) if linhas else "📣 Nenhuma transmissão em andamento.")
+        return
+
+    if acao == "cancelar" and len(partes) == 3 and partes[2].isdigit():
+        transmissao_id = int(partes[2])
+        cancelada = await transmissor.cancelar(transmissao_id)
+        await mensagem.reply_text(f"📣 Transmissão {transmissao_id} cancelada." if cancelada else f"❗️Transmissão {transmissao_id} não está em andamento.")
+        return
+
+    if acao in RepositorioPagamentos.CONSULTAS_PUBLICO and len(partes) == 3:
+        texto = partes[2]
+        transmissao_id = await repositorio.criar_transmissao(user.id, acao, texto)
+        transmissor.iniciar(context.bot, {
+            'id': transmissao_id, 'admin_id': user.id, 'publico': acao, 'texto': texto,
+            'ultimo_user_id': 0, 'enviados': 0, 'bloqueados': 0, 'falhas': 0,
+        })
+        logger.info(f"Admin {user.id} iniciou a transmissão {transmissao_id} para '{acao}'.")
+        await mensagem.reply_text(f"📣 Transmissão {transmissao_id} iniciada para '{acao}' "
+                                  f"(até {TRANSMISSAO_TAXA} mensagens/s). Você receberá um resumo ao final.")
+        return
+
+    await mensagem.reply_text(
+        "Uso:\n"
+        "/broadcast <assinantes|clientes|todos> <mensagem>\n"
+        "/broadcast cancelar <id>\n"
+        "/broadcast status"
+    )
+
+# -----------------------------------------------------------------------------
+# 📈 RELATÓRIOS DE VENDAS (/relatorio)
+# -----------------------------------------------------------------------------
+def _formatar_duracao(segundos: float) -> str:
+    segundos = int(segundos)
+    if segundos < 60:
+        return f"{segundos} s"
+    if segundos < 3600:
+        return f"{segundos // 60} min {segundos % 60:02d} s"
+    return f"{segundos // 3600} h {segundos % 3600 // 60:02d} min"
+
+def _taxa_conversao(aprovadas: int, cobrancas: int) -> str:
+    return f"{aprovadas / cobrancas * 100:.1f}%".replace(".", ",") if cobrancas else "—"
+
+async def montar_relatorio(dias: int) -> str:
+    """Texto (HTML) do relatório dos últimos `dias` dias, a partir de vendas_diarias."""
+    desde_dia = formatar_data_brasilia(time.time() - (dias - 1) * 86400, '%Y-%m-%d')
+    linhas = await repositorio.vendas_por_dia(desde_dia)
+
+    por_plano = collections.defaultdict(lambda: [0, 0, 0, 0])
+    por_dia = collections.defaultdict(lambda: [0, 0])
+    for dia, tipo_plano, cobrancas, aprovadas, receita, segundos in linhas:
+        totais = por_plano[tipo_plano]
+        totais[0] += cobrancas
+        totais[1] += aprovadas
+        totais[2] += receita
+        totais[3] += segundos
+        por_dia[dia][0] += receita
+        por_dia[dia][1] += aprovadas
+
+    cobrancas, aprovadas, receita, segundos = (sum(coluna) for coluna in zip(*por_plano.values())) if por_plano else (0, 0, 0, 0)
+    inicio = datetime.strptime(desde_dia, '%Y-%m-%d').strftime('%d/%m/%Y')
+    texto = [
+        f"📈 <b>Vendas dos últimos {dias} dia(s)</b> (desde {inicio})\n",
+        f"💰 Receita: <b>R$ {formatar_centavos(receita)}</b> em {aprovadas} venda(s)",
+        f"🧾 Cobranças geradas: {cobrancas} • Conversão: {_taxa_conversao(aprovadas, cobrancas)}",
+        f"⏱️ Tempo médio até o pagamento: {_formatar_duracao(segundos / aprovadas) if aprovadas else '—'}",
+    ]
+    if por_plano:
+        texto.append("\n<b>Por plano</b>")
+        for tipo_plano, (c, a, r, _) in sorted(por_plano.items()):
+            texto.append(f"• {html.escape(tipo_plano.capitalize())}: {a} venda(s), R$ {formatar_centavos(r)} "
+                         f"(conversão {_taxa_conversao(a, c)})")
+    if por_dia and dias <= 31:
+        texto.append("\n<b>Por dia</b>")
+        for dia, (r, a) in sorted(por_dia.items(), reverse=True):
+            texto.append(f"{dia[8:10]}/{dia[5:7]}: R$ {formatar_centavos(r)} ({a})")
+    return "\n".join(texto)
+
+async def exportar_csv_pagamentos(arquivo, desde: int) -> int:
+    """
+    Escreve em `arquivo` (binário) o CSV, compactado com gzip, dos pagamentos criados
+    a partir de `desde`, página por página. A compressão e a escrita em disco rodam
+    numa thread, fora do event loop. Retorna o número de linhas exportadas.
+    """
+    with gzip.open(arquivo, "wt", encoding="utf-8", newline="") as texto:
+        escritor = csv.writer(texto)
+        await asyncio.to_thread(escritor.writerow, RepositorioPagamentos.COLUNAS_EXPORTACAO)
+        total = 0
+        async for pagina in repositorio.paginas_pagamentos(desde, RELATORIO_CSV_PAGINA):
+            await asyncio.to_thread(escritor.writerows, pagina)
+            total += len(pagina)
+    return total
+
+async def relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /relatorio [dias]      — receita, vendas por plano, conversão e tempo até o pagamento
+    /relatorio csv [dias]  — exporta os pagamentos do período em CSV compactado (.csv.gz)
+    Restrito aos admins de ID_DONOS.
+    """
+    user = update.effective_user
+    mensagem = update.effective_message
+    if not user or not mensagem or user.id not in ID_DONOS:
+        return
+    partes = (mensagem.text or "").split()[1:]
+    exportar = bool(partes) and partes[0].lower() == "csv"
+    if exportar:
+        partes = partes[1:]
+    if len(partes) > 1 or (partes and not (partes[0].isdigit() and 1 <= int(partes[0]) <= RELATORIO_DIAS_MAXIMO)):
+        await mensagem.reply_text(
+            "Uso:\n"
+            f"/relatorio [dias]  (1 a {RELATORIO_DIAS_MAXIMO}, padrão {RELATORIO_DIAS})\n"
+            "/relatorio csv [dias]"
+        )
+        return
+
+    dias = int(partes[0]) if partes else RELATORIO_DIAS
+    if not exportar:
+        await mensagem.reply_text(await montar_relatorio(dias), parse_mode=constants.ParseMode.HTML)
+        return
+
+    # A partir da meia-noite (Brasília) do primeiro dia do período.
+    primeiro_dia = datetime.now(FUSO_BRASILIA).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=dias - 1)
+    with tempfile.TemporaryFile() as arquivo:
+        total = await exportar_csv_pagamentos(arquivo, int(primeiro_dia.timestamp()))
+        tamanho = arquivo.tell()
+        if tamanho > RELATORIO_CSV_LIMITE:
+            await mensagem.reply_text(
+                f"⚠️ O CSV de {dias} dia(s) ficou com {tamanho / 1024 / 1024:.0f} MB, acima do limite de "
+                f"{RELATORIO_CSV_LIMITE // 1024 // 1024} MB do Telegram. Peça um período menor."
+            )
+            logger.warning(f"Admin {user.id} pediu CSV de {dias} dia(s) com {tamanho} bytes; acima do limite, não enviado.")
+            return
+        arquivo.seek(0)
+        nome = f"pagamentos_{datetime.now(FUSO_BRASILIA).strftime('%Y%m%d_%H%M')}.csv.gz"
+        await mensagem.reply_document(document=arquivo, filename=nome, caption=f"📄 {total} pagamento(s) exportado(s) de {dias} dia(s).")
+    logger.info(f"Admin {user.id} exportou {total} pagamento(s) de {dias} dia(s) em CSV.")
+
+# -----------------------------------------------------------------------------
+# 🔄 RECONCILIAÇÃO PERIÓDICA DE COBRANÇAS
+# -----------------------------------------------------------------------------
+async def reconciliar_pendentes(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Job periódico: busca na Efí, com uma única listagem paginada, todas as cobranças
+    da janela recente e compara com as pendentes do banco. Aprova as pagas (mesmo
+    que o usuário nunca tenha clicado em "Já paguei") e expira as vencidas. Roda
+    mesmo sem pendentes no banco: uma cobrança já cancelada ainda pode ter sido paga.
+    """
+    pendentes = await repositorio.listar_pendentes()
+
+    agora = datetime.now(timezone.utc)
+    inicio_janela = agora - timedelta(seconds=RECONCILIADOR_JANELA)
+    criacao = {txid: datetime.fromtimestamp(data, timezone.utc) for txid, data in pendentes}
+    inicio = inicio_janela - timedelta(minutes=1)
+    if pool_cobrancas.profundidade > 0:
+        # Cobranças do pool são criadas na Efí até `validade` segundos antes de serem registradas no banco.
+        inicio -= timedelta(seconds=pool_cobrancas.validade)
+
+    try:
+        cobrancas = await gateway.listar_cobrancas(inicio, agora)
+    except Exception as e:
+        logger.error(f"Falha ao listar cobranças na Efí para reconciliação: {e}")
+        return
+    status_efi = {c.get('txid'): c.get('status') for c in cobrancas}
+
+    # Qualquer cobrança paga na janela é aprovada, inclusive uma antiga que o usuário
+    # pagou depois de gerar outra (já cancelada no banco).
+    aprovar = [txid for txid, status in status_efi.items() if status == 'CONCLUIDA']
+    vencimento = agora - timedelta(seconds=EXPIRACAO_COBRANCA + 300)
+    expirar = [
+        txid for txid, criada_em in criacao.items()
+        if (status_efi.get(txid) or '').startswith('REMOVIDA')
+        or (status_efi.get(txid) != 'CONCLUIDA' and criada_em < vencimento
+            and (txid in status_efi or criada_em < inicio_janela))
+    ]
+
+    aprovados = await repositorio.reconciliar(aprovar, expirar)
+    if aprovados or expirar:
+        logger.info(f"Reconciliação: {len(aprovados)} aprovada(s), {len(expirar)} expirada(s) de {len(pendentes)} pendente(s).")
+
+    for pagamento in aprovados:
+        user_id = pagamento['user_id']
+        logger.info(f"PAGAMENTO APROVADO via reconciliação! Plano: {pagamento['tipo_plano']}, txid {pagamento['txid']} para usuário {user_id}.")
+        await liberar_acesso_aprovado(context.application, pagamento)
+
+# -----------------------------------------------------------------------------
+# 📬 WEBHOOK DE NOTIFICAÇÕES PIX DA EFÍ
+# -----------------------------------------------------------------------------
+CHAVE_APLICACAO = web.AppKey("aplicacao", Application)
+_webhook_efi_runner: web.AppRunner | None = None
+
+async def processar_notificacao_pix(application: Application, payload: dict) -> int:
+    """
+    Aprova as cobranças de uma notificação da Efí (`{"pix": [{"txid": ...}, ...]}`)
+    e envia o link de acesso a cada usuário. Retorna quantas foram liberadas.
+    """
+    liberados = 0
+    for pix in payload.get('pix') or []:
+        txid = pix.get('txid')
+        if not txid:
+            continue
+        pagamento = await repositorio.aprovar(txid)
+        if not pagamento:
+            continue  # Desconhecida, ou já aprovada pelo botão "Já paguei"
+
+        user_id = pagamento['user_id']
+        logger.info(f"PAGAMENTO APROVADO via webhook! Plano: {pagamento['tipo_plano']}, txid {txid} para usuário {user_id}.")
+        await liberar_acesso_aprovado(application, pagamento)
+        liberados += 1
+    return liberados
+
+async def receber_webhook_efi(request: web.Request) -> web.Response:
+    """Endpoint HTTP chamado pela Efí a cada PIX recebido."""
+    # Comparação em tempo constante: o segredo não vaza pelo tempo de resposta.
+    if not hmac.compare_digest(request.query.get('hmac', '').encode(), WEBHOOK_EFI_SEGREDO.encode()):
+        return web.Response(status=403)
+    try:
+        payload = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    if not isinstance(payload, dict):
+        return web.Response(status=400)
+
+    liberados = await processar_notificacao_pix(request.app[CHAVE_APLICACAO], payload)
+    return web.json_response({"liberados": liberados})
+
+def criar_app_webhook_efi(application: Application) -> web.Application:
+    """
+    Monta o app aiohttp do webhook. A Efí acrescenta "/pix" à URL cadastrada, por isso
+    as duas rotas são aceitas.
+    """
+    app_web = web.Application()
+    app_web[CHAVE_APLICACAO] = application
+    app_web.router.add_post(WEBHOOK_EFI_CAMINHO, receber_webhook_efi)
+    app_web.router.add_post(f"{WEBHOOK_EFI_CAMINHO}/pix", receber_webhook_efi)
+    return app_web
+
+async def iniciar_webhook_efi(application: Application):
+    """Sobe o servidor do webhook no mesmo loop de eventos do bot."""
+    global _webhook_efi_runner
+    if not WEBHOOK_EFI_SEGREDO:
+        logger.error("WEBHOOK_EFI_ATIVO está ligado, mas WEBHOOK_EFI_SEGREDO está vazio. Webhook não iniciado.")
+        return
+    _webhook_efi_runner = web.AppRunner(criar_app_webhook_efi(application))
+    await _webhook_efi_runner.setup()
+    await web.TCPSite(_webhook_efi_runner, WEBHOOK_EFI_HOST, WEBHOOK_EFI_PORTA).start()
+    logger.info(f"Webhook da Efí ouvindo em {WEBHOOK_EFI_HOST}:{WEBHOOK_EFI_PORTA}{WEBHOOK_EFI_CAMINHO}")
+
+async def parar_webhook_efi():
+    global _webhook_efi_runner
+    if _webhook_efi_runner:
+        await _webhook_efi_runner.cleanup()
+        _webhook_efi_runner = None
+
 async def handle_any_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Reinicia o bot se o usuário estiver inativo ou sem um processo em andamento."""
     if not update.message or not update.message.from_user:
         return
 
     user_id = update.message.from_user.id
-    last_activity = context.user_data.get('last_activity_time')
-
-    if not last_activity or (datetime.now() - last_activity > timedelta(minutes=10)):
+    # A própria atualização ainda não registrou atividade: a sessão guarda a interação anterior.
+    if context.user_data.inativa_ha() > SESSAO_INATIVIDADE:
         logger.info(f"Usuário inativo {user_id} enviou uma mensagem. Reiniciando o fluxo.")
         await start(update, context)
     else:
         logger.info(f"Usuário ativo {user_id} enviou uma mensagem de texto no meio do fluxo. Ignorando.")
 
 
+# -----------------------------------------------------------------------------
+# 🔀 PROCESSAMENTO CONCORRENTE DE ATUALIZAÇÕES
+# -----------------------------------------------------------------------------
+class ProcessadorPorUsuario(BaseUpdateProcessor):
+    """
+    Processa atualizações de usuários diferentes em paralelo, mas as de um mesmo
+    usuário uma de cada vez e na ordem de chegada. A trava do usuário é obtida
+    antes da vaga global, para que quem clica sem parar não ocupe todas as vagas
+    esperando a própria vez.
+
+    Com um `limitador`, cada clique é conferido na chegada, antes da trava: o
+    recusado recebe só o answer e nunca espera o handler em andamento do usuário.
+    """
+    def __init__(self, max_concurrent_updates: int, limitador: LimitadorCliques | None = None):
+        super().__init__(max_concurrent_updates)
+        self.limitador = limitador
+        self._travas = {}  # user_id -> [asyncio.Lock, atualizações aguardando]
+
+    async def process_update(self, update: object, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if not user:
+            await super().process_update(update, coroutine)
+            return
+
+        if self.limitador is not None and update.callback_query:
+            motivo = self.limitador.recusar(user.id, update.callback_query.data or "")
+            if motivo:
+                coroutine.close()  # Os handlers nem chegam a rodar
+                await recusar_clique(update, motivo)
+                return
+
+        entrada = self._travas.get(user.id)
+        if entrada is None:
+            entrada = self._travas[user.id] = [asyncio.Lock(), 0]
+        entrada[1] += 1
+        try:
+            async with entrada[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entrada[1] -= 1
+            if not entrada[1]:
+                del self._travas[user.id]
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# -----------------------------------------------------------------------------
+# 🧩 MODO MULTIPROCESSO: FRONT + WORKERS
+# -----------------------------------------------------------------------------
+# O front só recebe o webhook do Telegram e repassa cada atualização, como uma linha
+# JSON, por uma conexão TCP local ao worker do usuário. Como cada usuário sempre cai
+# no mesmo worker e cada conexão entrega as linhas em ordem, a ordem por usuário se
+# mantém (e o ProcessadorPorUsuario de cada worker a preserva dali em diante).
+#
+# Estado compartilhado: o pagamentos.db em WAL. Cada worker tem seu repositório, com
+# sua tarefa escritora; entre processos, o BEGIN IMMEDIATE com busy timeout serializa
+# as transações. Sessões, travas de checkout, cache da Efí e pools ficam em memória no
+# worker, o que é correto porque o usuário nunca muda de worker. Tarefas que não podem
+# rodar em dobro (reconciliação, expiração, webhook da Efí) ficam só no worker 0; quando
+# elas aprovam o pagamento de um usuário de outro worker, avisam esse worker pela porta
+# dele para que a sessão seja limpa lá.
+def worker_do_usuario(user_id: int, total: int) -> int:
+    return user_id % total
+
+def pertence_a_este_worker(user_id: int) -> bool:
+    return worker_do_usuario(user_id, WORKER_TOTAL) == WORKER_INDICE
+
+def eh_worker_principal() -> bool:
+    """O worker 0 (ou o processo único) roda as tarefas que não podem rodar em dobro."""
+    return WORKER_INDICE == 0
+
+def usuario_da_atualizacao(dados: dict) -> int:
+    """user_id (ou chat_id) de uma atualização ainda em JSON; 0 se ela não tiver nenhum."""
+    for chave, valor in dados.items():
+        if chave != "update_id" and isinstance(valor, dict):
+            origem = valor.get("from") or valor.get("user") or valor.get("chat")
+            if isinstance(origem, dict) and isinstance(origem.get("id"), int):
+                return origem["id"]
+    return 0
+
+AVISO_ACESSO_LIBERADO = "acesso_liberado"  # Linha {"acesso_liberado": user_id} entre workers, fora do protocolo do Telegram
+
+async def avisar_acesso_liberado(user_id: int):
+    """Pede ao worker do usuário que limpe a sessão dele, pela mesma porta local usada pelo front."""
+    indice = worker_do_usuario(user_id, WORKER_TOTAL)
+    try:
+        _, escritor = await asyncio.open_connection(WORKERS_HOST, WORKERS_PORTA_BASE + indice)
+        try:
+            escritor.write(json.dumps({AVISO_ACESSO_LIBERADO: user_id}).encode() + b"\n")
+            await escritor.drain()
+        finally:
+            escritor.close()
+    except OSError as e:
+        logger.warning(f"Não foi possível avisar o worker {indice} do acesso liberado para {user_id}: {e}")
+
+class RoteadorAtualizacoes:
+    """Lado do front: uma conexão por worker e o envio de cada atualização ao worker do usuário."""
+
+    def __init__(self, total: int, host: str = WORKERS_HOST, porta_base: int = WORKERS_PORTA_BASE):
+        self.total = total
+        self.host = host
+        self.porta_base = porta_base
+        self.encaminhadas = [0] * total
+        self._escritores: list = [None] * total
+        self._travas = [asyncio.Lock() for _ in range(total)]
+
+    async def _conexao(self, indice: int, tempo_maximo: float = 0):
+        escritor = self._escritores[indice]
+        if escritor is not None and not escritor.is_closing():
+            return escritor
+        limite = time.monotonic() + tempo_maximo
+        while True:
+            try:
+                _, escritor = await asyncio.open_connection(self.host, self.porta_base + indice)
+                self._escritores[indice] = escritor
+                return escritor
+            except OSError:
+                if time.monotonic() >= limite:
+                    raise
+                await asyncio.sleep(0.2)
+
+    async def conectar(self, tempo_maximo: float = 60):
+        """Espera todos os workers aceitarem conexão (eles demoram alguns segundos para subir)."""
+        await asyncio.gather(*(self._conexao(indice, tempo_maximo) for indice in range(self.total)))
+
+    async def encaminhar(self, corpo: bytes) -> int:
+        """
+        Envia o corpo JSON de uma atualização ao worker do usuário e retorna o índice
+        dele. Quebras de linha fora de strings são só espaço em JSON, então trocá-las
+        por espaços mantém uma atualização por linha sem reserializar.
+        """
+        indice = worker_do_usuario(usuario_da_atualizacao(json.loads(corpo)), self.total)
+        async with self._travas[indice]:
+            escritor = await self._conexao(indice)
+            try:
+                escritor.write(corpo.replace(b"\n", b" ") + b"\n")
+                await escritor.drain()
+            except (ConnectionError, OSError):
+                self._escritores[indice] = None
+                raise
+        self.encaminhadas[indice] += 1
+        return indice
+
+    def desconectar(self, indice: int):
+        """Descarta a conexão com um worker (ex.: depois de reiniciá-lo)."""
+        escritor, self._escritores[indice] = self._escritores[indice], None
+        if escritor is not None:
+            escritor.close()
+
+    async def fechar(self):
+        for indice in range(self.total):
+            self.desconectar(indice)
+
+async def servir_worker(application: Application, host: str, porta: int, parada: asyncio.Event | None = None):
+    """
+    Lado do worker: roda a Application sem Updater, recebendo as atualizações do front
+    pela porta local, até `parada` (ou SIGTERM/SIGINT).
+    """
+    parada = parada or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sinal in (signal.SIGTERM, signal.SIGINT):
+        with contextlib.suppress(NotImplementedError, RuntimeError):
+            loop.add_signal_handler(sinal, parada.set)
+
+    async def receber(leitor: asyncio.StreamReader, escritor: asyncio.StreamWriter):
+        try:
+            while linha := await leitor.readline():
+                dados = json.loads(linha)
+                if AVISO_ACESSO_LIBERADO in dados:
+                    sessao = application.user_data.get(dados[AVISO_ACESSO_LIBERADO])
+                    if sessao is not None:
+                        sessao.limpar()
+                    continue
+                await application.update_queue.put(Update.de_json(dados, application.bot))
+        except (ConnectionError, ValueError) as e:
+            logger.error(f"Conexão com o front encerrada com erro: {e}")
+        finally:
+            escritor.close()
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    servidor = await asyncio.start_server(receber, host, porta, limit=2 ** 20)
+    logger.info(f"Worker {WORKER_INDICE + 1}/{WORKER_TOTAL} recebendo atualizações em {host}:{porta}.")
+    try:
+        await parada.wait()
+    finally:
+        servidor.close()
+        await servidor.wait_closed()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def executar_worker(indice: int, total: int, fabrica=None):
+    """Ponto de entrada do processo worker. `fabrica()` monta a Application (padrão: criar_aplicacao)."""
+    global WORKER_INDICE, WORKER_TOTAL
+    WORKER_INDICE, WORKER_TOTAL = indice, total
+    configurar_logs()
+    if sys.platform == "win32":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    application = (fabrica or criar_aplicacao)()
+    asyncio.run(servir_worker(application, WORKERS_HOST, WORKERS_PORTA_BASE + indice))
+
+def iniciar_processo_worker(indice: int, total: int, fabrica=None) -> multiprocessing.Process:
+    # "spawn" em todas as plataformas: o worker não herda o loop nem as conexões do front.
+    processo = multiprocessing.get_context("spawn").Process(
+        target=executar_worker, args=(indice, total, fabrica), name=f"worker-{indice}", daemon=False
+    )
+    processo.start()
+    return processo
+
+async def executar_front(total: int):
+    """
+    Processo front: sobe os workers, recebe o webhook do Telegram e repassa cada
+    atualização. Um worker que morre é reiniciado; enquanto ele não volta, o front
+    responde 503 e o Telegram reenvia a atualização depois.
+    """
+    processos = [iniciar_processo_worker(indice, total) for indice in range(total)]
+    roteador = RoteadorAtualizacoes(total)
+    parada = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sinal in (signal.SIGTERM, signal.SIGINT):
+        with contextlib.suppress(NotImplementedError, RuntimeError):
+            loop.add_signal_handler(sinal, parada.set)
+
+    async def receber(request: web.Request) -> web.Response:
+        if WEBHOOK_TELEGRAM_SEGREDO and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_TELEGRAM_SEGREDO:
+            return web.Response(status=403)
+        try:
+            await roteador.encaminhar(await request.read())
+        except ValueError:
+            return web.Response(status=400)
+        except (ConnectionError, OSError):
+            return web.Response(status=503)
+        return web.Response()
+
+    async def supervisionar():
+        while not parada.is_set():
+            for indice, processo in enumerate(processos):
+                if not processo.is_alive():
+                    logger.error(f"Worker {indice} terminou (código {processo.exitcode}). Reiniciando.")
+                    roteador.desconectar(indice)
+                    processos[indice] = iniciar_processo_worker(indice, total)
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(parada.wait(), timeout=1)
+
+    supervisor = asyncio.create_task(supervisionar())
+    runner = None
+    try:
+        await roteador.conectar()
+        app_web = web.Application()
+        app_web.router.add_post(f"/{WEBHOOK_TELEGRAM_CAMINHO.strip('/')}", receber)
+        runner = web.AppRunner(app_web, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_TELEGRAM_HOST, WEBHOOK_TELEGRAM_PORTA).start()
+        async with Bot(TOKEN_BOT) as bot_front:
+            await bot_front.set_webhook(WEBHOOK_TELEGRAM_URL, secret_token=WEBHOOK_TELEGRAM_SEGREDO or None,
+                                        allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Front ouvindo em {WEBHOOK_TELEGRAM_HOST}:{WEBHOOK_TELEGRAM_PORTA} com {total} worker(s).")
+        await parada.wait()
+    finally:
+        parada.set()
+        await supervisor
+        if runner:
+            await runner.cleanup()
+        await roteador.fechar()
+        for processo in processos:
+            processo.terminate()  # SIGTERM: o worker encerra a Application normalmente
+        for processo in processos:
+            await loop.run_in_executor(None, processo.join)
+        logger.info(f"Front encerrado. Atualizações encaminhadas por worker: {roteador.encaminhadas}")
+
 # -----------------------------------------------------------------------------
 # 🚀 FUNÇÃO PRINCIPAL E INICIALIZAÇÃO DO BOT
 # -----------------------------------------------------------------------------
-def main():
-    """Função principal que configura e executa o bot."""
+def _handlers_de_log_telegram():
+    return [h for h in logging.getLogger().handlers if isinstance(h, TelegramLogHandler)]
+
+def coletar_estado_interno():
+    """Copia para as métricas os números mantidos pelos próprios componentes."""
+    cache = gateway.cache
+    metricas.definir("efi_cache_acertos_total", valor=cache.acertos, contador=True)
+    metricas.definir("efi_cache_coalescidas_total", valor=cache.coalescidas, contador=True)
+    metricas.definir("efi_cache_falhas_total", valor=cache.falhas, contador=True)
+    metricas.definir("efi_cache_itens", valor=len(cache._itens))
+    metricas.definir("pool_cobrancas_acertos_total", valor=pool_cobrancas.acertos, contador=True)
+    metricas.definir("pool_cobrancas_falhas_total", valor=pool_cobrancas.falhas, contador=True)
+    for tipo_plano in PRECOS_POR_PLANO:
+        metricas.definir("pool_cobrancas_prontas", (("plano", tipo_plano),), pool_cobrancas.tamanho(tipo_plano))
+    metricas.definir("convites_acertos_total", valor=pool_convites.acertos, contador=True)
+    metricas.definir("convites_falhas_total", valor=pool_convites.falhas, contador=True)
+    metricas.definir("convites_revogados_total", valor=pool_convites.revogados, contador=True)
+    metricas.definir("convites_prontos", valor=len(pool_convites))
+    metricas.definir("checkout_travas", valor=len(travas_checkout))
+    metricas.definir("limite_cliques_baldes", valor=len(limitador_cliques))
+    metricas.definir("limite_cliques_caros_em_andamento", valor=limitador_cliques.em_andamento)
+    if repositorio._fila is not None:
+        metricas.definir("sqlite_fila_escrita", valor=repositorio._fila.qsize())
+    for handler in _handlers_de_log_telegram():
+        metricas.definir("log_telegram_enviados_total", valor=handler.enviados, contador=True)
+        metricas.definir("log_telegram_descartados_total", valor=handler.descartados, contador=True)
+
+async def _medir_fase(tempos: dict, fase: str, aguardavel):
+    """Aguarda `aguardavel` e guarda quanto tempo a fase levou (log e métrica `inicializacao_segundos`)."""
+    inicio = time.perf_counter()
+    try:
+        return await aguardavel
+    finally:
+        tempos[fase] = time.perf_counter() - inicio
+        metricas.definir("inicializacao_segundos", (("fase", fase),), tempos[fase])
+
+async def iniciar(application: Application):
+    """
+    Sobe os serviços que rodam junto com o bot, no mesmo loop de eventos.
+
+    Banco (migrações + conexões) e Efí (cliente + token OAuth) são preparados em
+    paralelo; só depois começam as tarefas que dependem deles.
+    """
+    inicio = time.perf_counter()
+    tempos = {}
+
+    async def preparar_banco():
+        await _medir_fase(tempos, "migracoes", asyncio.to_thread(aplicar_migracoes))
+        await _medir_fase(tempos, "banco", repositorio.abrir())
+
+    await asyncio.gather(preparar_banco(), _medir_fase(tempos, "efi", gateway.preparar()))
+
+    despachante.iniciar(application.bot)
+    fila_checkouts.iniciar(application.bot)
+    pool_cobrancas.iniciar()
+    pool_convites.iniciar(application.bot)
+    for handler in _handlers_de_log_telegram():
+        handler.iniciar()
+    servidores = []
+    if WEBHOOK_EFI_ATIVO and eh_worker_principal():
+        servidores.append(iniciar_webhook_efi(application))
+    if METRICAS_PORTA:
+        metricas.registrar_coletor(coletar_estado_interno)
+        servidores.append(iniciar_servidor_metricas(METRICAS_PORTA + WORKER_INDICE))
+    await _medir_fase(tempos, "servidores", asyncio.gather(*servidores))
+    await _medir_fase(tempos, "transmissoes", transmissor.retomar(application.bot))
+
+    tempos["total"] = time.perf_counter() - inicio
+    metricas.definir("inicializacao_segundos", (("fase", "total"),), tempos["total"])
+    logger.info("Inicialização concluída: " + ", ".join(f"{fase} {segundos * 1e3:.0f} ms" for fase, segundos in tempos.items()) + ".")
+
+async def parar(application: Application):
+    """Interrompe as transmissões e envia os logs pendentes enquanto o bot ainda pode falar com o Telegram."""
+    await transmissor.parar()
+    await fila_checkouts.parar()
+    await despachante.parar()
+    await pool_convites.parar()
+    for handler in _handlers_de_log_telegram():
+        await handler.encerrar()
+
+async def encerrar(application: Application):
+    """Libera os recursos compartilhados quando o bot é desligado."""
+    await parar_servidor_metricas()
+    await parar_webhook_efi()
+    await repositorio.fechar()
+    await pool_cobrancas.parar()
+    await gateway.fechar()
+
+def configurar_logs():
     log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    if MODO_EXECUCAO == "multiprocesso":
+        log_format = '%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=log_format, stream=sys.stdout)
 
     logging.getLogger("httpx").setLevel(logging.WARNING)
     logging.getLogger("telegram.ext").setLevel(logging.WARNING)
     logging.getLogger("efipay").setLevel(logging.INFO)
 
-    persistence = PicklePersistence(filepath="bot_persistence")
-    app = Application.builder().token(TOKEN_BOT).persistence(persistence).build()
+def criar_aplicacao() -> Application:
+    """Monta a Application com handlers, jobs e o log no Telegram (usada pelo processo único e por cada worker)."""
+    persistence = PersistenciaSQLite(repositorio)
+    app = (
+        Application.builder()
+        .token(TOKEN_BOT)
+        .base_url(TELEGRAM_API_URL)
+        .request(RequisicaoInstrumentada(connection_pool_size=256))
+        .persistence(persistence)
+        .context_types(ContextTypes(user_data=SessaoUsuario))
+        .concurrent_updates(ProcessadorPorUsuario(ATUALIZACOES_SIMULTANEAS, limitador_cliques))
+        .post_init(iniciar)
+        .post_stop(parar)
+        .post_shutdown(encerrar)
+        .build()
+    )
     
     # Handlers de comando e callback
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(start, pattern="^start$"))
-    app.add_handler(CallbackQueryHandler(mostrar_planos, pattern="^mostrar_planos$"))
-    app.add_handler(CallbackQueryHandler(mostrar_termos, pattern=r"^plano_"))  
-    app.add_handler(CallbackQueryHandler(aceitar_termos, pattern="^aceitar_termos$"))
-    app.add_handler(CallbackQueryHandler(verificar, pattern="^verificar$"))
+    app.add_handler(CommandHandler("start", instrumentar(start)))
+    app.add_handler(CallbackQueryHandler(instrumentar(start), pattern="^start$"))
+    app.add_handler(CallbackQueryHandler(instrumentar(mostrar_planos), pattern="^mostrar_planos$"))
+    app.add_handler(CallbackQueryHandler(instrumentar(mostrar_termos), pattern=r"^plano_"))  
+    app.add_handler(CallbackQueryHandler(instrumentar(limitador_cliques.operacao_cara(aceitar_termos)), pattern="^aceitar_termos$"))
+    app.add_handler(CallbackQueryHandler(instrumentar(limitador_cliques.operacao_cara(verificar)), pattern="^verificar$"))
+    app.add_handler(CommandHandler("broadcast", instrumentar(broadcast)))
+    app.add_handler(CommandHandler("relatorio", instrumentar(relatorio)))
 
     # Handler para qualquer mensagem de texto (baixa prioridade)
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_any_message))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumentar(handle_any_message)))
+
+    # Jobs periódicos: reconciliação, limpeza de sessões e expiração de assinaturas.
+    # A limpeza mexe nas sessões (em memória e no banco) dos usuários de cada processo; os outros rodam só no worker 0.
+    if app.job_queue:
+        if RECONCILIADOR_INTERVALO and eh_worker_principal():
+            app.job_queue.run_repeating(reconciliar_pendentes, interval=RECONCILIADOR_INTERVALO, first=10)
+        app.job_queue.run_repeating(limpar_sessoes_ociosas, interval=SESSAO_LIMPEZA_INTERVALO, first=SESSAO_LIMPEZA_INTERVALO)
+        if EXPIRACAO_INTERVALO and eh_worker_principal():
+            app.job_queue.run_repeating(processar_expiracoes, interval=EXPIRACAO_INTERVALO, first=30)
+    else:
+        logger.warning("JobQueue indisponível (instale python-telegram-bot[job-queue]). Jobs periódicos desativados.")
 
     # Adiciona o handler de logs para o Telegram
-    telegram_handler = TelegramLogHandler(bot=app.bot, chat_id=ID_LOGS)
+    telegram_handler = TelegramLogHandler(bot=app.bot, chat_id=ID_LOGS, max_fila=LOG_TELEGRAM_MAX_FILA, intervalo=LOG_TELEGRAM_INTERVALO)
     telegram_handler.setFormatter(logging.Formatter('LEVEL: %(levelname)s\nFILE: %(name)s\nMESSAGE: %(message)s'))
     logging.getLogger().addHandler(telegram_handler)
+    return app
+
+def main():
+    """Função principal que configura e executa o bot."""
+    configurar_logs()
+    if MODO_EXECUCAO == "multiprocesso":
+        asyncio.run(executar_front(WORKERS))
+        return
 
-    app.run_polling()
+    app = criar_aplicacao()
+    if MODO_EXECUCAO == "webhook":
+        app.run_webhook(
+            listen=WEBHOOK_TELEGRAM_HOST,
+            port=WEBHOOK_TELEGRAM_PORTA,
+            url_path=WEBHOOK_TELEGRAM_CAMINHO,
+            webhook_url=WEBHOOK_TELEGRAM_URL,
+            secret_token=WEBHOOK_TELEGRAM_SEGREDO or None
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
-    criar_e_migrar_db()
     if sys.platform == "win32":
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
     main()
@@ -0,0 +1,18 @@
+"""
+Configuração dos testes (pytest). Os testes importam o bot.py, que lê o senhas.py:
+ele precisa existir, mas nenhum teste acessa a Efí ou o Telegram de verdade.
+"""
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def banco(tmp_path, monkeypatch):
+    """pagamentos.db migrado em um diretório temporário, com o repositório global apontando para ele."""
+    db_file = str(tmp_path / "pagamentos.db")
+    monkeypatch.setattr(bot, "DB_FILE", db_file)
+    monkeypatch.setattr(bot, "PERSISTENCIA_ANTIGA", str(tmp_path / "bot_persistence"))
+    bot.aplicar_migracoes()
+    monkeypatch.setattr(bot, "repositorio", bot.RepositorioPagamentos(db_file))
+    return db_file
@@ -0,0 +1,89 @@
+"""Dublês da Efí e do Telegram compartilhados pelos testes."""
+import asyncio
+import collections
+import itertools
+import types
+
+import bot
+
+
+class TransporteEfiFalso:
+    """
+    Transporte da Efí em memória, no lugar de TransporteEfi/TransporteSdkEfi. Conta
+    as chamadas por endpoint; `falha` injeta defeitos: None responde normalmente,
+    "erro" levanta ErroGatewayEfi (como um 503) e "lenta" não responde antes do timeout.
+    """
+    def __init__(self, latencia: float = 0.01):
+        self.latencia = latencia
+        self.falha = None
+        self.chamadas = collections.Counter()
+        self._numeros = itertools.count(1)
+
+    async def preparar(self):
+        pass
+
+    async def chamar(self, endpoint: str, params: dict | None = None, body: dict | None = None, headers: dict | None = None):
+        self.chamadas[endpoint] += 1
+        if self.falha == "lenta":
+            await asyncio.sleep(3600)
+        await asyncio.sleep(self.latencia)
+        if self.falha == "erro":
+            raise bot.ErroGatewayEfi(f"HTTP 503 em '{endpoint}'")
+        if endpoint == 'pix_create_immediate_charge':
+            numero = next(self._numeros)
+            return {"txid": f"teste{numero:030d}", "loc": {"id": numero}}
+        if endpoint == 'pix_generate_qrcode':
+            return {"pixCopiaECola": f"00020126580014br.gov.bcb.pix{params['id']}"}
+        return {"txid": params['txid'], "status": "ATIVA"}
+
+    async def fechar(self):
+        pass
+
+
+class BotFalso:
+    """Bot.send_message/delete_message em memória: guarda as mensagens enviadas por chat."""
+
+    def __init__(self):
+        self.enviadas = collections.defaultdict(list)
+        self._ids = itertools.count(1)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.enviadas[chat_id].append(text)
+        return types.SimpleNamespace(message_id=next(self._ids), chat_id=chat_id)
+
+    async def delete_message(self, chat_id, message_id):
+        return True
+
+
+class DespachanteFalso:
+    """No lugar do despachante global: guarda (chat_ids, texto) de cada notificação."""
+
+    def __init__(self):
+        self.notificacoes = []
+
+    async def notificar(self, chat_ids, texto: str, parse_mode: str | None = None):
+        self.notificacoes.append((list(chat_ids), texto))
+
+
+class ConsultaFalsa:
+    """CallbackQuery de um usuário: registra as edições da mensagem."""
+
+    def __init__(self, user_id: int, dados: str):
+        self.data = dados
+        self.from_user = types.SimpleNamespace(id=user_id, username=f"u{user_id}", full_name=f"Usuário {user_id}")
+        self.edicoes = []
+
+    async def answer(self, *args, **kwargs):
+        return True
+
+    async def edit_message_text(self, text=None, **kwargs):
+        self.edicoes.append(text)
+        await asyncio.sleep(0)
+
+
+def clique(user_id: int, dados: str, sessao: bot.SessaoUsuario, bot_falso: BotFalso):
+    """(update, context) de um clique em um botão, com a sessão compartilhada entre cliques."""
+    consulta = ConsultaFalsa(user_id, dados)
+    update = types.SimpleNamespace(callback_query=consulta, effective_user=consulta.from_user)
+    contexto = types.SimpleNamespace(user_data=sessao, bot=bot_falso)
+    return update, contexto
@@ -0,0 +1,68 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import bot
+from falsos import BotFalso, DespachanteFalso, TransporteEfiFalso, clique
+
+USER_ID = 4242
+
+
+@pytest.fixture
+def checkout(banco, monkeypatch):
+    transporte = TransporteEfiFalso(latencia=0.05)
+    despachante = DespachanteFalso()
+    monkeypatch.setattr(bot, "gateway", bot.GatewayEfi(transporte))
+    monkeypatch.setattr(bot, "despachante", despachante)
+    monkeypatch.setattr(bot, "travas_checkout", bot.TravasPorUsuario(bot.CHECKOUT_TRAVA_TTL))
+    monkeypatch.setattr(bot, "pool_cobrancas", bot.PoolCobrancas(bot.PRECOS_POR_PLANO, 0))
+    sessao = bot.SessaoUsuario()
+    sessao.escolher_plano(bot.Plano.MENSAL)
+    return transporte, despachante, sessao
+
+
+def _pagamentos(db_file: str) -> list:
+    with sqlite3.connect(db_file) as conn:
+        return conn.execute("SELECT user_id, status FROM pagamentos").fetchall()
+
+
+def _tocar(handler, toques: int, sessao, bot_falso):
+    async def executar():
+        await bot.repositorio.abrir()
+        try:
+            await asyncio.gather(*(handler(*clique(USER_ID, "aceitar_termos", sessao, bot_falso)) for _ in range(toques)))
+        finally:
+            await bot.repositorio.fechar()
+    asyncio.run(executar())
+
+
+@pytest.mark.parametrize("toques", [2, 10])
+def test_toques_simultaneos_geram_uma_cobranca(banco, checkout, toques):
+    transporte, _, sessao = checkout
+    bot_falso = BotFalso()
+    _tocar(bot.gerar_pagamento, toques, sessao, bot_falso)
+
+    assert transporte.chamadas['pix_create_immediate_charge'] == 1
+    assert _pagamentos(banco) == [(USER_ID, 'pendente')]
+    assert len(bot_falso.enviadas[USER_ID]) == 1
+
+
+def test_aceite_duplo_registra_um_aviso_de_termos(banco, checkout):
+    transporte, despachante, sessao = checkout
+    _tocar(bot.aceitar_termos, 3, sessao, BotFalso())
+
+    assert transporte.chamadas['pix_create_immediate_charge'] == 1
+    assert len(despachante.notificacoes) == 1
+    assert despachante.notificacoes[0][0] == [bot.ID_CANAL_TERMOS]
+
+
+def test_toque_depois_da_cobranca_reaproveita_a_pendente(banco, checkout):
+    transporte, despachante, sessao = checkout
+    bot_falso = BotFalso()
+    _tocar(bot.aceitar_termos, 1, sessao, bot_falso)
+    _tocar(bot.aceitar_termos, 1, sessao, bot_falso)
+
+    assert transporte.chamadas['pix_create_immediate_charge'] == 1
+    assert _pagamentos(banco) == [(USER_ID, 'pendente')]
+    assert len(despachante.notificacoes) == 1
@@ -0,0 +1,158 @@
+import asyncio
+import collections
+import sqlite3
+import time
+
+import pytest
+
+import bot
+from falsos import BotFalso, TransporteEfiFalso, clique
+
+ESPERA = 0.3
+
+
+def _gateway(transporte, limite_falhas: int = 3, **kwargs) -> bot.GatewayEfi:
+    return bot.GatewayEfi(transporte, timeout=0.2, backoff=0,
+                          fabrica_disjuntor=lambda endpoint: bot.Disjuntor(endpoint, limite_falhas=limite_falhas,
+                                                                          lentidao=1, espera=ESPERA),
+                          **kwargs)
+
+
+def _estados(disjuntor: bot.Disjuntor) -> list:
+    return [estado for _, estado in disjuntor.historico]
+
+
+def _corpo() -> dict:
+    return {"calendario": {"expiracao": 900}, "valor": {"original": "19.90"}, "chave": "teste"}
+
+
+@pytest.mark.parametrize("falha", ["erro", "lenta"])
+def test_disjuntor_abre_no_limite_sonda_e_fecha(falha):
+    transporte = TransporteEfiFalso()
+    gateway = _gateway(transporte)
+    disjuntor = gateway.disjuntor('pix_create_immediate_charge')
+
+    async def cenario():
+        transporte.falha = falha
+        for tentativa in range(3):
+            assert disjuntor.estado == bot.Disjuntor.FECHADO
+            with pytest.raises(Exception) as erro:
+                await gateway.criar_cobranca(_corpo())
+            assert not isinstance(erro.value, bot.DisjuntorAberto)
+        assert disjuntor.estado == bot.Disjuntor.ABERTO
+
+        # Aberto: falha na hora, sem tocar no transporte.
+        inicio = time.monotonic()
+        with pytest.raises(bot.DisjuntorAberto):
+            await gateway.criar_cobranca(_corpo())
+        assert time.monotonic() - inicio < 0.05
+        assert transporte.chamadas['pix_create_immediate_charge'] == 3
+        assert not gateway.disponivel(*bot.GatewayEfi.CRIACAO)
+
+        # Depois da espera (±20%): uma única sondagem; ela falha e o disjuntor reabre.
+        await asyncio.sleep(ESPERA * 1.25)
+        assert gateway.disponivel('pix_create_immediate_charge')
+        with pytest.raises(Exception):
+            await gateway.criar_cobranca(_corpo())
+        assert disjuntor.estado == bot.Disjuntor.ABERTO
+
+        # A Efí volta: a sondagem passa e fecha; chamadas simultâneas à sondagem são barradas.
+        await asyncio.sleep(ESPERA * 1.25)
+        transporte.falha = None
+        transporte.latencia = 0.05
+        resultados = await asyncio.gather(*(gateway.criar_cobranca(_corpo()) for _ in range(3)), return_exceptions=True)
+        assert sum(isinstance(r, dict) for r in resultados) == 1
+        assert sum(isinstance(r, bot.DisjuntorAberto) for r in resultados) == 2
+        assert disjuntor.estado == bot.Disjuntor.FECHADO
+        await gateway.criar_cobranca(_corpo())
+        await gateway.fechar()
+
+    asyncio.run(cenario())
+    assert _estados(disjuntor) == ["aberto", "meio_aberto", "aberto", "meio_aberto", "fechado"]
+    assert transporte.chamadas['pix_create_immediate_charge'] == 3 + 1 + 1 + 1
+
+
+def test_sucesso_zera_as_falhas_seguidas():
+    transporte = TransporteEfiFalso()
+    gateway = _gateway(transporte)
+
+    async def cenario():
+        for _ in range(5):
+            transporte.falha = "erro"
+            for _ in range(2):
+                with pytest.raises(bot.ErroGatewayEfi):
+                    await gateway.criar_cobranca(_corpo())
+            transporte.falha = None
+            await gateway.criar_cobranca(_corpo())
+
+    asyncio.run(cenario())
+    assert gateway.disjuntor('pix_create_immediate_charge').estado == bot.Disjuntor.FECHADO
+
+
+def test_consultas_sao_repetidas_e_criacao_nao():
+    transporte = TransporteEfiFalso()
+    gateway = _gateway(transporte, limite_falhas=100, tentativas=3)
+    transporte.falha = "erro"
+
+    async def cenario():
+        with pytest.raises(bot.ErroGatewayEfi):
+            await gateway.detalhar_cobranca("txid", usar_cache=False)
+        with pytest.raises(bot.ErroGatewayEfi):
+            await gateway.criar_cobranca(_corpo())
+
+    asyncio.run(cenario())
+    assert transporte.chamadas == {'pix_detail_charge': 3, 'pix_create_immediate_charge': 1}
+
+
+def test_checkouts_adiados_sao_entregues_uma_vez(banco, monkeypatch):
+    usuarios = range(1, 21)
+    transporte = TransporteEfiFalso()
+    monkeypatch.setattr(bot, "gateway", _gateway(transporte, limite_falhas=1))
+    monkeypatch.setattr(bot, "travas_checkout", bot.TravasPorUsuario(bot.CHECKOUT_TRAVA_TTL))
+    monkeypatch.setattr(bot, "pool_cobrancas", bot.PoolCobrancas(bot.PRECOS_POR_PLANO, 0))
+    bot_falso = BotFalso()
+    # Duas filas no mesmo banco, como dois workers: a reserva impede que ambas entreguem o mesmo pedido.
+    filas = [bot.FilaCheckoutsAdiados(intervalo=0.05, validade=3600, simultaneos=4) for _ in range(2)]
+    monkeypatch.setattr(bot, "fila_checkouts", filas[0])
+    sessoes = collections.defaultdict(bot.SessaoUsuario)
+    edicoes = {}
+
+    async def tocar(user_id):
+        sessoes[user_id].escolher_plano(bot.Plano.MENSAL)
+        update, contexto = clique(user_id, "aceitar_termos", sessoes[user_id], bot_falso)
+        await bot.gerar_pagamento(update, contexto)
+        edicoes[user_id] = update.callback_query.edicoes[-1]
+
+    async def cenario():
+        await bot.repositorio.abrir()
+        transporte.falha = "erro"
+        for user_id in usuarios:
+            await tocar(user_id)
+        await tocar(1)  # Toque repetido enquanto a Efí está fora: continua um pedido só
+        assert await bot.repositorio.checkouts_adiados() == len(usuarios)
+        assert not bot_falso.enviadas
+
+        transporte.falha = None
+        for fila in filas:
+            fila.iniciar(bot_falso)
+        async with asyncio.timeout(10):
+            while await bot.repositorio.checkouts_adiados():
+                await asyncio.sleep(0.05)
+        await asyncio.sleep(0.2)  # Uma rodada a mais: nada pode ser entregue de novo
+        for fila in filas:
+            await fila.parar()
+        await bot.repositorio.fechar()
+
+    asyncio.run(cenario())
+
+    assert all(texto.startswith("⏳") for texto in edicoes.values())
+    codigos = {user_id: [t for t in textos if t.startswith("<pre><code>")] for user_id, textos in bot_falso.enviadas.items()}
+    assert codigos.keys() == set(usuarios)
+    assert all(len(c) == 1 for c in codigos.values())
+    assert sum(fila.entregues for fila in filas) == len(usuarios)
+    with sqlite3.connect(banco) as conn:
+        linhas = conn.execute("SELECT user_id, COUNT(*), MAX(pix_message_id IS NOT NULL) FROM pagamentos "
+                              "WHERE status = 'pendente' GROUP BY user_id").fetchall()
+    assert linhas == [(user_id, 1, 1) for user_id in usuarios]
+    disjuntor = bot.gateway.disjuntor('pix_create_immediate_charge')
+    assert _estados(disjuntor)[0] == "aberto" and _estados(disjuntor)[-1] == "fechado"
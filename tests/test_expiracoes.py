@@ -0,0 +1,107 @@
+import asyncio
+import collections
+import sqlite3
+import time
+import types
+
+import pytest
+from telegram.error import RetryAfter, TimedOut
+
+import bot
+
+
+class BotExpiracoesFalso:
+    """Conta banimentos e desbanimentos por usuário; `falhas` injeta erros na remoção."""
+
+    def __init__(self, falhas: dict | None = None):
+        self.falhas = falhas or {}  # user_id -> lista de exceções, uma por chamada a ban_chat_member
+        self.banidos = collections.Counter()
+        self.desbanidos = collections.Counter()
+        self.avisados = collections.Counter()
+
+    async def ban_chat_member(self, chat_id, user_id, **kwargs):
+        pendentes = self.falhas.get(user_id)
+        if pendentes:
+            raise pendentes.pop(0)
+        self.banidos[user_id] += 1
+
+    async def unban_chat_member(self, chat_id, user_id, **kwargs):
+        self.desbanidos[user_id] += 1
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.avisados[chat_id] += 1
+
+
+class Queda(Exception):
+    """O processo caiu no meio da varredura."""
+
+
+def _criar_assinaturas(db_file: str, vencidas: int, ativas: int):
+    agora = int(time.time())
+    with sqlite3.connect(db_file) as conn:
+        conn.executemany(
+            "INSERT INTO assinaturas (user_id, tipo_plano, txid, inicio, expira_em) VALUES (?, 'mensal', ?, ?, ?)",
+            [(user_id, f"tx{user_id}", agora - 40 * 86400, agora - 3600 + user_id) for user_id in range(1, vencidas + 1)]
+            + [(user_id, f"tx{user_id}", agora, agora + 30 * 86400) for user_id in range(1001, 1001 + ativas)]
+        )
+
+
+def _status(db_file: str) -> dict:
+    with sqlite3.connect(db_file) as conn:
+        return dict(conn.execute("SELECT user_id, status FROM assinaturas"))
+
+
+@pytest.fixture(autouse=True)
+def sem_pausas(monkeypatch):
+    monkeypatch.setattr(bot, "EXPIRACAO_INTERVALO_CHAMADAS", 0)
+    monkeypatch.setattr(bot, "EXPIRACAO_LOTE", 7)
+    monkeypatch.setattr(bot, "ID_DONOS", [])
+
+
+def test_retomada_apos_queda_remove_cada_vencido_uma_vez(banco):
+    vencidas = 30
+    _criar_assinaturas(banco, vencidas, ativas=5)
+    # Usuário 12: dois RetryAfter seguidos (o segundo escapa do _chamar_com_limite);
+    # usuário 15: erro de rede; usuário 20: o processo cai.
+    falhas = {12: [RetryAfter(0), RetryAfter(0)], 15: [TimedOut()], 20: [Queda()]}
+    bot_falso = BotExpiracoesFalso(falhas)
+    contexto = types.SimpleNamespace(bot=bot_falso)
+
+    async def executar():
+        await bot.repositorio.abrir()
+        try:
+            await bot.processar_expiracoes(contexto)
+        finally:
+            await bot.repositorio.fechar()
+
+    with pytest.raises(Queda):
+        asyncio.run(executar())
+    status = _status(banco)
+    assert [u for u in range(1, 20) if status[u] == 'ativa'] == [12, 15]
+    assert all(status[u] == 'ativa' for u in range(20, vencidas + 1))
+
+    asyncio.run(executar())  # Reinício: a próxima execução do job
+
+    status = _status(banco)
+    assert all(status[u] == 'expirada' for u in range(1, vencidas + 1))
+    assert all(status[u] == 'ativa' for u in range(1001, 1006))
+    assert bot_falso.banidos == {u: 1 for u in range(1, vencidas + 1)}
+    assert bot_falso.desbanidos == {u: 1 for u in range(1, vencidas + 1)}
+    assert bot_falso.avisados == {u: 1 for u in range(1, vencidas + 1)}
+
+
+def test_remocao_que_falha_nao_interrompe_a_varredura(banco):
+    _criar_assinaturas(banco, 10, ativas=0)
+    bot_falso = BotExpiracoesFalso({3: [TimedOut(), TimedOut()]})
+
+    async def executar():
+        await bot.repositorio.abrir()
+        try:
+            await bot.processar_expiracoes(types.SimpleNamespace(bot=bot_falso))
+        finally:
+            await bot.repositorio.fechar()
+
+    asyncio.run(executar())
+    status = _status(banco)
+    assert [u for u, s in status.items() if s == 'ativa'] == [3]
+    assert 3 not in bot_falso.banidos
@@ -0,0 +1,44 @@
+import asyncio
+
+from telegram import CallbackQuery, Update, User
+
+import bot
+
+USER_ID = 99
+
+
+def _clique(update_id: int, dados: str) -> Update:
+    usuario = User(USER_ID, "u", False)
+    return Update(update_id, callback_query=CallbackQuery(str(update_id), usuario, "chat", data=dados))
+
+
+def test_clique_recusado_nao_espera_o_handler_do_usuario(monkeypatch):
+    recusados = []
+
+    async def recusar_clique(update, motivo):
+        recusados.append((update.update_id, motivo, liberar.is_set()))
+
+    monkeypatch.setattr(bot, "recusar_clique", recusar_clique)
+    limitador = bot.LimitadorCliques(taxa=1, rajada=2)
+    processador = bot.ProcessadorPorUsuario(4, limitador)
+    liberar = asyncio.Event()
+    executados = []
+
+    async def handler(update_id):
+        executados.append(update_id)
+        if update_id == 1:
+            await liberar.wait()
+
+    async def executar():
+        lento = asyncio.create_task(processador.process_update(_clique(1, "verificar"), handler(1)))
+        await asyncio.sleep(0)
+        # Enquanto o primeiro clique segura a trava do usuário, os excedentes são recusados na hora.
+        seguintes = [asyncio.create_task(processador.process_update(_clique(i, "verificar"), handler(i))) for i in range(2, 6)]
+        await asyncio.sleep(0.05)
+        assert [update_id for update_id, _, _ in recusados] == [3, 4, 5]
+        liberar.set()
+        await asyncio.gather(lento, *seguintes)
+
+    asyncio.run(executar())
+    assert all(motivo == "usuario" and not liberado for _, motivo, liberado in recusados)
+    assert executados == [1, 2]
@@ -0,0 +1,108 @@
+import asyncio
+import sqlite3
+import time
+from types import SimpleNamespace
+
+from telegram import Bot
+from telegram.ext import PersistenceInput, PicklePersistence
+
+import bot
+
+ATIVO, AUSENTE = 1, 2
+
+
+def _envelhecer(db_file: str):
+    with sqlite3.connect(db_file) as conn:
+        conn.execute("UPDATE persistencia_usuarios SET atualizado_em = ?", (int(time.time()) - bot.SESSAO_TTL - 60,))
+
+
+def _linhas(db_file: str) -> list:
+    with sqlite3.connect(db_file) as conn:
+        return [linha[0] for linha in conn.execute("SELECT user_id FROM persistencia_usuarios ORDER BY user_id")]
+
+
+def test_limpeza_nao_perde_sessao_ativa_sem_mudancas(banco):
+    persistencia = bot.PersistenciaSQLite(bot.repositorio)
+    sessao = bot.SessaoUsuario()
+    sessao.escolher_plano(bot.Plano.MENSAL)
+    sessao.registrar_atividade()
+    ausente = bot.SessaoUsuario()
+    ausente.escolher_plano(bot.Plano.TRIMESTRAL)
+    contexto = SimpleNamespace(application=SimpleNamespace(user_data={ATIVO: sessao}, persistence=persistencia))
+
+    async def executar():
+        await bot.repositorio.abrir()
+        try:
+            await persistencia.update_user_data(ATIVO, sessao)
+            await persistencia.update_user_data(AUSENTE, ausente)
+            _envelhecer(banco)
+            # Sem mudança na sessão, a gravação é pulada e a linha continua antiga.
+            await persistencia.update_user_data(ATIVO, sessao)
+            await bot.limpar_sessoes_ociosas(contexto)
+            assert _linhas(banco) == [ATIVO]
+
+            await persistencia.update_user_data(ATIVO, sessao)
+            recarregada = bot.SessaoUsuario()
+            await bot.PersistenciaSQLite(bot.repositorio).refresh_user_data(ATIVO, recarregada)
+            return recarregada
+        finally:
+            await bot.repositorio.fechar()
+
+    recarregada = asyncio.run(executar())
+    assert recarregada.persistente() == sessao.persistente()
+
+
+def test_limpeza_de_um_worker_nao_apaga_usuarios_de_outro(banco, monkeypatch):
+    monkeypatch.setattr(bot, "WORKER_TOTAL", 2)
+    monkeypatch.setattr(bot, "WORKER_INDICE", 0)
+    persistencia = bot.PersistenciaSQLite(bot.repositorio)
+    sessao = bot.SessaoUsuario()
+    sessao.escolher_plano(bot.Plano.MENSAL)
+    contexto = SimpleNamespace(application=SimpleNamespace(user_data={}, persistence=persistencia))
+
+    async def executar():
+        await bot.repositorio.abrir()
+        try:
+            for user_id in (10, 11, 12, 13):
+                await persistencia.update_user_data(user_id, sessao)
+            _envelhecer(banco)
+            await bot.limpar_sessoes_ociosas(contexto)
+        finally:
+            await bot.repositorio.fechar()
+
+    asyncio.run(executar())
+    # Os ímpares são do worker 1, que pode tê-los ativos em memória.
+    assert _linhas(banco) == [11, 13]
+
+
+def test_migracao_importa_o_pickle_persistence_antigo(tmp_path, monkeypatch):
+    antigo = str(tmp_path / "bot_persistence")
+
+    async def gravar_antigo():
+        persistencia = PicklePersistence(filepath=antigo, store_data=PersistenceInput(callback_data=False))
+        persistencia.set_bot(Bot("1:falso"))
+        await persistencia.update_user_data(ATIVO, {"plano_escolhido": {"tipo": "trimestral", "valor": 49.9},
+                                                     "pix_message_id": 7})
+        await persistencia.update_user_data(AUSENTE, {"pix_message_id": None})
+        await persistencia.flush()
+    asyncio.run(gravar_antigo())
+
+    db_file = str(tmp_path / "pagamentos.db")
+    monkeypatch.setattr(bot, "DB_FILE", db_file)
+    monkeypatch.setattr(bot, "PERSISTENCIA_ANTIGA", antigo)
+    bot.aplicar_migracoes()
+    bot.aplicar_migracoes()  # Idempotente: a migração só roda uma vez
+    repositorio = bot.RepositorioPagamentos(db_file)
+
+    async def carregar():
+        await repositorio.abrir()
+        try:
+            sessao = bot.SessaoUsuario()
+            await bot.PersistenciaSQLite(repositorio).refresh_user_data(ATIVO, sessao)
+            return sessao
+        finally:
+            await repositorio.fechar()
+
+    sessao = asyncio.run(carregar())
+    assert _linhas(db_file) == [ATIVO]
+    assert (sessao.plano, sessao.valor_centavos) == (bot.Plano.TRIMESTRAL, 4990)
@@ -0,0 +1,93 @@
+import asyncio
+import sqlite3
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+class GatewayListagemFalso:
+    def __init__(self, cobrancas: list):
+        self.cobrancas = cobrancas
+        self.janelas = []
+
+    async def listar_cobrancas(self, inicio, fim, **kwargs) -> list:
+        self.janelas.append((inicio, fim))
+        return self.cobrancas
+
+
+@pytest.fixture
+def liberados(banco, monkeypatch):
+    registrados = []
+
+    async def liberar_acesso(bot_telegram, pagamento, sessao=None):
+        registrados.append(pagamento['txid'])
+
+    monkeypatch.setattr(bot, "liberar_acesso", liberar_acesso)
+    monkeypatch.setattr(bot, "pool_cobrancas", bot.PoolCobrancas(bot.PRECOS_POR_PLANO, 0))
+    return registrados
+
+
+def _inserir(db_file: str, txid: str, status: str):
+    with sqlite3.connect(db_file) as conn:
+        conn.execute(
+            "INSERT INTO pagamentos (txid, user_id, username, status, data_criacao, tipo_plano, valor_centavos) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (txid, 1, "usuario", status, int(time.time()), "mensal", 1000),
+        )
+
+
+def _status(db_file: str, txid: str) -> str:
+    with sqlite3.connect(db_file) as conn:
+        return conn.execute("SELECT status FROM pagamentos WHERE txid = ?", (txid,)).fetchone()[0]
+
+
+def _reconciliar(gateway, monkeypatch):
+    monkeypatch.setattr(bot, "gateway", gateway)
+    contexto = SimpleNamespace(bot=None, application=SimpleNamespace(bot=None, user_data={}))
+
+    async def executar():
+        await bot.repositorio.abrir()
+        try:
+            await bot.reconciliar_pendentes(contexto)
+        finally:
+            await bot.repositorio.fechar()
+    asyncio.run(executar())
+
+
+def test_aprova_cancelada_paga_sem_pendentes_e_tolera_status_nulo(banco, liberados, monkeypatch):
+    _inserir(banco, "cancelada", "cancelada")
+    _inserir(banco, "pendente", "pendente")
+    gateway = GatewayListagemFalso([{"txid": "cancelada", "status": "CONCLUIDA"}, {"txid": "pendente", "status": None}])
+
+    _reconciliar(gateway, monkeypatch)
+
+    assert liberados == ["cancelada"]
+    assert _status(banco, "cancelada") == "aprovado"
+    assert _status(banco, "pendente") == "pendente"
+
+    # Sem nenhuma pendente no banco, a cobrança cancelada e paga ainda é encontrada.
+    _inserir(banco, "cancelada2", "cancelada")
+    with sqlite3.connect(banco) as conn:
+        conn.execute("DELETE FROM pagamentos WHERE txid = 'pendente'")
+    gateway = GatewayListagemFalso([{"txid": "cancelada2", "status": "CONCLUIDA"}])
+
+    _reconciliar(gateway, monkeypatch)
+
+    assert liberados == ["cancelada", "cancelada2"]
+
+
+@pytest.mark.parametrize("profundidade", [0, 2])
+def test_janela_so_cresce_com_pool_ativo(banco, liberados, monkeypatch, profundidade):
+    monkeypatch.setattr(bot, "pool_cobrancas", bot.PoolCobrancas(bot.PRECOS_POR_PLANO, profundidade))
+    gateway = GatewayListagemFalso([])
+
+    _reconciliar(gateway, monkeypatch)
+
+    inicio, fim = gateway.janelas[0]
+    esperado = timedelta(seconds=bot.RECONCILIADOR_JANELA, minutes=1)
+    if profundidade:
+        esperado += timedelta(seconds=bot.pool_cobrancas.validade)
+    assert abs((fim - inicio) - esperado) < timedelta(seconds=1)
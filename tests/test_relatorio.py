@@ -0,0 +1,72 @@
+import asyncio
+import csv
+import gzip
+import io
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+ADMIN = 777
+
+
+class MensagemFalsa:
+    def __init__(self, texto: str):
+        self.text = texto
+        self.respostas = []
+        self.documentos = []
+
+    async def reply_text(self, texto, **kwargs):
+        self.respostas.append(texto)
+
+    async def reply_document(self, document, filename, caption=None, **kwargs):
+        self.documentos.append((filename, document.read()))
+
+
+@pytest.fixture
+def pagamentos(banco, monkeypatch):
+    monkeypatch.setattr(bot, "ID_DONOS", [ADMIN])
+    agora = int(time.time())
+    with sqlite3.connect(banco) as conn:
+        conn.executemany(
+            "INSERT INTO pagamentos (txid, user_id, username, status, data_criacao, tipo_plano, valor_centavos) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [("recente", 1, "a", "aprovado", agora, "mensal", 1000),
+             ("antigo", 2, "b", "aprovado", agora - 400 * 86400, "mensal", 1000)],
+        )
+    return banco
+
+
+def _relatorio(texto: str) -> MensagemFalsa:
+    mensagem = MensagemFalsa(texto)
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=ADMIN), effective_message=mensagem)
+
+    async def executar():
+        await bot.repositorio.abrir()
+        try:
+            await bot.relatorio(update, None)
+        finally:
+            await bot.repositorio.fechar()
+    asyncio.run(executar())
+    return mensagem
+
+
+def test_csv_sem_periodo_usa_o_padrao_e_vem_compactado(pagamentos):
+    mensagem = _relatorio("/relatorio csv")
+
+    nome, conteudo = mensagem.documentos[0]
+    assert nome.endswith(".csv.gz")
+    linhas = list(csv.reader(io.StringIO(gzip.decompress(conteudo).decode("utf-8"))))
+    assert linhas[0] == list(bot.RepositorioPagamentos.COLUNAS_EXPORTACAO)
+    assert [linha[0] for linha in linhas[1:]] == ["recente"]
+
+
+def test_csv_acima_do_limite_nao_e_enviado(pagamentos, monkeypatch):
+    monkeypatch.setattr(bot, "RELATORIO_CSV_LIMITE", 10)
+
+    mensagem = _relatorio(f"/relatorio csv {bot.RELATORIO_DIAS_MAXIMO}")
+
+    assert mensagem.documentos == []
+    assert "período menor" in mensagem.respostas[0]
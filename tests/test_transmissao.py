@@ -0,0 +1,222 @@
+import asyncio
+import collections
+import random
+import sqlite3
+
+import pytest
+from telegram.error import RetryAfter
+
+import bot
+
+DESTINATARIOS = 3000
+SIMULTANEAS = 10
+DESTINATARIOS_ESCALA = 100_000
+
+
+class BotTransmissaoFalso:
+    """send_message com latência sorteada: os envios terminam fora de ordem, como no Telegram."""
+
+    def __init__(self):
+        self.recebidas = collections.Counter()
+        self.admin = []
+        self._aleatorio = random.Random(7)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self._aleatorio.uniform(0, 0.004))
+        if chat_id == 1:
+            self.admin.append(text)
+        else:
+            self.recebidas[chat_id] += 1
+
+
+def _inserir_assinantes(db_file: str, total: int):
+    with sqlite3.connect(db_file) as conn:
+        conn.executemany(
+            "INSERT INTO assinaturas (user_id, tipo_plano, txid, inicio, expira_em, status) VALUES (?, 'mensal', ?, 0, ?, 'ativa')",
+            ((user_id, f"tx{user_id}", 2**31) for user_id in range(2, total + 2))
+        )
+
+
+@pytest.fixture
+def assinantes(banco):
+    _inserir_assinantes(banco, DESTINATARIOS)
+    return banco
+
+
+def _status(db_file: str, transmissao_id: int) -> tuple:
+    with sqlite3.connect(db_file) as conn:
+        return conn.execute("SELECT status, enviados FROM transmissoes WHERE id = ?", (transmissao_id,)).fetchone()
+
+
+def _transmitir(bot_falso, interromper):
+    """Inicia a transmissão, chama `interromper(transmissor)` no meio e retoma com um Transmissor novo."""
+    async def cenario():
+        await bot.repositorio.abrir()
+        transmissao_id = await bot.repositorio.criar_transmissao(1, "assinantes", "Oi!")
+        transmissor = bot.Transmissor(taxa=100_000, simultaneas=SIMULTANEAS)
+        transmissor.iniciar(bot_falso, {'id': transmissao_id, 'admin_id': 1, 'publico': 'assinantes', 'texto': "Oi!",
+                                        'ultimo_user_id': 0, 'enviados': 0, 'bloqueados': 0, 'falhas': 0})
+        while sum(bot_falso.recebidas.values()) < DESTINATARIOS // 2:
+            await asyncio.sleep(0.001)
+        await interromper(transmissor)
+
+        retomada = bot.Transmissor(taxa=100_000, simultaneas=SIMULTANEAS)
+        await retomada.retomar(bot_falso)
+        while retomada.em_andamento():
+            await asyncio.sleep(0.01)
+        await bot.repositorio.fechar()
+        return transmissao_id
+    return asyncio.run(cenario())
+
+
+def test_desligamento_repete_no_maximo_os_envios_em_voo(assinantes):
+    bot_falso = BotTransmissaoFalso()
+    transmissao_id = _transmitir(bot_falso, lambda transmissor: transmissor.parar())
+
+    assert set(bot_falso.recebidas) == set(range(2, DESTINATARIOS + 2))
+    repetidos = sum(n - 1 for n in bot_falso.recebidas.values())
+    assert repetidos <= SIMULTANEAS
+    # Envios em voo no desligamento não chegaram a ser contados: o total do banco não duplica.
+    assert _status(assinantes, transmissao_id) == ('concluida', DESTINATARIOS)
+    assert len(bot_falso.admin) == 1 and "concluída" in bot_falso.admin[0]
+
+
+def test_queda_repete_no_maximo_o_ultimo_bloco_sem_salvar(assinantes, monkeypatch):
+    bot_falso = BotTransmissaoFalso()
+
+    async def queda(transmissor):
+        # Como um kill: nada mais chega ao banco antes de a tarefa morrer.
+        salvar = bot.repositorio.salvar_progresso_transmissao
+
+        async def perdido(*args, **kwargs):
+            pass
+
+        monkeypatch.setattr(bot.repositorio, "salvar_progresso_transmissao", perdido)
+        await transmissor.parar()
+        monkeypatch.setattr(bot.repositorio, "salvar_progresso_transmissao", salvar)
+
+    _transmitir(bot_falso, queda)
+
+    assert set(bot_falso.recebidas) == set(range(2, DESTINATARIOS + 2))
+    repetidos = [user_id for user_id, n in bot_falso.recebidas.items() if n > 1]
+    assert all(n <= 2 for n in bot_falso.recebidas.values())
+    assert len(repetidos) <= 2 * SIMULTANEAS - 1
+    # Os repetidos são um bloco contíguo: o trecho ainda sem salvar quando o processo caiu.
+    assert max(repetidos) - min(repetidos) < 2 * SIMULTANEAS
+
+
+def test_erro_na_transmissao_avisa_o_admin(assinantes, monkeypatch):
+    bot_falso = BotTransmissaoFalso()
+    destinatarios = bot.repositorio.destinatarios
+    paginas = []
+
+    async def destinatarios_com_erro(*args):
+        paginas.append(args)
+        if len(paginas) == 2:
+            raise sqlite3.OperationalError("disk I/O error")
+        return await destinatarios(*args)
+
+    monkeypatch.setattr(bot.repositorio, "destinatarios", destinatarios_com_erro)
+
+    async def cenario():
+        await bot.repositorio.abrir()
+        transmissao_id = await bot.repositorio.criar_transmissao(1, "assinantes", "Oi!")
+        transmissor = bot.Transmissor(taxa=100_000, lote=500, simultaneas=SIMULTANEAS)
+        transmissor.iniciar(bot_falso, {'id': transmissao_id, 'admin_id': 1, 'publico': 'assinantes', 'texto': "Oi!",
+                                        'ultimo_user_id': 0, 'enviados': 0, 'bloqueados': 0, 'falhas': 0})
+        while transmissor.em_andamento():
+            await asyncio.sleep(0.01)
+        await bot.repositorio.fechar()
+        return transmissao_id
+
+    transmissao_id = asyncio.run(cenario())
+    assert len(bot_falso.admin) == 1 and "interrompida por erro" in bot_falso.admin[0]
+    status, enviados = _status(assinantes, transmissao_id)
+    assert status == 'em_andamento'
+    assert enviados >= 500 - SIMULTANEAS
+
+
+class RelogioFalso:
+    """Tempo virtual do balde: dormir só avança o relógio, então 100 mil envios a 25/s rodam em segundos."""
+
+    def __init__(self):
+        self.agora = 0.0
+
+    def __call__(self) -> float:
+        return self.agora
+
+    async def dormir(self, segundos: float):
+        # Como um sleep de verdade, sempre passa algum tempo (senão o resto de um arredondamento nunca avança).
+        self.agora += max(segundos, 1e-6)
+        await asyncio.sleep(0)
+
+
+class BotEscalaFalso:
+    """Registra o instante (virtual) de cada envio e devolve RetryAfter nos user_ids de `retry_after`, uma vez."""
+
+    def __init__(self, relogio: RelogioFalso, retry_after: set):
+        self.relogio = relogio
+        self.retry_after = set(retry_after)
+        self.envios = []  # (instante, user_id) das mensagens entregues
+        self.pausas = []  # (início, fim) das pausas pedidas
+        self.admin = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id == 1:
+            self.admin.append(text)
+            return
+        if chat_id in self.retry_after:
+            self.retry_after.discard(chat_id)
+            self.pausas.append((self.relogio.agora, self.relogio.agora + 5))
+            raise RetryAfter(5)
+        self.envios.append((self.relogio.agora, chat_id))
+
+
+def test_cem_mil_destinatarios_respeitam_a_taxa_e_recebem_uma_vez(banco, monkeypatch):
+    _inserir_assinantes(banco, DESTINATARIOS_ESCALA)
+    relogio = RelogioFalso()
+    bot_falso = BotEscalaFalso(relogio, retry_after={10_000, 50_000, 90_000})
+    salvar = bot.repositorio.salvar_progresso_transmissao
+    salvamentos = []
+
+    async def salvar_contando(*args, **kwargs):
+        salvamentos.append(args[0]['ultimo_user_id'])
+        await salvar(*args, **kwargs)
+
+    monkeypatch.setattr(bot.repositorio, "salvar_progresso_transmissao", salvar_contando)
+
+    async def cenario():
+        await bot.repositorio.abrir()
+        transmissao_id = await bot.repositorio.criar_transmissao(1, "assinantes", "Oi!")
+        transmissor = bot.Transmissor(simultaneas=SIMULTANEAS)
+        transmissor.balde = bot.BaldeDeFichas(bot.TRANSMISSAO_TAXA, relogio=relogio, dormir=relogio.dormir)
+        transmissor.iniciar(bot_falso, {'id': transmissao_id, 'admin_id': 1, 'publico': 'assinantes', 'texto': "Oi!",
+                                        'ultimo_user_id': 0, 'enviados': 0, 'bloqueados': 0, 'falhas': 0})
+        while transmissor.em_andamento():
+            await asyncio.sleep(0.01)
+        await bot.repositorio.fechar()
+        return transmissao_id
+
+    transmissao_id = asyncio.run(cenario())
+
+    taxa = bot.TRANSMISSAO_TAXA
+    instantes = [instante for instante, _ in bot_falso.envios]
+    recebidos = collections.Counter(user_id for _, user_id in bot_falso.envios)
+    assert set(recebidos) == set(range(2, DESTINATARIOS_ESCALA + 2)) and max(recebidos.values()) == 1
+    assert _status(banco, transmissao_id) == ('concluida', DESTINATARIOS_ESCALA)
+
+    # Balde: refazendo a conta das fichas sobre os instantes registrados, nunca falta ficha.
+    fichas, anterior = float(taxa), 0.0
+    for instante in instantes:
+        fichas = min(taxa, fichas + (instante - anterior) * taxa) - 1
+        anterior = instante
+        assert fichas >= -1e-6
+    # Nada sai durante uma pausa por RetryAfter.
+    assert len(bot_falso.pausas) == 3
+    assert not any(inicio < instante < fim for inicio, fim in bot_falso.pausas for instante in instantes)
+    # E a taxa é de fato usada: a duração é a mínima do balde mais as pausas.
+    minima = (DESTINATARIOS_ESCALA + 3 - taxa) / taxa + 5 * 3
+    assert minima - 1 <= instantes[-1] <= minima * 1.001
+    # Progresso salvo a cada SIMULTANEAS confirmações, sempre em ordem.
+    assert len(salvamentos) <= DESTINATARIOS_ESCALA // SIMULTANEAS + 2
+    assert salvamentos == sorted(salvamentos)
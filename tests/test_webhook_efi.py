@@ -0,0 +1,85 @@
+import asyncio
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import bot
+from falsos import BotFalso
+
+SEGREDO = "segredo-de-teste"
+TXID = "txid0001"
+
+
+@pytest.fixture
+def webhook(banco, monkeypatch):
+    liberados = []
+
+    async def liberar_acesso(bot_telegram, pagamento, sessao=None):
+        liberados.append(pagamento['txid'])
+
+    monkeypatch.setattr(bot, "liberar_acesso", liberar_acesso)
+    monkeypatch.setattr(bot, "WEBHOOK_EFI_SEGREDO", SEGREDO)
+    with sqlite3.connect(banco) as conn:
+        conn.execute(
+            "INSERT INTO pagamentos (txid, user_id, username, status, data_criacao, tipo_plano, valor_centavos) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (TXID, 1, "usuario", "pendente", int(time.time()), "mensal", 1000),
+        )
+    application = SimpleNamespace(bot=BotFalso(), user_data={})
+    return application, liberados
+
+
+def _postar(application, *pedidos) -> list:
+    """Faz os POSTs (query, corpo) ao mesmo tempo e retorna (status, json ou None) de cada um."""
+    async def executar():
+        await bot.repositorio.abrir()
+        try:
+            async with TestClient(TestServer(bot.criar_app_webhook_efi(application))) as cliente:
+                async def postar(query, corpo):
+                    resposta = await cliente.post(f"{bot.WEBHOOK_EFI_CAMINHO}/pix", params=query, data=corpo,
+                                                  headers={"Content-Type": "application/json"})
+                    return resposta.status, (await resposta.json() if resposta.status == 200 else None)
+                return await asyncio.gather(*(postar(query, corpo) for query, corpo in pedidos))
+        finally:
+            await bot.repositorio.fechar()
+    return asyncio.run(executar())
+
+
+def _status(db_file: str) -> str:
+    with sqlite3.connect(db_file) as conn:
+        return conn.execute("SELECT status FROM pagamentos WHERE txid = ?", (TXID,)).fetchone()[0]
+
+
+def test_recusa_sem_hmac_ou_com_hmac_errado(webhook, banco):
+    application, liberados = webhook
+    corpo = f'{{"pix": [{{"txid": "{TXID}"}}]}}'
+
+    respostas = _postar(application, ({}, corpo), ({"hmac": "errado"}, corpo), ({"hmac": "ção"}, corpo))
+
+    assert [status for status, _ in respostas] == [403, 403, 403]
+    assert liberados == []
+    assert _status(banco) == "pendente"
+
+
+def test_json_malformado_e_400(webhook):
+    application, _ = webhook
+
+    respostas = _postar(application, ({"hmac": SEGREDO}, "{pix"), ({"hmac": SEGREDO}, "[1, 2]"))
+
+    assert [status for status, _ in respostas] == [400, 400]
+
+
+def test_notificacao_aprova_e_libera_uma_vez_mesmo_repetida(webhook, banco):
+    application, liberados = webhook
+    corpo = f'{{"pix": [{{"txid": "{TXID}", "valor": "10.00"}}]}}'
+
+    # A Efí reenvia a mesma notificação; as repetidas chegam juntas e depois de novo.
+    respostas = _postar(application, *[({"hmac": SEGREDO}, corpo)] * 5)
+    respostas += _postar(application, ({"hmac": SEGREDO}, corpo))
+
+    assert all(status == 200 for status, _ in respostas)
+    assert sum(dados["liberados"] for _, dados in respostas) == 1
+    assert liberados == [TXID]
+    assert _status(banco) == "aprovado"
@@ -0,0 +1,39 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import bot
+
+
+def test_aprovacao_no_worker_0_limpa_a_sessao_no_worker_do_usuario(monkeypatch):
+    liberados = []
+
+    async def liberar_acesso(bot_telegram, pagamento, sessao=None):
+        liberados.append((pagamento['user_id'], sessao))
+
+    monkeypatch.setattr(bot, "liberar_acesso", liberar_acesso)
+    monkeypatch.setattr(bot, "WORKER_TOTAL", 2)
+    monkeypatch.setattr(bot, "WORKER_INDICE", 0)
+    sessao_local = bot.SessaoUsuario()
+    application = SimpleNamespace(bot=None, user_data={4: sessao_local})
+
+    async def executar():
+        avisos = []
+        recebido = asyncio.Event()
+
+        async def worker_1(leitor, escritor):
+            avisos.append(json.loads(await leitor.readline()))
+            escritor.close()
+            recebido.set()
+
+        servidor = await asyncio.start_server(worker_1, bot.WORKERS_HOST, 0)
+        monkeypatch.setattr(bot, "WORKERS_PORTA_BASE", servidor.sockets[0].getsockname()[1] - 1)
+        async with servidor:
+            await bot.liberar_acesso_aprovado(application, {"user_id": 4})
+            await bot.liberar_acesso_aprovado(application, {"user_id": 5})
+            await asyncio.wait_for(recebido.wait(), 5)
+        return avisos
+
+    avisos = asyncio.run(executar())
+    assert liberados == [(4, sessao_local), (5, None)]
+    assert avisos == [{bot.AVISO_ACESSO_LIBERADO: 5}]